@@ -0,0 +1,42 @@
+'''
+Checks and benchmarks for the modules in `media-processor/`. They aren't part of the app and aren't installed with it.
+Run one from the repository root with `python3 -m checks.<name>`. Each prints what it measured and exits with a non-zero status if a check fails.
+'''
+import os
+import sys
+import time
+from typing import Any, Callable
+
+# The app's modules import each other by their plain names, so its folder has to be on the path
+APP_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'media-processor')
+if APP_DIR not in sys.path:
+	sys.path.insert(0, APP_DIR)
+
+
+class Checks(object):
+	'''Collects failed checks and reports them all at the end'''
+	def __init__(self):
+		self.failures: list[str] = []
+
+	def expect(self, ok: bool, failure: str) -> bool:
+		'''Record `failure` unless `ok`. Returns `ok`.'''
+		if not ok:
+			self.failures.append(failure)
+		return ok
+
+	def finish(self, summary: str = '') -> None:
+		'''Print the failures and exit with status 1 if there were any, otherwise print OK'''
+		if self.failures:
+			print('FAIL: ' + '\n'.join(self.failures))
+			sys.exit(1)
+		print(f'OK: {summary}' if summary else 'OK')
+
+
+def best_time(run: Callable[[], Any], repeat: int = 5) -> tuple[Any, float]:
+	'''The result of `run` and the fastest of `repeat` runs in seconds, so a busy machine doesn't decide which of two ways looks faster'''
+	times = []
+	for _ in range(repeat):
+		started = time.perf_counter()
+		result = run()
+		times.append(time.perf_counter() - started)
+	return result, min(times)
@@ -0,0 +1,135 @@
+'''
+Reader threads share one instance and read queue counts and a page of jobs while another connection writes large batches, like the watcher flushing its scan index.
+Compares the single lock-guarded connection the DB used before WAL mode with one `shared` connection and with per-thread connections, and checks reads never fail or stall behind the writer.
+'''
+import argparse
+import os
+from sqlite3 import connect
+import tempfile
+from threading import Event, Lock, Thread
+import time
+
+# First, so the app's modules can be imported
+from checks import Checks
+
+from db import JOB_STATES, STAGE_STATES, LockableSqliteConn, create_tables, job_counts
+
+
+class SingleSqliteConn(object):
+	'''`LockableSqliteConn` as it was before WAL mode: one connection in the default rollback journal mode, used by one thread at a time'''
+	def __init__(self, db: str):
+		self.lock = Lock()
+		self.conn = connect(db, check_same_thread=False)
+		self.cur = None
+
+	def __enter__(self):
+		self.lock.acquire()
+		self.cur = self.conn.cursor()
+		return self
+
+	def __exit__(self, type, value, traceback):
+		if self.cur is not None:
+			self.cur.close()
+			self.cur = None
+		self.lock.release()
+
+	def close(self) -> None:
+		self.conn.close()
+
+
+def run(open_conn, readers: int, seconds: float, batch_rows: int) -> tuple[list[int], list[float], int, list[str]]:
+	'''Reads per reader thread, read latencies, batches written and errors, from `readers` threads sharing one `open_conn()` and a writer on its own'''
+	lconn = open_conn()
+	stop = Event()
+	reads = [0] * readers
+	latencies: list[float] = []
+	errors: list[str] = []
+	writes = 0
+
+	def read(k: int) -> None:
+		while not stop.is_set():
+			started = time.perf_counter()
+			try:
+				job_counts(lconn, STAGE_STATES)
+				with lconn:
+					lconn.cur.execute('''SELECT id, path, state, progress FROM jobs WHERE state = 'transcoding' ORDER BY priority DESC, id LIMIT 50;''')
+					lconn.cur.fetchall()
+			except Exception as e:
+				errors.append(f'read: {e}')
+				continue
+			reads[k] += 1
+			latencies.append(time.perf_counter() - started)
+
+	def write() -> None:
+		nonlocal writes
+		writer = open_conn()
+		while not stop.is_set():
+			try:
+				with writer:
+					writer.cur.executemany('''INSERT OR REPLACE INTO scan_index (path, inode, size, mtime, ctime) VALUES (?, ?, ?, ?, ?);''', [(f'/watch/{writes}/{i}.mkv', i, i, 0.0, 0.0) for i in range(batch_rows)])
+					writer.conn.commit()
+			except Exception as e:
+				errors.append(f'write: {e}')
+			writes += 1
+		writer.close()
+
+	threads = [Thread(target=read, args=(k,)) for k in range(readers)] + [Thread(target=write)]
+	for t in threads:
+		t.start()
+	time.sleep(seconds)
+	stop.set()
+	for t in threads:
+		t.join()
+	lconn.close()
+	return reads, sorted(latencies), writes, errors
+
+
+def main() -> None:
+	parser = argparse.ArgumentParser(description=__doc__)
+	parser.add_argument('-s', '--seconds', dest='seconds', help='seconds to run each reader count for', type=float, default=3.0)
+	parser.add_argument('-j', '--jobs', dest='jobs', help='jobs in the DB', type=int, default=20000)
+	parser.add_argument('-b', '--batch', dest='batch', help='rows in each write transaction', type=int, default=50000)
+	args: argparse.Namespace = parser.parse_args()
+
+	checks = Checks()
+	with tempfile.TemporaryDirectory() as tmp:
+		name = os.path.join(tmp, 'bench.sqlite3')
+		setup = LockableSqliteConn(name)
+		create_tables(setup)
+		now = time.time()
+		with setup:
+			setup.cur.executemany('''INSERT INTO jobs (path, state, priority, created, updated, progress) VALUES (?, ?, 0, ?, ?, '{}');''', [(f'/watch/{i}.mkv', JOB_STATES[i % len(JOB_STATES)], now, now) for i in range(args.jobs)])
+			setup.conn.commit()
+		setup.close()
+		# The same DB back in the rollback journal mode it had before
+		single_name = os.path.join(tmp, 'single.sqlite3')
+		conn = connect(name)
+		conn.execute('''VACUUM INTO ?;''', (single_name,))
+		conn.close()
+		conn = connect(single_name)
+		conn.execute('''PRAGMA journal_mode = DELETE;''')
+		conn.close()
+
+		# Reads per second of the single connection before WAL, by reader count
+		baseline = {}
+		for mode, open_conn in (('single connection before WAL', lambda: SingleSqliteConn(single_name)), ('shared connection', lambda: LockableSqliteConn(name, True)), ('per-thread connections', lambda: LockableSqliteConn(name))):
+			for readers in (1, 2, 4, 8):
+				reads, latencies, writes, errors = run(open_conn, readers, args.seconds, args.batch)
+				p50 = latencies[len(latencies) // 2] * 1000 if latencies else 0.0
+				worst = latencies[-1] * 1000 if latencies else 0.0
+				rate = sum(reads) / args.seconds
+				print(f'{mode}, {readers} reader threads: {rate:.0f} reads/s, {writes} batches of {args.batch} rows written, read p50 {p50:.1f} ms, max {worst:.0f} ms' + (f', {len(errors)} errors' if errors else ''))
+				if mode == 'single connection before WAL':
+					# What WAL mode fixed. Reported, not failed.
+					baseline[readers] = rate
+					continue
+				checks.expect(not errors, '\n'.join(errors[:3]))
+				checks.expect(writes > 0, f'the writer made no progress with a {mode} and {readers} readers')
+				if mode == 'per-thread connections':
+					checks.expect(all(reads), f'a reader made no progress with {readers} readers')
+					checks.expect(rate > baseline[readers], f'{readers} readers with per-thread connections were no faster than the single connection before WAL')
+	checks.finish()
+
+
+if __name__ == '__main__':
+	main()
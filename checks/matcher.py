@@ -0,0 +1,58 @@
+'''Matches noisy filenames against a synthetic catalog with the trigram index, as a batch, and by scoring every property, and compares the speed and the answers'''
+import argparse
+import random
+import time
+
+# First, so the app's modules can be imported
+from checks import Checks, best_time
+
+from matcher import Matcher, cdist_ok
+
+
+def main() -> None:
+	parser = argparse.ArgumentParser(description=__doc__)
+	parser.add_argument('-c', '--catalog', dest='catalog', help='how many properties in the catalog', type=int, default=20000)
+	parser.add_argument('-n', '--queries', dest='queries', help='how many filenames to match', type=int, default=300)
+	parser.add_argument('-p', '--partial', dest='partial', help='fraction of patterns matched partially', type=float, default=0.05)
+	parser.add_argument('-a', '--min-agreement', dest='min_agreement', help='fraction of answers that must agree with scoring every property', type=float, default=0.85)
+	parser.add_argument('-r', '--repeat', dest='repeat', help='runs of each way of matching, of which the fastest is kept', type=int, default=9)
+	args: argparse.Namespace = parser.parse_args()
+
+	rng = random.Random(1)
+	letters = 'eeeeeeeeeeeetttttttttaaaaaaaaooooooooiiiiiiinnnnnnnsssssshhhhhhrrrrrrddddlllluuucccmmmwwffggyyppbbvkjxqz'
+	words = [''.join(rng.choice(letters) for _ in range(rng.randint(3, 9))) for _ in range(8000)] + ['the', 'of', 'and', 'a', 'in'] * 400
+	titles = list(dict.fromkeys(' '.join(rng.choice(words).capitalize() for _ in range(rng.randint(1, 4))) for _ in range(args.catalog * 2)))[:args.catalog]
+	matcher = Matcher([(t, t, rng.random() < args.partial) for t in titles])
+	filenames = []
+	for _ in range(args.queries):
+		# A cleaned filename: the title plus a leftover tag, sometimes with a typo
+		f = rng.choice(titles) + rng.choice(['', ' S01E02', ' 2019', ' Extended'])
+		if rng.random() < 0.3:
+			i = rng.randrange(len(f))
+			f = f[:i] + f[i + 1:]
+		filenames.append(f)
+	print(f'{len(titles)} properties, {len(matcher.stop_grams)} stop trigrams, {len(matcher.unindexed)} unindexed')
+
+	indexed, indexed_time = best_time(lambda: [matcher.match(f) for f in filenames], args.repeat)
+	batched, batched_time = best_time(lambda: matcher.match_batch(filenames), args.repeat)
+	started = time.perf_counter()
+	brute = [(matcher.top_k(f, 1, exhaustive=True) or [None])[0] for f in filenames]
+	brute_time = time.perf_counter() - started
+
+	agree = sum(a == b for a, b in zip(indexed, brute))
+	same_score = sum((a and a[1]) == (b and b[1]) for a, b in zip(indexed, brute))
+	print(f'indexed: {len(filenames) / indexed_time:.1f} matches/s')
+	print(f'batched: {len(filenames) / batched_time:.1f} matches/s ({"rapidfuzz" if cdist_ok else "thefuzz"})')
+	print(f'every property: {len(filenames) / brute_time:.1f} matches/s')
+	print(f'agreement with every property: {agree}/{len(filenames)} same property, {same_score}/{len(filenames)} same best score')
+
+	checks = Checks()
+	checks.expect(indexed_time < brute_time, 'the index was no faster than scoring every property')
+	checks.expect(agree >= args.min_agreement * len(filenames), f'only {agree}/{len(filenames)} answers agreed with scoring every property')
+	checks.expect(batched == indexed, f'{sum(a != b for a, b in zip(batched, indexed))} batched matches differ from single matches')
+	checks.expect(batched_time < indexed_time, 'matching as a batch was no faster than one file at a time')
+	checks.finish()
+
+
+if __name__ == '__main__':
+	main()
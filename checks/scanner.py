@@ -0,0 +1,69 @@
+'''Walks a generated tree with a plain recursive scandir and stat of every file (as the watcher did before) and with `TreeScanner`, cold and unchanged, and checks they see the same files'''
+import argparse
+import os
+import tempfile
+import time
+
+# First, so the app's modules can be imported
+from checks import Checks
+
+from scanner import RACY_NS, TreeScanner
+
+
+def plain_walk(path: str) -> dict[str, float]:
+	'''ctime of every file under `path`'''
+	ctimes = {}
+	for entry in os.scandir(path):
+		if entry.is_file():
+			ctimes[entry.path] = os.stat(entry.path).st_ctime
+		else:
+			ctimes.update(plain_walk(entry.path))
+	return ctimes
+
+
+def main() -> None:
+	parser = argparse.ArgumentParser(description=__doc__)
+	parser.add_argument('-n', '--files', dest='files', help='how many files in the generated tree', type=int, default=100000)
+	parser.add_argument('-w', '--workers', dest='workers', help='threads listing directories', type=int, default=8)
+	args: argparse.Namespace = parser.parse_args()
+
+	checks = Checks()
+	with tempfile.TemporaryDirectory() as tmp:
+		# Shows with 10 seasons of 20 episodes each
+		for i in range(args.files):
+			season = os.path.join(tmp, f'Show {i // 200}', f'Season {i // 20 % 10 + 1}')
+			if i % 20 == 0:
+				os.makedirs(season)
+			open(os.path.join(season, f'Episode {i % 20 + 1}.mkv'), 'w').close()
+		# Let the tree age past the window where a directory's mtime can't be trusted
+		time.sleep(RACY_NS / 10**9 + 0.1)
+
+		started = time.perf_counter()
+		expected = plain_walk(tmp)
+		print(f'plain walk: {len(expected)} files in {time.perf_counter() - started:.3f} s')
+		scanner = TreeScanner(tmp, args.workers)
+		started = time.perf_counter()
+		added, removed = scanner.scan()
+		print(f'TreeScanner cold: {len(added)} files in {time.perf_counter() - started:.3f} s')
+		checks.expect({row[0]: row[4] for row in added} == expected and not removed, 'the cold scan saw different files than the plain walk')
+		started = time.perf_counter()
+		added, removed = scanner.scan()
+		unchanged_time = time.perf_counter() - started
+		print(f'TreeScanner unchanged: {len(added)} new files in {unchanged_time:.3f} s')
+		checks.expect(not added and not removed, f'the scan of an unchanged tree reported {len(added)} new and {len(removed)} removed files')
+
+		started = time.perf_counter()
+		plain_walk(tmp)
+		checks.expect(unchanged_time < time.perf_counter() - started, 'scanning an unchanged tree was no faster than the plain walk')
+
+		new_file = os.path.join(tmp, 'Show 0', 'Season 1', 'Episode 21.mkv')
+		old_file = os.path.join(tmp, 'Show 0', 'Season 2', 'Episode 1.mkv')
+		open(new_file, 'w').close()
+		os.remove(old_file)
+		added, removed = scanner.scan()
+		checks.expect([row[0] for row in added] == [new_file] and removed == [old_file], f'after adding and removing a file the scan reported {[row[0] for row in added]} new and {removed} removed')
+	checks.finish()
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,121 @@
+'''
+Pipeline check with stand-ins for ffmpeg and ffprobe on PATH. Transcode threads work through jobs of different resolutions, and each fake ffmpeg logs its `-threads` and the cores it was pinned to.
+Checks that no more transcodes run at once than admitted, running transcodes never share a core, and each one gets `-threads` equal to its share of cores and no more than it asked for.
+'''
+import argparse
+import json
+import os
+import re
+import sys
+import tempfile
+import time
+
+# First, so the app's modules can be imported
+from checks import Checks
+
+from catalog import PropertyCatalog
+from db import LockableSqliteConn, advance_job, create_tables, enqueue_job
+import processor
+from probe import probe
+from scheduler import TranscodeScheduler
+from sftp_pool import SftpPool
+from transfer_scheduler import TransferScheduler
+
+# Prints what ffprobe would for a file named <width>x<height>-<seconds>.mkv
+FAKE_FFPROBE = f'''#!{sys.executable}
+import json, os, re, sys
+# The resolution and duration come from the file name: <width>x<height>-<seconds>.mkv
+width, height, duration = map(int, re.search(r'(\\d+)x(\\d+)-(\\d+)', os.path.basename(sys.argv[-1])).groups())
+print(json.dumps({{'streams': [{{'codec_type': 'video', 'codec_name': 'h264', 'width': width, 'height': height}}], 'format': {{'duration': str(duration), 'size': '1000'}}}}))
+'''
+# Takes FAKE_FFMPEG_SECONDS to write a small output, and logs its -threads and affinity to FAKE_FFMPEG_LOG
+FAKE_FFMPEG = f'''#!{sys.executable}
+import json, os, sys, time
+started = time.time()
+# Give the scheduler time to pin this process before looking at its affinity
+time.sleep(0.2)
+affinity = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else None
+time.sleep(float(os.environ['FAKE_FFMPEG_SECONDS']))
+with open(sys.argv[-1], 'wb') as f:
+	f.write(b'x' * 1000)
+print('progress=end', flush=True)
+with open(os.environ['FAKE_FFMPEG_LOG'], 'a') as f:
+	f.write(json.dumps({{'input': sys.argv[sys.argv.index('-i') + 1], 'threads': int(sys.argv[sys.argv.index('-threads') + 1]), 'affinity': affinity, 'started': started, 'finished': time.time()}}) + '\\n')
+'''
+
+
+def main() -> None:
+	parser = argparse.ArgumentParser(description=__doc__)
+	parser.add_argument('-j', '--max-jobs', dest='max_jobs', help='most transcodes at once. defaults to the number of available cores', type=int)
+	parser.add_argument('-n', '--jobs', dest='jobs', help='how many files to transcode', type=int, default=8)
+	parser.add_argument('-s', '--seconds', dest='seconds', help='how long each fake transcode takes', type=float, default=1.0)
+	args: argparse.Namespace = parser.parse_args()
+
+	with tempfile.TemporaryDirectory() as tmp:
+		bin_dir = os.path.join(tmp, 'bin')
+		os.makedirs(bin_dir)
+		for name, script in (('ffprobe', FAKE_FFPROBE), ('ffmpeg', FAKE_FFMPEG)):
+			with open(os.path.join(bin_dir, name), 'w') as f:
+				f.write(script)
+			os.chmod(os.path.join(bin_dir, name), 0o755)
+		os.environ['PATH'] = bin_dir + os.pathsep + os.environ['PATH']
+		os.environ['FAKE_FFMPEG_SECONDS'] = str(args.seconds)
+		log_path = os.environ['FAKE_FFMPEG_LOG'] = os.path.join(tmp, 'ffmpeg.log')
+		# The stages use `db.sqlite3` in the working directory
+		os.chdir(tmp)
+
+		lconn = LockableSqliteConn('db.sqlite3')
+		create_tables(lconn)
+		with lconn:
+			lconn.cur.execute('''INSERT INTO properties (property, pattern, partial) VALUES ('Clip', 'Clip', 0);''')
+			lconn.cur.execute('''INSERT INTO property_settings (property, ffmpeg_input_args, ffmpeg_output_args, output_container, user_at_ip, folder, is_show) VALUES ('Clip', '', '-c:v libx264', 'mkv', NULL, ?, 0);''', (os.path.join(tmp, 'out'),))
+			lconn.conn.commit()
+		# 4K, 1080p and 720p features, and a short clip that only gets one core
+		sizes = ['3840x2160-3600', '1920x1080-3600', '1280x720-3600', '1920x1080-60']
+		os.makedirs(os.path.join(tmp, 'in'))
+		for i in range(args.jobs):
+			item = os.path.join(tmp, 'in', f'{i}-{sizes[i % len(sizes)]}.mkv')
+			with open(item, 'w') as f:
+				# Different contents, so no job reuses another's result
+				f.write(str(i))
+			advance_job(lconn, enqueue_job(lconn, item), 'transcoding', property='Clip', filename=f'Clip {i}')
+
+		scheduler = TranscodeScheduler(args.max_jobs, float('inf'))
+		catalog = PropertyCatalog('db.sqlite3')
+		# One more thread than may transcode at once, so admission has to hold one back
+		threads = [processor.TranscodeThread(os.path.join(tmp, 'process'), re.compile(r's(\d+)e(\d+)'), re.compile(r'e(\d{2,})'), catalog, scheduler, SftpPool(None, None, None), TransferScheduler(catalog, 1), False, args.jobs, 0, 1, i + 1) for i in range(scheduler.max_jobs + 1)]
+		for t in threads:
+			t.start()
+		deadline = time.monotonic() + args.jobs * (args.seconds + 5)
+		while time.monotonic() < deadline:
+			with lconn:
+				lconn.cur.execute('''SELECT COUNT(*) FROM jobs WHERE state != 'transferring';''')
+				if not lconn.cur.fetchone()[0]:
+					break
+			time.sleep(0.2)
+		processor.kill()
+		for t in threads:
+			t.join()
+
+		with open(log_path) as f:
+			runs = [json.loads(line) for line in f]
+		checks = Checks()
+		checks.expect(len(runs) == args.jobs, f'{len(runs)} of {args.jobs} transcodes ran')
+		for r in runs:
+			name = os.path.basename(r['input'])
+			_, wanted = scheduler.estimate(probe(r['input']))
+			checks.expect(r['threads'] <= wanted, f'{name} got -threads {r["threads"]}, more than the {wanted} it asked for')
+			checks.expect(r['affinity'] is None or len(r['affinity']) == r['threads'], f'{name} got -threads {r["threads"]} but was pinned to cores {r["affinity"]}')
+			overlapping = [o for o in runs if o['started'] < r['finished'] and r['started'] < o['finished']]
+			checks.expect(len(overlapping) <= scheduler.max_jobs, f'{len(overlapping)} transcodes ran alongside {name}, more than the {scheduler.max_jobs} admitted at once')
+			for o in overlapping:
+				if o is not r and r['affinity'] and o['affinity']:
+					shared = sorted(set(r['affinity']) & set(o['affinity']))
+					checks.expect(not shared, f'{name} and {os.path.basename(o["input"])} ran at the same time on cores {shared}')
+		peak = max(sum(1 for o in runs if o['started'] <= r['started'] < o['finished']) for r in runs) if runs else 0
+		print(f'{len(runs)} transcodes on {len(scheduler.cores)} cores, at most {peak} at once (limit {scheduler.max_jobs}). -threads used: {sorted(r["threads"] for r in runs)}')
+		checks.finish('admission, -threads and affinity are consistent')
+
+
+if __name__ == '__main__':
+	main()
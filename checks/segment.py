@@ -0,0 +1,62 @@
+'''Correctness check. Encodes a generated clip losslessly both in a single pass and in segments and compares the decoded frames and audio. Needs ffmpeg.'''
+import argparse
+import os
+from subprocess import run, PIPE
+import tempfile
+
+# First, so the app's modules can be imported
+from checks import Checks
+
+from probe import probe
+from segment import SegmentPlan
+
+
+def frame_hashes(path: str) -> list[tuple[str, str]]:
+	'''(pts, md5) of every decoded video frame'''
+	p = run(['ffmpeg', '-v', 'quiet', '-i', path, '-map', '0:v', '-f', 'framemd5', '-'], stdout=PIPE, check=True)
+	frames = []
+	for line in p.stdout.decode().splitlines():
+		cols = [c.strip() for c in line.split(',')]
+		if not line.startswith('#') and len(cols) == 6:
+			frames.append((cols[2], cols[5]))
+	return frames
+
+
+def audio_hash(path: str) -> str:
+	p = run(['ffmpeg', '-v', 'quiet', '-i', path, '-map', '0:a', '-f', 'md5', '-'], stdout=PIPE, check=True)
+	return p.stdout.decode().strip()
+
+
+def main() -> None:
+	parser = argparse.ArgumentParser(description=__doc__)
+	parser.add_argument('-n', '--segments', dest='segments', help='how many segments to split the clip into', type=int, default=4)
+	parser.add_argument('-d', '--duration', dest='duration', help='length of the generated clip in seconds', type=float, default=30.0)
+	args: argparse.Namespace = parser.parse_args()
+
+	checks = Checks()
+	with tempfile.TemporaryDirectory() as tmp:
+		source = os.path.join(tmp, 'source.mkv')
+		# Keyframes every 2 seconds with B-frames, like a typical download
+		run(['ffmpeg', '-y', '-v', 'quiet', '-f', 'lavfi', '-i', f'testsrc2=size=640x360:rate=24:duration={args.duration}', '-f', 'lavfi', '-i', f'sine=frequency=440:duration={args.duration}', '-c:v', 'libx264', '-g', '48', '-bf', '2', '-c:a', 'aac', source], check=True)
+		output_args = ['-c:v', 'ffv1', '-c:a', 'flac']
+		single = os.path.join(tmp, 'single.mkv')
+		run(['ffmpeg', '-y', '-v', 'quiet', '-i', source, *output_args, single], check=True)
+		segmented = os.path.join(tmp, 'segmented.mkv')
+		plan = SegmentPlan(source, [], output_args, [], segmented, probe(source), args.segments)
+		plan.prepare()
+		run(plan.split, check=True)
+		for c in [plan.audio] + plan.encodes(1):
+			run(c, check=True)
+		run(plan.join, check=True)
+		pieces = len(plan.encodes(1))
+		plan.cleanup()
+		expected, got = frame_hashes(single), frame_hashes(segmented)
+		print(f'Split into {pieces} pieces. Single pass: {len(expected)} frames. Segmented: {len(got)} frames.')
+		mismatched = [i for i, (a, b) in enumerate(zip(expected, got)) if a != b]
+		checks.expect(len(expected) == len(got) and not mismatched, f'{len(mismatched)} frames differ' + (f', first at frame {mismatched[0]}' if mismatched else ''))
+		checks.expect(audio_hash(single) == audio_hash(segmented), 'audio differs')
+	checks.finish('decoded video frames and audio are identical')
+
+
+if __name__ == '__main__':
+	main()
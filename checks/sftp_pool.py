@@ -0,0 +1,103 @@
+'''Checks against a local stand-in SFTP server with added latency: per file latency of a new connection per upload vs a pooled session, reuse, reconnecting after the server drops the session, and the per-destination cap'''
+import argparse
+import logging
+import os
+import tempfile
+import threading
+import time
+
+# First, so the app's modules can be imported
+from checks import Checks
+from checks.sftp_standin import StandInSftpServer
+
+from paramiko.ssh_exception import SSHException
+
+from sftp_pool import SftpPool
+
+
+def main() -> None:
+	parser = argparse.ArgumentParser(description=__doc__)
+	parser.add_argument('-n', '--files', dest='files', help='how many small files to upload each way', type=int, default=20)
+	parser.add_argument('-l', '--latency', dest='latency', help='seconds added to each direction of the link', type=float, default=0.01)
+	args: argparse.Namespace = parser.parse_args()
+	logging.basicConfig(level=logging.INFO)
+
+	checks = Checks()
+	with tempfile.TemporaryDirectory() as tmp:
+		server = StandInSftpServer(os.path.join(tmp, 'remote'), latency=args.latency)
+		destination = server.user_at_ip()
+		source = os.path.join(tmp, 'small.bin')
+		with open(source, 'wb') as f:
+			f.write(os.urandom(4096))
+
+		def connect_per_file(i: int) -> None:
+			'''What uploads did before the pool'''
+			connection = SftpPool(None, None, None).connect(destination, server.password)
+			connection.sftp.put(source, f'/connect-{i}.bin')
+			connection.close()
+
+		pool = SftpPool(None, None, None, 2)
+		def pooled(i: int) -> None:
+			with pool.session(destination, server.password) as sftp:
+				sftp.put(source, f'/pooled-{i}.bin')
+
+		medians = {}
+		for name, upload in (('new connection per file', connect_per_file), ('pooled session', pooled)):
+			connections = server.connections
+			times = []
+			for i in range(args.files):
+				started = time.perf_counter()
+				upload(i)
+				times.append(time.perf_counter() - started)
+			times.sort()
+			medians[name] = times[len(times) // 2]
+			print(f'{name}: median {medians[name] * 1000:.1f} ms, p90 {times[int(len(times) * 0.9)] * 1000:.1f} ms per file, {server.connections - connections} connections')
+		checks.expect(server.connections - connections == 1, f'{args.files} sequential pooled uploads opened {server.connections - connections} connections instead of 1')
+		checks.expect(medians['pooled session'] < medians['new connection per file'], 'pooled uploads were no faster than a new connection per file')
+
+		# The server goes away under an idle pooled session. The next upload should notice and reconnect rather than fail.
+		connections = server.connections
+		server.drop()
+		deadline = time.monotonic() + 5.0
+		while time.monotonic() < deadline and pool.idle[destination][0].client.get_transport().is_active():
+			time.sleep(0.05)
+		try:
+			pooled('after-drop')
+		except (SSHException, OSError, EOFError) as e:
+			checks.expect(False, f'upload after the server dropped the session failed ({type(e).__name__}: {e})')
+		checks.expect(server.connections - connections == 1 and os.path.exists(os.path.join(tmp, 'remote', 'pooled-after-drop.bin')), 'the pool did not reconnect after the server dropped its session')
+		print(f'After the server dropped the session: reconnected with {server.connections - connections} new connection')
+
+		# More uploads at once than the cap. No more than `max_per_destination` sessions should be open or in use.
+		in_use = 0
+		peak = 0
+		lock = threading.Lock()
+		def hold(i: int) -> None:
+			nonlocal in_use, peak
+			with pool.session(destination, server.password) as sftp:
+				with lock:
+					in_use += 1
+					peak = max(peak, in_use)
+				sftp.put(source, f'/capped-{i}.bin')
+				time.sleep(0.2)
+				with lock:
+					in_use -= 1
+		connections = server.connections
+		workers = [threading.Thread(target=hold, args=(i,)) for i in range(3 * pool.max_per_destination)]
+		for w in workers:
+			w.start()
+		time.sleep(0.1)
+		checks.expect(pool.acquire(destination, server.password, wait=False) is None, 'acquire without waiting handed out a session beyond the cap')
+		for w in workers:
+			w.join()
+		print(f'{len(workers)} uploads at once with a cap of {pool.max_per_destination}: at most {peak} in use, {pool.open[destination]} open, {server.connections - connections} new connections')
+		checks.expect(peak <= pool.max_per_destination and pool.open[destination] <= pool.max_per_destination, f'{peak} sessions were in use at once, over the cap of {pool.max_per_destination}')
+
+		pool.close()
+		checks.expect(not pool.open[destination], f'{pool.open[destination]} sessions still open after closing the pool')
+		server.close()
+	checks.finish('sessions are reused, reconnected, and capped per destination')
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,230 @@
+import errno
+import hashlib
+import os
+from queue import Queue
+import socket
+import threading
+import time
+
+from paramiko import AUTH_FAILED, AUTH_SUCCESSFUL, Message, OPEN_SUCCEEDED, RSAKey, SFTP_FAILURE, SFTP_OK, SFTP_OP_UNSUPPORTED, SFTPAttributes, SFTPHandle, SFTPServer, SFTPServerInterface, ServerInterface, Transport
+from paramiko.sftp import CMD_EXTENDED_REPLY
+
+# Bytes read from a connection at a time when adding latency
+PUMP_SIZE = 64 * 1024
+
+
+class StandInSftpServer(object):
+	'''
+	A local SFTP server serving the folder `root` on 127.0.0.1, for the `sftp_pool` and `sftp_upload` checks. Any user logs in with `password`.
+	`latency` seconds are added to each direction of every connection, like a long distance link. `check_file` turns on the `check-file` extension, which OpenSSH doesn't have.
+	'''
+	def __init__(self, root: str, password: str = 'pw', latency: float = 0.0, check_file: bool = False):
+		self.root: str = root
+		self.password: str = password
+		self.latency: float = latency
+		self.check_file: bool = check_file
+		self.host_key = RSAKey.generate(2048)
+		self.lock = threading.Lock()
+		# Connections accepted so far
+		self.connections: int = 0
+		self.sockets: list[socket.socket] = []
+		self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		self.listener.bind(('127.0.0.1', 0))
+		self.listener.listen(50)
+		self.port: int = self.listener.getsockname()[1]
+		threading.Thread(target=self.accept, name='Stand-in SFTP Server', daemon=True).start()
+
+	def user_at_ip(self, user: str = 'user') -> str:
+		return f'{user}@127.0.0.1:{self.port}'
+
+	def accept(self) -> None:
+		while True:
+			try:
+				conn, _ = self.listener.accept()
+			except OSError:
+				# Closed
+				return
+			with self.lock:
+				self.connections += 1
+				self.sockets.append(conn)
+			threading.Thread(target=self.serve, args=(conn,), daemon=True).start()
+
+	def serve(self, conn: socket.socket) -> None:
+		if self.latency:
+			conn = self.delay(conn)
+		transport = Transport(conn)
+		transport.add_server_key(self.host_key)
+		transport.set_subsystem_handler('sftp', CheckFileServer if self.check_file else NoCheckFileServer, StandInInterface, self.root)
+		server = StandInAuth(self.password)
+		try:
+			transport.start_server(server=server)
+		except Exception:
+			# The client went away during the handshake
+			return
+
+	def delay(self, conn: socket.socket) -> socket.socket:
+		'''Put `latency` between the client's socket and the server side of a socket pair. Returns the server side.'''
+		outer, inner = socket.socketpair()
+		for src, dst in ((conn, outer), (outer, conn)):
+			threading.Thread(target=self.pump, args=(src, dst), daemon=True).start()
+		return inner
+
+	def pump(self, src: socket.socket, dst: socket.socket) -> None:
+		'''Forward everything read from `src` to `dst` `latency` seconds later, without limiting the throughput'''
+		queue: Queue = Queue()
+		def send() -> None:
+			while True:
+				due, data = queue.get()
+				if data is None:
+					break
+				time.sleep(max(0.0, due - time.monotonic()))
+				try:
+					dst.sendall(data)
+				except OSError:
+					break
+			try:
+				dst.shutdown(socket.SHUT_WR)
+			except OSError:
+				pass
+		threading.Thread(target=send, daemon=True).start()
+		while True:
+			try:
+				data = src.recv(PUMP_SIZE)
+			except OSError:
+				data = b''
+			queue.put((time.monotonic() + self.latency, data or None))
+			if not data:
+				return
+
+	def drop(self) -> None:
+		'''Cut every open connection, as if the server had restarted'''
+		with self.lock:
+			sockets, self.sockets = self.sockets, []
+		for conn in sockets:
+			try:
+				conn.shutdown(socket.SHUT_RDWR)
+			except OSError:
+				pass
+			conn.close()
+
+	def close(self) -> None:
+		self.listener.close()
+		self.drop()
+
+
+class StandInAuth(ServerInterface):
+	def __init__(self, password: str):
+		self.password: str = password
+
+	def get_allowed_auths(self, username: str) -> str:
+		return 'password'
+
+	def check_auth_password(self, username: str, password: str) -> int:
+		return AUTH_SUCCESSFUL if password == self.password else AUTH_FAILED
+
+	def check_channel_request(self, kind: str, chanid: int) -> int:
+		return OPEN_SUCCEEDED
+
+
+class StandInHandle(SFTPHandle):
+	def stat(self):
+		return SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+
+	def chattr(self, attr):
+		return SFTP_OK
+
+
+class StandInInterface(SFTPServerInterface):
+	'''Serves `root` as `/`'''
+	def __init__(self, server, root: str):
+		SFTPServerInterface.__init__(self, server)
+		self.root: str = root
+
+	def real(self, path: str) -> str:
+		return os.path.join(self.root, os.path.normpath('/' + path).lstrip('/'))
+
+	def canonicalize(self, path: str) -> str:
+		return os.path.normpath('/' + path)
+
+	def stat(self, path: str):
+		try:
+			return SFTPAttributes.from_stat(os.stat(self.real(path)))
+		except OSError as e:
+			return SFTPServer.convert_errno(e.errno)
+
+	lstat = stat
+
+	def open(self, path: str, flags: int, attr):
+		real = self.real(path)
+		try:
+			os.makedirs(os.path.dirname(real), exist_ok=True)
+			fd = os.open(real, flags, 0o644)
+		except OSError as e:
+			return SFTPServer.convert_errno(e.errno)
+		f = os.fdopen(fd, 'r+b' if flags & os.O_RDWR else 'wb' if flags & os.O_WRONLY else 'rb')
+		handle = StandInHandle(flags)
+		handle.filename = real
+		handle.readfile = handle.writefile = f
+		return handle
+
+	def remove(self, path: str):
+		try:
+			os.remove(self.real(path))
+		except OSError as e:
+			return SFTPServer.convert_errno(e.errno)
+		return SFTP_OK
+
+	def rename(self, oldpath: str, newpath: str):
+		if os.path.exists(self.real(newpath)):
+			# Plain SFTP rename doesn't overwrite
+			return SFTPServer.convert_errno(errno.EEXIST)
+		os.rename(self.real(oldpath), self.real(newpath))
+		return SFTP_OK
+
+	def posix_rename(self, oldpath: str, newpath: str):
+		os.replace(self.real(oldpath), self.real(newpath))
+		return SFTP_OK
+
+	def mkdir(self, path: str, attr):
+		os.makedirs(self.real(path), exist_ok=True)
+		return SFTP_OK
+
+	def chattr(self, path: str, attr):
+		return SFTP_OK
+
+
+class NoCheckFileServer(SFTPServer):
+	'''Like OpenSSH, doesn't implement the `check-file` extension'''
+	def _check_file(self, request_number, msg):
+		self._send_status(request_number, SFTP_OP_UNSUPPORTED)
+
+
+class CheckFileServer(SFTPServer):
+	'''
+	paramiko's own `check-file` moves its read offset on by the total hashed so far rather than by the last read, so it hashes the wrong bytes of files over 64 KiB.
+	This hashes whole files (a `block_size` of 0), which is all `SFTPFile.check` asks for by default.
+	'''
+	def _check_file(self, request_number, msg):
+		handle = msg.get_binary()
+		algorithms = msg.get_list()
+		start = msg.get_int64()
+		length = msg.get_int64()
+		block_size = msg.get_int()
+		algorithm = next((a for a in algorithms if a in ('sha1', 'md5')), None)
+		if handle not in self.file_table or algorithm is None or block_size:
+			self._send_status(request_number, SFTP_FAILURE, 'Unsupported check-file request')
+			return
+		readfile = self.file_table[handle].readfile
+		h = hashlib.new(algorithm)
+		remaining = length or os.fstat(readfile.fileno()).st_size - start
+		offset = start
+		while remaining > 0 and (data := os.pread(readfile.fileno(), min(remaining, PUMP_SIZE), offset)):
+			h.update(data)
+			offset += len(data)
+			remaining -= len(data)
+		reply = Message()
+		reply.add_int(request_number)
+		reply.add_string('check-file')
+		reply.add_string(algorithm)
+		reply.add_bytes(h.digest())
+		self._send_packet(CMD_EXTENDED_REPLY, reply)
@@ -0,0 +1,93 @@
+'''Uploads a file to a local stand-in SFTP server with added latency with paramiko's `put` and with `upload`, and checks resuming and verifying'''
+import argparse
+import os
+import tempfile
+import time
+
+# First, so the app's modules can be imported
+from checks import Checks
+from checks.sftp_standin import StandInSftpServer
+
+from sftp_pool import SftpPool
+from sftp_upload import PART_SUFFIX, STRIPE_MIN, file_sha1, upload, verify
+
+
+class Interrupted(Exception):
+	pass
+
+
+def interrupt_halfway(sent: int, total: int) -> None:
+	if sent > total // 2:
+		raise Interrupted()
+
+
+def main() -> None:
+	parser = argparse.ArgumentParser(description=__doc__)
+	parser.add_argument('-s', '--size', dest='size', help='MiB to upload', type=int, default=32)
+	parser.add_argument('-l', '--latency', dest='latency', help='seconds added to each direction of the link', type=float, default=0.02)
+	args: argparse.Namespace = parser.parse_args()
+
+	checks = Checks()
+	with tempfile.TemporaryDirectory() as tmp:
+		root = os.path.join(tmp, 'remote')
+		server = StandInSftpServer(root, latency=args.latency, check_file=True)
+		destination = server.user_at_ip()
+		pool = SftpPool(None, None, None)
+		source = os.path.join(tmp, 'source.bin')
+		with open(source, 'wb') as f:
+			f.write(os.urandom(args.size << 20))
+		with open(source, 'rb') as f:
+			digest = file_sha1(f)
+
+		def intact(remote_path: str) -> bool:
+			with open(os.path.join(root, remote_path.lstrip('/')), 'rb') as f:
+				return file_sha1(f) == digest
+
+		times = {}
+		for name, send in (('sftp.put', lambda sftp, path: sftp.put(source, path)), ('upload', lambda sftp, path: upload(sftp, source, path))):
+			with pool.session(destination, server.password) as sftp:
+				started = time.perf_counter()
+				send(sftp, f'/{name}.bin')
+				times[name] = time.perf_counter() - started
+			print(f'{name}: {args.size} MiB in {times[name]:.2f} s, {args.size / times[name]:.1f} MiB/s')
+			checks.expect(intact(f'/{name}.bin'), f'the file uploaded with {name} doesn\'t match')
+		# A small file is sent on one channel, and the round trips to verify and rename it, which `put` doesn't make, outweigh what pipelining saves
+		if args.size << 20 >= STRIPE_MIN:
+			checks.expect(times['upload'] < times['sftp.put'], 'upload was no faster than sftp.put')
+
+		# Resume an interrupted upload on a new session
+		try:
+			with pool.session(destination, server.password) as sftp:
+				upload(sftp, source, '/resumed.bin', callback=interrupt_halfway)
+		except Interrupted:
+			pass
+		acknowledged = []
+		with pool.session(destination, server.password) as sftp:
+			upload(sftp, source, '/resumed.bin', callback=lambda sent, total: acknowledged.append(sent))
+		print(f'resumed after an interruption at {acknowledged[0] if acknowledged else 0} of {args.size << 20} bytes')
+		checks.expect(bool(acknowledged) and acknowledged[0] >= (args.size << 20) // 4, 'the interrupted upload started over instead of resuming')
+		checks.expect(intact('/resumed.bin') and not os.path.exists(os.path.join(root, 'resumed.bin' + PART_SUFFIX)), 'the resumed upload doesn\'t match or left its partial file behind')
+
+		# A partial file that doesn't match the local one starts over, and replacing an existing file works
+		with open(os.path.join(root, 'restarted.bin' + PART_SUFFIX), 'wb') as f:
+			f.write(os.urandom(1 << 20))
+		for _ in range(2):
+			with pool.session(destination, server.password) as sftp:
+				upload(sftp, source, '/restarted.bin')
+		checks.expect(intact('/restarted.bin'), 'the upload over a mismatched partial file or an existing file doesn\'t match')
+
+		# The uploads above were checked by SHA-1. Make sure a mismatch would have been caught rather than falling back to the size check.
+		with pool.session(destination, server.password) as sftp:
+			try:
+				verify(sftp, '/restarted.bin', args.size << 20, lambda: bytes(20), 'a different file')
+				checks.expect(False, 'a file with a different SHA-1 passed verification')
+			except IOError:
+				pass
+
+		pool.close()
+		server.close()
+	checks.finish()
+
+
+if __name__ == '__main__':
+	main()
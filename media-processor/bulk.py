@@ -0,0 +1,178 @@
+import csv
+import json
+from typing import Any, Iterator, Optional
+
+from db import LockableSqliteConn
+
+# Tables that can be imported and exported, with their columns as (name, type, required). The first column is the table's key.
+# Tables are imported in this order so settings can refer to properties and servers from the same file.
+TABLES: dict[str, list[tuple[str, type, bool]]] = {
+	'destination_servers': [('user_at_ip', str, True), ('password', str, False), ('max_transfers', int, False), ('max_rate', int, False)],
+	'properties': [('property', str, True), ('pattern', str, True), ('partial', int, False)],
+	'property_settings': [('property', str, True), ('ffmpeg_input_args', str, False), ('ffmpeg_output_args', str, True), ('output_container', str, True), ('user_at_ip', str, False), ('folder', str, True), ('is_show', int, False), ('season_override', int, False), ('copy_codecs', str, False), ('segments', int, False)],
+}
+# `upsert` replaces rows with the same key and keeps the rest. `replace` empties the tables being imported first.
+MODES = ['upsert', 'replace']
+# Rows fetched at a time while exporting
+EXPORT_BATCH = 1000
+# Invalid rows listed when an import is rejected
+MAX_ERRORS = 10
+
+
+def file_format(path: str) -> str:
+	format = path.rsplit('.', 1)[-1].lower()
+	if format not in ('json', 'csv'):
+		raise ValueError(f'{path} is not a .json or .csv file')
+	return format
+
+
+def export_tables(lconn: LockableSqliteConn, path: str, tables: Optional[list[str]] = None) -> dict[str, int]:
+	'''
+	Write tables to a JSON file (`{"table": [{"column": value, ...}, ...], ...}`, all tables unless `tables` is given) or a CSV file (one table, with a header row).
+	Rows are streamed from the DB, so memory use doesn't grow with the catalog. Returns how many rows of each table were written.
+	'''
+	format = file_format(path)
+	tables = tables or list(TABLES)
+	for table in tables:
+		if table not in TABLES:
+			raise ValueError(f'{table} can\'t be exported. Choose from {", ".join(TABLES)}.')
+	if format == 'csv' and len(tables) != 1:
+		raise ValueError('A CSV file holds one table. Name the table to export.')
+	counts: dict[str, int] = {}
+	with lconn, open(path, 'w', newline='') as f:
+		if format == 'csv':
+			columns = [c[0] for c in TABLES[tables[0]]]
+			writer = csv.writer(f)
+			writer.writerow(columns)
+			counts[tables[0]] = 0
+			for rows in fetch_batches(lconn, tables[0]):
+				writer.writerows(rows)
+				counts[tables[0]] += len(rows)
+			return counts
+		f.write('{')
+		for i, table in enumerate(tables):
+			columns = [c[0] for c in TABLES[table]]
+			f.write(f'{"," if i else ""}\n\t{json.dumps(table)}: [')
+			counts[table] = 0
+			for rows in fetch_batches(lconn, table):
+				for row in rows:
+					f.write(f'{"," if counts[table] else ""}\n\t\t{json.dumps(dict(zip(columns, row)))}')
+					counts[table] += 1
+			f.write('\n\t]' if counts[table] else ']')
+		f.write('\n}\n')
+	return counts
+
+
+def fetch_batches(lconn: LockableSqliteConn, table: str) -> Iterator[list[tuple]]:
+	'''Call inside `with lconn`'''
+	lconn.cur.execute(f'''SELECT {", ".join(c[0] for c in TABLES[table])} FROM {table} ORDER BY {TABLES[table][0][0]};''')
+	while rows := lconn.cur.fetchmany(EXPORT_BATCH):
+		yield rows
+
+
+def import_tables(lconn: LockableSqliteConn, path: str, mode: str = 'upsert', table: Optional[str] = None) -> dict[str, int]:
+	'''
+	Load tables from a file written by `export_tables`. A CSV file holds the one `table` given. Columns left out of a row are set to `NULL`.
+	Every row is checked before anything is written, then each table is written with one `executemany`. Raises `ValueError` listing the invalid rows, if any.
+	The import either happens completely or not at all, as part of the caller's transaction. The shell commits it at the end of `exec`.
+	Returns how many rows of each table were imported.
+	'''
+	format = file_format(path)
+	# CSV can't tell an empty value from a missing one
+	blank_is_null = format == 'csv'
+	if mode not in MODES:
+		raise ValueError(f'{mode} is not an import mode. Choose from {", ".join(MODES)}.')
+	if format == 'csv':
+		if table not in TABLES:
+			raise ValueError(f'Name the table a CSV file is for. Choose from {", ".join(TABLES)}.')
+		tables = [table]
+		source = lambda t: read_csv(path)
+	else:
+		with open(path) as f:
+			data = json.load(f)
+		if not isinstance(data, dict) or any(t not in TABLES or not isinstance(rows, list) for t, rows in data.items()):
+			raise ValueError(f'{path} should be an object of lists of rows, keyed by table ({", ".join(TABLES)}).')
+		tables = [t for t in TABLES if t in data]
+		source = lambda t: enumerate(data[t], 1)
+	with lconn:
+		keys = {t: set() if mode == 'replace' and t in tables else existing_keys(lconn, t) for t in ('properties', 'destination_servers')}
+		# Check everything first. Servers and properties come first, so the keys collected from them are complete when settings refer to them.
+		errors: list[str] = []
+		counts: dict[str, int] = {}
+		for t in tables:
+			counts[t] = 0
+			for n, row in source(t):
+				try:
+					values = to_values(t, row, blank_is_null)
+					if t == 'property_settings':
+						if values[0] not in keys['properties']:
+							raise ValueError(f'property {values[0]} doesn\'t exist')
+						if values[4] and values[4] not in keys['destination_servers']:
+							raise ValueError(f'destination server {values[4]} doesn\'t exist')
+				except ValueError as e:
+					errors.append(f'{t} row {n}: {e}')
+					continue
+				if t in keys:
+					keys[t].add(values[0])
+				counts[t] += 1
+		if errors:
+			raise ValueError(f'{len(errors)} invalid rows in {path}. Nothing was imported.\n' + '\n'.join(errors[:MAX_ERRORS]) + ('\n...' if len(errors) > MAX_ERRORS else ''))
+		if not lconn.conn.in_transaction:
+			lconn.cur.execute('''BEGIN;''')
+		lconn.cur.execute('''SAVEPOINT import_tables;''')
+		try:
+			for t in tables:
+				columns = [c[0] for c in TABLES[t]]
+				if mode == 'replace':
+					lconn.cur.execute(f'''DELETE FROM {t};''')
+				updates = ', '.join(f'{c} = excluded.{c}' for c in columns[1:])
+				lconn.cur.executemany(f'''INSERT INTO {t} ({", ".join(columns)}) VALUES ({", ".join("?" * len(columns))}) ON CONFLICT({columns[0]}) DO UPDATE SET {updates};''', (to_values(t, row, blank_is_null) for _, row in source(t)))
+		except BaseException:
+			lconn.cur.execute('''ROLLBACK TO import_tables;''')
+			raise
+		finally:
+			lconn.cur.execute('''RELEASE import_tables;''')
+	return counts
+
+
+def read_csv(path: str) -> Iterator[tuple[int, dict[str, str]]]:
+	'''Rows of a CSV file with a header row, numbered from 1. Read lazily so large files aren't held in memory.'''
+	with open(path, newline='') as f:
+		yield from enumerate(csv.DictReader(f), 1)
+
+
+def existing_keys(lconn: LockableSqliteConn, table: str) -> set:
+	lconn.cur.execute(f'''SELECT {TABLES[table][0][0]} FROM {table};''')
+	return {row[0] for row in lconn.cur.fetchall()}
+
+
+def to_values(table: str, row: Any, blank_is_null: bool = False) -> tuple:
+	'''
+	Check an imported row against its table's columns and convert it to a tuple of values in column order. Raises `ValueError` if it is invalid.
+	With `blank_is_null`, empty values are `NULL` unless the column is required text (e.g. no ffmpeg output args).
+	'''
+	if not isinstance(row, dict):
+		raise ValueError('not an object of column values')
+	columns = TABLES[table]
+	unknown = set(row) - {c[0] for c in columns}
+	if unknown:
+		raise ValueError(f'unknown columns {", ".join(sorted(map(str, unknown)))}')
+	values = []
+	for i, (name, kind, required) in enumerate(columns):
+		value = row.get(name)
+		if value == '' and (blank_is_null and not (required and kind is str) or kind is int):
+			value = None
+		if value is None or (i == 0 and value == ''):
+			if required:
+				raise ValueError(f'{name} is required')
+			values.append(None)
+			continue
+		if kind is int:
+			try:
+				value = int(value)
+			except (TypeError, ValueError):
+				raise ValueError(f'{name} should be a whole number, not {value!r}')
+		elif not isinstance(value, str):
+			raise ValueError(f'{name} should be text, not {value!r}')
+		values.append(value)
+	return tuple(values)
@@ -0,0 +1,69 @@
+import hashlib
+import os
+import time
+from typing import Optional
+
+from db import LockableSqliteConn
+
+# Blocks sampled from each file for its fingerprint
+SAMPLES = 16
+SAMPLE_SIZE = 64 * 1024
+
+
+def fingerprint(path: str) -> str:
+	'''
+	Fast content fingerprint of a file: its size and a hash of `SAMPLES` blocks spread evenly through it (always including the first and last).
+	Reads at most `SAMPLES * SAMPLE_SIZE` bytes however large the file is.
+	'''
+	h = hashlib.blake2b(digest_size=20)
+	fd = os.open(path, os.O_RDONLY)
+	try:
+		size = os.fstat(fd).st_size
+		h.update(str(size).encode())
+		if size <= SAMPLES * SAMPLE_SIZE:
+			offsets = range(0, size, SAMPLE_SIZE)
+		else:
+			step = (size - SAMPLE_SIZE) / (SAMPLES - 1)
+			offsets = (int(i * step) for i in range(SAMPLES))
+		for offset in offsets:
+			h.update(os.pread(fd, SAMPLE_SIZE, offset))
+	finally:
+		os.close(fd)
+	return h.hexdigest()
+
+
+def cache_key(source_fingerprint: str, row: tuple) -> str:
+	'''Key for a source transcoded with a `PropertyCatalog` settings row. Only settings that change the transcoded file count, not where it is delivered.'''
+	# (ffmpeg_input_args, ffmpeg_output_args, output_container, copy_codecs)
+	settings = (row[0], row[1], row[2], row[8])
+	return hashlib.sha1(repr((source_fingerprint, settings)).encode()).hexdigest()
+
+
+def destination_of(row: tuple, name: str) -> str:
+	'''Where a settings row delivers a file called `name`, as `user@ip:port:folder/name` or just the path when local'''
+	path = os.path.join(row[3], name)
+	return f'{row[4]}:{path}' if row[4] else path
+
+
+def lookup_result(lconn: LockableSqliteConn, key: str) -> Optional[tuple]:
+	'''The `(job_id, destination, local_path, size, mtime)` of a previous result with the same key, if any'''
+	with lconn:
+		lconn.cur.execute('''SELECT job_id, destination, local_path, size, mtime FROM result_cache WHERE cache_key = ?;''', (key,))
+		return lconn.cur.fetchone()
+
+
+def record_result(lconn: LockableSqliteConn, key: str, job_id: int, destination: str, local_path: Optional[str], size: int) -> None:
+	'''Remember a delivered result. `local_path` is where a copy can be reused from, if it was delivered locally.'''
+	mtime = os.path.getmtime(local_path) if local_path else None
+	with lconn:
+		lconn.cur.execute('''INSERT INTO result_cache (cache_key, job_id, destination, local_path, size, mtime, created) VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT(cache_key) DO UPDATE SET job_id = excluded.job_id, destination = excluded.destination, local_path = excluded.local_path, size = excluded.size, mtime = excluded.mtime, created = excluded.created;''', (key, job_id, destination, local_path, size, mtime, time.time()))
+		lconn.conn.commit()
+
+
+def unchanged(local_path: str, size: int, mtime: Optional[float]) -> bool:
+	'''Whether a result's local copy is still there with the size and mtime it was delivered with. Results recorded before mtimes were kept only have their size checked.'''
+	try:
+		stat = os.stat(local_path)
+	except OSError:
+		return False
+	return stat.st_size == size and (mtime is None or stat.st_mtime == mtime)
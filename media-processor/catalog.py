@@ -0,0 +1,83 @@
+import hashlib
+import threading
+import time
+from typing import Optional
+
+from db import LockableSqliteConn
+from matcher import Matcher, MatchMemo
+
+
+class PropertyCatalog(object):
+	'''
+	In-memory copy of `properties`, `property_settings` (joined with `destination_servers`) and the destination servers' limits, shared by all processor threads.
+	The catalog keeps its own connection and only reloads when `PRAGMA data_version` says another connection committed a change.
+	'''
+	def __init__(self, db: str, match_threshold: int = 40, tie_break: str = 'longest', memo_size: int = 10000, persist_memo: bool = False, check_interval: float = 0.5):
+		self.lconn = LockableSqliteConn(db, shared=True)
+		self.match_threshold: int = match_threshold
+		self.tie_break: str = tie_break
+		self.lock = threading.Lock()
+		self.check_interval: float = check_interval
+		self.last_check: float = 0.0
+		self.data_version: Optional[int] = None
+		# Hash of everything that affects matching. Only changes when the properties (or match options) do.
+		self.version: str = ''
+		# (property, pattern, partial)
+		self.properties: list[tuple] = []
+		# property -> (ffmpeg_input_args, ffmpeg_output_args, output_container, folder, user_at_ip, password, is_show, season_override, copy_codecs, segments)
+		self.settings: dict[str, tuple] = {}
+		# user_at_ip -> (max_transfers, max_rate)
+		self.destinations: dict[str, tuple] = {}
+		self.matcher = Matcher(self.properties, match_threshold, tie_break)
+		self.memo = MatchMemo(memo_size, db if persist_memo else None)
+
+	def refresh(self) -> None:
+		'''Reload the catalog if the DB changed. The DB is checked at most once per `check_interval` seconds.'''
+		with self.lock:
+			now = time.monotonic()
+			if now - self.last_check < self.check_interval:
+				return
+			self.last_check = now
+			with self.lconn:
+				self.lconn.cur.execute('''PRAGMA data_version;''')
+				data_version = self.lconn.cur.fetchone()[0]
+				if data_version == self.data_version:
+					return
+				self.lconn.cur.execute('''SELECT property, pattern, partial FROM properties;''')
+				properties = self.lconn.cur.fetchall()
+				self.lconn.cur.execute('''SELECT ps.property, ps.ffmpeg_input_args, ps.ffmpeg_output_args, ps.output_container, ps.folder, ds.user_at_ip, ds.password, ps.is_show, ps.season_override, ps.copy_codecs, ps.segments FROM property_settings ps LEFT JOIN destination_servers ds ON ps.user_at_ip = ds.user_at_ip;''')
+				settings = {row[0]: row[1:] for row in self.lconn.cur.fetchall()}
+				self.lconn.cur.execute('''SELECT user_at_ip, max_transfers, max_rate FROM destination_servers;''')
+				destinations = {row[0]: row[1:] for row in self.lconn.cur.fetchall()}
+			self.data_version = data_version
+			# Every commit bumps data_version (e.g. the watcher's scan index) so only rebuild the matcher if the properties really changed
+			version = hashlib.sha1(repr((properties, self.match_threshold, self.tie_break)).encode()).hexdigest()
+			if version != self.version:
+				matcher = Matcher(properties, self.match_threshold, self.tie_break)
+				# Swap in whole objects so readers never see a half-loaded catalog
+				self.properties = properties
+				self.matcher = matcher
+				self.version = version
+			self.settings = settings
+			self.destinations = destinations
+
+	def match_batch(self, filenames: list[str]) -> list[Optional[tuple[str, int]]]:
+		'''Match cleaned filenames, reusing memoized results for the current catalog version'''
+		self.refresh()
+		version, matcher = self.version, self.matcher
+		found = self.memo.get_many(version, filenames)
+		missing = [f for f in dict.fromkeys(filenames) if f not in found]
+		if missing:
+			results = dict(zip(missing, matcher.match_batch(missing)))
+			self.memo.put_many(version, results)
+			found.update(results)
+		return [found[f] for f in filenames]
+
+	def get_settings(self, property: str) -> Optional[tuple]:
+		self.refresh()
+		return self.settings.get(property)
+
+	def get_destination(self, user_at_ip: str) -> Optional[tuple]:
+		'''The `(max_transfers, max_rate)` limits of a destination server'''
+		self.refresh()
+		return self.destinations.get(user_at_ip)
@@ -1,25 +1,49 @@
+import json
 import shlex
+import time
 try:
 	import readline # Naked import. Used to extend `input()` to allow for better UX (arrow key navigation, history, etc.)
 except ImportError:
 	pass # Just ignore it. Not critical. I read that some python environments don't support readline
 
-from db import LockableSqliteConn
+from bulk import export_tables, import_tables
+from db import JOB_STATES, LockableSqliteConn
+from history import stats
 
 def yn(say: str) -> bool:
 	yn = input(say + 'Continue? (y/n)').lower()
 	return yn == 'y' or yn == 'e' or yn == 's'
 
+class Declined(Exception):
+	'''A confirmation was answered no, so none of the commands are kept'''
+
 def command(lconn: LockableSqliteConn, commands: list[str]) -> None:
+	'''
+	Run commands in one transaction, committed once they have all run. If one fails or a confirmation is declined, none of them are kept.
+	An open transaction holds the DB's write lock, which the pipeline needs to claim, heartbeat and queue jobs, so nothing is left uncommitted.
+	'''
 	with lconn:
-		for c in commands:
-			split: list[str] = [a.strip() for a in shlex.split(c)]
-			if split[0] == 'commit':
+		try:
+			vacuum = run_commands(lconn, commands)
+			if lconn.conn.in_transaction:
 				print('Committing to DB.')
 				lconn.conn.commit()
-			elif split[0] == 'vacuum':
-				print('Clearing space in DB.')
-				lconn.conn.execute('''VACUUM;''')
+		except BaseException:
+			lconn.conn.rollback()
+			raise
+	if vacuum:
+		# Can't run inside a transaction
+		print('Clearing space in DB.')
+		lconn.conn.execute('''VACUUM;''')
+
+def run_commands(lconn: LockableSqliteConn, commands: list[str]) -> bool:
+	'''Run commands without committing. Returns `True` if a `vacuum` was asked for.'''
+	vacuum = False
+	with lconn:
+		for c in commands:
+			split: list[str] = [a.strip() for a in shlex.split(c)]
+			if split[0] == 'vacuum':
+				vacuum = True
 			elif split[0] == 'add' or split[0] == '':
 				if split[1] == 'property':
 					property = split[2]
@@ -39,6 +63,8 @@ def command(lconn: LockableSqliteConn, commands: list[str]) -> None:
 					destination_server = None
 					is_show = 0
 					season_override = None
+					copy_codecs = None
+					segments = None
 					if len(split) > 7:
 						for i in range(7, len(split)):
 							if i == 7:
@@ -50,19 +76,34 @@ def command(lconn: LockableSqliteConn, commands: list[str]) -> None:
 							elif i == 9:
 								if len(split[i]) > 0:
 									season_override = split[i]
-					print(f'Adding settings (ffmpeg_input_args: "{ffmpeg_input_args}") (ffmpeg_output_args: "{ffmpeg_output_args}") (output_container: "{output_container}") (destination folder: "{folder}") (destination server "{destination_server}") to property "{property}."')
-					lconn.cur.execute('''INSERT INTO property_settings (property, ffmpeg_input_args, ffmpeg_output_args, output_container, user_at_ip, folder, is_show, season_override) VALUES (?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT(property) DO UPDATE SET ffmpeg_input_args = ?, ffmpeg_output_args = ?, output_container = ?, user_at_ip = ?, folder = ?, is_show = ?, season_override = ?;''', (property, ffmpeg_input_args, ffmpeg_output_args, output_container, destination_server, folder, is_show, season_override, ffmpeg_input_args, ffmpeg_output_args, output_container, destination_server, folder, is_show, season_override))
+							elif i == 10:
+								if len(split[i]) > 0:
+									copy_codecs = split[i]
+							elif i == 11:
+								if len(split[i]) > 0:
+									segments = int(split[i])
+					print(f'Adding settings (ffmpeg_input_args: "{ffmpeg_input_args}") (ffmpeg_output_args: "{ffmpeg_output_args}") (output_container: "{output_container}") (destination folder: "{folder}") (destination server "{destination_server}") (copy codecs "{copy_codecs}") (segments "{segments}") to property "{property}."')
+					lconn.cur.execute('''INSERT INTO property_settings (property, ffmpeg_input_args, ffmpeg_output_args, output_container, user_at_ip, folder, is_show, season_override, copy_codecs, segments) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT(property) DO UPDATE SET ffmpeg_input_args = ?, ffmpeg_output_args = ?, output_container = ?, user_at_ip = ?, folder = ?, is_show = ?, season_override = ?, copy_codecs = ?, segments = ?;''', (property, ffmpeg_input_args, ffmpeg_output_args, output_container, destination_server, folder, is_show, season_override, copy_codecs, segments, ffmpeg_input_args, ffmpeg_output_args, output_container, destination_server, folder, is_show, season_override, copy_codecs, segments))
 				elif split[1] == 'destination':
 					user_at_ip = split[2]
-					if len(split) > 3:
-						password = split[3]
-					else:
-						password = None
-					print(f'Adding destination server at {user_at_ip} with password {password}.')
-					lconn.cur.execute('''INSERT INTO destination_servers (user_at_ip, password) VALUES (?, ?) ON CONFLICT(user_at_ip) DO UPDATE SET password = ?;''', (user_at_ip, password, password))
+					password = None
+					max_transfers = None
+					max_rate = None
+					for i in range(3, len(split)):
+						if i == 3:
+							if len(split[i]) > 0:
+								password = split[i]
+						elif i == 4:
+							if len(split[i]) > 0:
+								max_transfers = int(split[i])
+						elif i == 5:
+							if len(split[i]) > 0:
+								max_rate = int(split[i])
+					print(f'Adding destination server at {user_at_ip} with password {password} (max transfers "{max_transfers}") (max rate "{max_rate}" KiB/s).')
+					lconn.cur.execute('''INSERT INTO destination_servers (user_at_ip, password, max_transfers, max_rate) VALUES (?, ?, ?, ?) ON CONFLICT(user_at_ip) DO UPDATE SET password = ?, max_transfers = ?, max_rate = ?;''', (user_at_ip, password, max_transfers, max_rate, password, max_transfers, max_rate))
 				else:
 					if not yn(f'[{split[1]}] is not a valid `add` command and it will be ignored. '):
-						break
+						raise Declined()
 			elif split[0] == 'remove':
 				if split[1] == 'property':
 					property = split[2]
@@ -80,7 +121,7 @@ def command(lconn: LockableSqliteConn, commands: list[str]) -> None:
 					lconn.cur.execute('''UPDATE property_settings SET user_at_ip = NULL WHERE user_at_ip = ?;''', (user_at_ip,))
 				else:
 					if not yn(f'[{split[1]}] is not a valid `remove` command and it will be ignored. '):
-						break
+						raise Declined()
 			elif split[0] == 'reset':
 				if split[1] == 'db':
 					print('Removing all data.')
@@ -95,9 +136,69 @@ def command(lconn: LockableSqliteConn, commands: list[str]) -> None:
 				elif split[1] == 'destination':
 					print('Removing all data in `destination_servers`.')
 					lconn.cur.execute('''DELETE FROM destination_servers;''')
+				elif split[1] == 'cache':
+					print('Removing all data in `result_cache`.')
+					lconn.cur.execute('''DELETE FROM result_cache;''')
+				elif split[1] == 'history':
+					print('Removing all data in `job_history`.')
+					lconn.cur.execute('''DELETE FROM job_history;''')
+			elif split[0] == 'import':
+				path = split[1]
+				mode = split[2] if len(split) > 2 and len(split[2]) > 0 else 'upsert'
+				table = split[3] if len(split) > 3 else None
+				counts = import_tables(lconn, path, mode, table)
+				print(f'Imported {", ".join(f"{n} {t}" for t, n in counts.items())} from {path} ({mode}).')
+			elif split[0] == 'export':
+				path = split[1]
+				counts = export_tables(lconn, path, split[2:] or None)
+				print(f'Exported {", ".join(f"{n} {t}" for t, n in counts.items())} to {path}.')
+			elif split[0] == 'job':
+				if split[1] == 'list':
+					if len(split) > 2:
+						lconn.cur.execute('''SELECT id, state, priority, attempts, path, property, error FROM jobs WHERE state = ? ORDER BY priority DESC, id;''', (split[2],))
+					else:
+						lconn.cur.execute('''SELECT id, state, priority, attempts, path, property, error FROM jobs WHERE state NOT IN ('done', 'failed') ORDER BY priority DESC, id;''')
+					for row in lconn.cur.fetchall():
+						print(f'{row[0]} | {row[1]} | priority {row[2]} | attempts {row[3]} | {row[4]} | {row[5] or ""} | {row[6] or ""}')
+				elif split[1] == 'progress':
+					lconn.cur.execute('''SELECT id, path, progress FROM jobs WHERE state = 'transcoding' AND lease_owner IS NOT NULL ORDER BY id;''')
+					for row in lconn.cur.fetchall():
+						progress = json.loads(row[2]) if row[2] else {}
+						eta = f'{progress["eta"]:.0f}s' if progress.get('eta') is not None else '?'
+						print(f'{row[0]} | {row[1]} | {progress.get("frames", 0)} frames | {progress.get("fps", 0)} fps | {progress.get("speed", 0)}x | {progress.get("size", 0)} bytes | eta {eta}')
+				elif split[1] == 'queues':
+					lconn.cur.execute('''SELECT state, COUNT(*) FROM jobs GROUP BY state;''')
+					counts = dict(lconn.cur.fetchall())
+					print(' | '.join(f'{state} {counts.get(state, 0)}' for state in JOB_STATES))
+				elif split[1] == 'stats':
+					by = split[2] if len(split) > 2 else 'property'
+					if by not in ('property', 'destination'):
+						if not yn(f'[{by}] is not `property` or `destination` and it will be ignored. '):
+							raise Declined()
+						continue
+					since = time.time() - float(split[3]) * 86400 if len(split) > 3 else 0.0
+					seconds = lambda ps: ' '.join(f'p{p} {v:.1f}s' for p, v in ps.items()) if ps else '-'
+					for entry in stats(lconn, by, since):
+						throughput = f'{entry["throughput"] / 1024 / 1024:.1f} MiB/s' if entry['throughput'] else '-'
+						speed = f' | {entry["speed"]:.2f}x' if entry['speed'] else ''
+						print(f'{entry["group"] or "(unmatched)"} | {entry["stage"]} | {entry["count"]} runs, {entry["failed"]} failed | took {seconds(entry["duration"])} | waited {seconds(entry["wait"])} | {throughput}{speed}')
+				elif split[1] == 'priority':
+					job_id = int(split[2])
+					priority = int(split[3])
+					print(f'Setting priority of job {job_id} to {priority}.')
+					lconn.cur.execute('''UPDATE jobs SET priority = ? WHERE id = ?;''', (priority, job_id))
+				elif split[1] == 'retry':
+					job_id = int(split[2])
+					print(f'Retrying job {job_id}.')
+					# Failed jobs start over. Others just skip their backoff.
+					lconn.cur.execute('''UPDATE jobs SET state = CASE state WHEN 'failed' THEN 'queued' ELSE state END, attempts = 0, not_before = 0, error = NULL WHERE id = ? AND state != 'done';''', (job_id,))
+				else:
+					if not yn(f'[{split[1]}] is not a valid `job` command and it will be ignored. '):
+						raise Declined()
 			else:
 				if not yn(f'[{c}] is not a valid command and it will be ignored. '):
-					break
+					raise Declined()
+	return vacuum
 
 def shell(lconn: LockableSqliteConn, symbol: str):
 	print('Starting shell.')
@@ -116,8 +217,10 @@ def shell(lconn: LockableSqliteConn, symbol: str):
 				print('Executing commands.')
 				try:
 					command(lconn, commands[:-1])
+				except Declined:
+					print('Cancelled. None of the commands were kept.')
 				except Exception as e:
-					print(f'Some commands did not execute successfully. [{e}] error occured')
+					print(f'Some commands did not execute successfully. [{e}] error occured. None of the commands were kept.')
 				commands: list[str] = []
 
 if __name__ == '__main__':
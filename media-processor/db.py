@@ -1,36 +1,98 @@
-from sqlite3 import connect
-from threading import Lock
+from sqlite3 import Connection, Cursor, connect
+from threading import RLock, local
+import time
+from typing import Optional
+
+JOB_STATES = ['queued', 'probing', 'transcoding', 'transferring', 'done', 'failed']
+# States of jobs that are waiting for or in a pipeline stage
+STAGE_STATES = JOB_STATES[:4]
+# Columns returned for claimed jobs
+JOB_COLUMNS = 'id, path, state, priority, attempts, property, filename, output_path, cache_key'
+# Seconds a connection waits for another one to finish writing before giving up with `database is locked`
+BUSY_TIMEOUT = 30.0
+# Prepared statements kept per connection, keyed by their SQL. Enough for every statement the app runs.
+CACHED_STATEMENTS = 256
 
 
 class LockableSqliteConn(object):
-	def __init__(self, db: str):
-		self.lock = Lock()
-		self.conn = connect(db, check_same_thread=False)
-		self.cur = None
+	'''
+	A SQLite DB used as `with lconn: lconn.cur.execute(...)`.
+	Each thread gets its own connection, so threads sharing one of these don't wait for each other to read. The DB is in WAL mode, so reads don't wait for writes either.
+	SQLite lets one connection write at a time. The others wait up to `BUSY_TIMEOUT` for their turn.
+	With `shared`, every thread uses the same connection, one at a time. For callers that need the same connection every time, e.g. to compare `PRAGMA data_version`.
+	`with` blocks can be nested in a thread, e.g. a helper called while the shell's transaction is open. They share the outermost block's cursor.
+	'''
+	def __init__(self, db: str, shared: bool = False):
+		self.db: str = db
+		self.shared: bool = shared
+		self.lock = RLock()
+		self.local = local()
+		# Every connection opened, so they can be closed together
+		self.conns: list[Connection] = []
+		self.shared_conn: Optional[Connection] = self.open() if shared else None
 
 	def __del__(self):
-		self.conn.close()
-	
+		self.close()
+
 	def __enter__(self):
-		self.lock.acquire()
-		self.cur = self.conn.cursor()
+		if self.shared:
+			self.lock.acquire()
+		depth = getattr(self.local, 'depth', 0)
+		if not depth:
+			self.local.cur = self.conn.cursor()
+		self.local.depth = depth + 1
 		return self
-	
+
 	def __exit__(self, type, value, traceback):
-		if self.cur is not None:
+		self.local.depth -= 1
+		if not self.local.depth and self.cur is not None:
 			self.cur.close()
-			self.cur = None
-		self.lock.release()
+			self.local.cur = None
+		if self.shared:
+			self.lock.release()
 
-def create_tables(lconn: LockableSqliteConn) -> None:
-	with lconn:
-		lconn.cur.execute('''CREATE TABLE IF NOT EXISTS properties (
+	@property
+	def conn(self) -> Connection:
+		'''The calling thread's connection'''
+		if self.shared_conn is not None:
+			return self.shared_conn
+		conn = getattr(self.local, 'conn', None)
+		if conn is None:
+			conn = self.local.conn = self.open()
+		return conn
+
+	@property
+	def cur(self) -> Optional[Cursor]:
+		'''The calling thread's cursor while it is inside `with`'''
+		return getattr(self.local, 'cur', None)
+
+	def open(self) -> Connection:
+		conn = connect(self.db, timeout=BUSY_TIMEOUT, check_same_thread=False, cached_statements=CACHED_STATEMENTS)
+		# Stored in the DB file, so this only does anything the first time
+		conn.execute('''PRAGMA journal_mode = WAL;''')
+		# In WAL mode this only risks the last commits on power loss, never corruption
+		conn.execute('''PRAGMA synchronous = NORMAL;''')
+		with self.lock:
+			self.conns.append(conn)
+		return conn
+
+	def close(self) -> None:
+		for conn in getattr(self, 'conns', []):
+			conn.close()
+		self.conns = []
+
+# Schema changes in the order they were made, each a list of statements. A DB's `PRAGMA user_version` is how many it has had.
+# Add a new entry for a change rather than editing an old one, so existing DBs get it too.
+MIGRATIONS: list[list[str]] = [
+	# 1: The schema when versioning was added
+	[
+		'''CREATE TABLE IF NOT EXISTS properties (
 			property TEXT,
 			pattern TEXT NOT NULL,
 			partial INT(1),
 			PRIMARY KEY (property)
-		);''')
-		lconn.cur.execute('''CREATE TABLE IF NOT EXISTS property_settings (
+		);''',
+		'''CREATE TABLE IF NOT EXISTS property_settings (
 			property TEXT,
 			ffmpeg_input_args TEXT,
 			ffmpeg_output_args TEXT NOT NULL,
@@ -39,13 +101,239 @@ def create_tables(lconn: LockableSqliteConn) -> None:
 			folder TEXT NOT NULL,
 			is_show INT(1),
 			season_override INT(2),
+			copy_codecs TEXT,
+			segments INT,
 			PRIMARY KEY (property),
 			FOREIGN KEY (property) REFERENCES properties(property),
 			FOREIGN KEY (user_at_ip) REFERENCES destination_servers(user_at_ip)
-		);''')
-		lconn.cur.execute('''CREATE TABLE IF NOT EXISTS destination_servers (
+		);''',
+		'''CREATE TABLE IF NOT EXISTS destination_servers (
 			user_at_ip TEXT,
 			password TEXT,
+			max_transfers INT,
+			max_rate INT,
 			PRIMARY KEY (user_at_ip)	
-		);''')
-		lconn.conn.commit()
\ No newline at end of file
+		);''',
+		'''CREATE TABLE IF NOT EXISTS scan_index (
+			path TEXT,
+			inode INT,
+			size INT,
+			mtime REAL,
+			ctime REAL,
+			PRIMARY KEY (path)
+		);''',
+		'''CREATE TABLE IF NOT EXISTS match_memo (
+			filename TEXT,
+			catalog_version TEXT,
+			property TEXT,
+			score INT,
+			PRIMARY KEY (filename, catalog_version)
+		);''',
+		'''CREATE TABLE IF NOT EXISTS jobs (
+			id INTEGER PRIMARY KEY AUTOINCREMENT,
+			path TEXT NOT NULL,
+			state TEXT NOT NULL,
+			priority INT DEFAULT 0,
+			attempts INT DEFAULT 0,
+			not_before REAL DEFAULT 0,
+			lease_owner TEXT,
+			lease_expires REAL,
+			property TEXT,
+			filename TEXT,
+			output_path TEXT,
+			error TEXT,
+			progress TEXT,
+			cache_key TEXT,
+			created REAL,
+			updated REAL
+		);''',
+		'''CREATE INDEX IF NOT EXISTS jobs_ready ON jobs (state, priority DESC, id);''',
+		'''CREATE INDEX IF NOT EXISTS jobs_path ON jobs (path);''',
+		'''CREATE TABLE IF NOT EXISTS result_cache (
+			cache_key TEXT,
+			job_id INT,
+			destination TEXT,
+			local_path TEXT,
+			size INT,
+			created REAL,
+			PRIMARY KEY (cache_key)
+		);''',
+	],
+	# 2: Claims read back their jobs by lease owner
+	[
+		'''CREATE INDEX IF NOT EXISTS jobs_lease ON jobs (lease_owner);''',
+	],
+	# 3: What happened to each job in each stage, for `job stats`
+	[
+		'''CREATE TABLE IF NOT EXISTS job_history (
+			id INTEGER PRIMARY KEY AUTOINCREMENT,
+			job_id INT NOT NULL,
+			stage TEXT NOT NULL,
+			outcome TEXT NOT NULL,
+			property TEXT,
+			server TEXT,
+			started REAL,
+			finished REAL,
+			input_size INT,
+			output_size INT,
+			speed REAL,
+			ffmpeg_args TEXT,
+			error TEXT
+		);''',
+		'''CREATE INDEX IF NOT EXISTS job_history_finished ON job_history (finished);''',
+	],
+	# 4: The configurator lists and searches properties in this order, a page at a time
+	[
+		'''CREATE INDEX IF NOT EXISTS properties_search ON properties (property COLLATE NOCASE, property);''',
+	],
+	# 5: A result's local copy is only reused if it still has the mtime it was delivered with
+	[
+		'''ALTER TABLE result_cache ADD COLUMN mtime REAL;''',
+	],
+]
+
+def create_tables(lconn: LockableSqliteConn) -> None:
+	'''Create the tables, or bring an existing DB up to date by running the migrations it hasn't had, all in one transaction'''
+	with lconn:
+		lconn.cur.execute('''BEGIN IMMEDIATE;''')
+		try:
+			lconn.cur.execute('''PRAGMA user_version;''')
+			version = lconn.cur.fetchone()[0]
+			if version == 0:
+				upgrade_unversioned(lconn.cur)
+			for statements in MIGRATIONS[version:]:
+				for statement in statements:
+					lconn.cur.execute(statement)
+			if version < len(MIGRATIONS):
+				lconn.cur.execute(f'''PRAGMA user_version = {len(MIGRATIONS)};''')
+			lconn.conn.commit()
+		except BaseException:
+			lconn.conn.rollback()
+			raise
+
+def upgrade_unversioned(cur: Cursor) -> None:
+	'''Add the columns that were added to existing tables before the schema was versioned, so the first migration finds them all'''
+	added = {
+		'property_settings': [('copy_codecs', 'TEXT'), ('segments', 'INT')],
+		# Most transfers to the server at once, and its upload bandwidth limit in KiB/s
+		'destination_servers': [('max_transfers', 'INT'), ('max_rate', 'INT')],
+		'jobs': [('progress', 'TEXT'), ('cache_key', 'TEXT')],
+	}
+	for table, new_columns in added.items():
+		cur.execute(f'''PRAGMA table_info({table});''')
+		columns = [row[1] for row in cur.fetchall()]
+		if not columns:
+			# The first migration creates it
+			continue
+		for name, type in new_columns:
+			if name not in columns:
+				cur.execute(f'''ALTER TABLE {table} ADD COLUMN {name} {type};''')
+
+def enqueue_job(lconn: LockableSqliteConn, path: str, priority: int = 0) -> Optional[int]:
+	'''Queue a file for processing. Returns the job's id, or `None` if it already has an unfinished job.'''
+	now = time.time()
+	with lconn:
+		lconn.cur.execute('''SELECT 1 FROM jobs WHERE path = ? AND state NOT IN ('done', 'failed');''', (path,))
+		if lconn.cur.fetchone():
+			return None
+		lconn.cur.execute('''INSERT INTO jobs (path, state, priority, created, updated) VALUES (?, 'queued', ?, ?, ?);''', (path, priority, now, now))
+		lconn.conn.commit()
+		return lconn.cur.lastrowid
+
+def claim_jobs(lconn: LockableSqliteConn, state: str, owner: str, limit: int = 1, lease_time: float = 60.0, to_state: Optional[str] = None) -> list[tuple]:
+	'''
+	Lease up to `limit` jobs waiting in `state`, highest priority first, optionally moving them to `to_state`.
+	Jobs whose lease expired (the worker died or stopped heartbeating) can be claimed again.
+	'''
+	now = time.time()
+	where = '''state = ? AND (lease_owner IS NULL OR lease_expires < ?) AND not_before <= ?'''
+	with lconn:
+		# Cheap read first so idle workers don't keep taking the write lock
+		lconn.cur.execute(f'''SELECT 1 FROM jobs WHERE {where} LIMIT 1;''', (state, now, now))
+		if not lconn.cur.fetchone():
+			return []
+		token = f'{owner}:{now}'
+		lconn.cur.execute(f'''UPDATE jobs SET lease_owner = ?, lease_expires = ?, state = ?, updated = ? WHERE id IN (SELECT id FROM jobs WHERE {where} ORDER BY priority DESC, id LIMIT ?);''', (token, now + lease_time, to_state or state, now, state, now, now, limit))
+		lconn.conn.commit()
+		lconn.cur.execute(f'''SELECT {JOB_COLUMNS} FROM jobs WHERE lease_owner = ? ORDER BY priority DESC, id;''', (token,))
+		return lconn.cur.fetchall()
+
+def claim_job(lconn: LockableSqliteConn, job_id: int, state: str, owner: str, lease_time: float = 60.0) -> list[tuple]:
+	'''Lease one particular job if it is still waiting in `state`. Returns it in a list like `claim_jobs`, or an empty list if another worker got it first.'''
+	now = time.time()
+	token = f'{owner}:{now}'
+	with lconn:
+		lconn.cur.execute('''UPDATE jobs SET lease_owner = ?, lease_expires = ?, updated = ? WHERE id = ? AND state = ? AND (lease_owner IS NULL OR lease_expires < ?) AND not_before <= ?;''', (token, now + lease_time, now, job_id, state, now, now))
+		lconn.conn.commit()
+		lconn.cur.execute(f'''SELECT {JOB_COLUMNS} FROM jobs WHERE id = ? AND lease_owner = ?;''', (job_id, token))
+		return lconn.cur.fetchall()
+
+def destination_heads(lconn: LockableSqliteConn, state: str) -> list[tuple]:
+	'''The next job waiting in `state` for each destination server (`''` for local folders), as `(job id, user_at_ip, priority)`'''
+	now = time.time()
+	with lconn:
+		lconn.cur.execute('''SELECT id, destination, priority FROM (
+			SELECT j.id, COALESCE(ps.user_at_ip, '') AS destination, j.priority, ROW_NUMBER() OVER (PARTITION BY COALESCE(ps.user_at_ip, '') ORDER BY j.priority DESC, j.id) AS n
+			FROM jobs j LEFT JOIN property_settings ps ON ps.property = j.property
+			WHERE j.state = ? AND (j.lease_owner IS NULL OR j.lease_expires < ?) AND j.not_before <= ?
+		) WHERE n = 1;''', (state, now, now))
+		return lconn.cur.fetchall()
+
+def heartbeat_job(lconn: LockableSqliteConn, job_id: int, lease_time: float = 60.0, progress: Optional[str] = None) -> None:
+	'''Extend a job's lease while it is being worked on, optionally saving its progress (JSON)'''
+	with lconn:
+		lconn.cur.execute('''UPDATE jobs SET lease_expires = ?, progress = COALESCE(?, progress) WHERE id = ?;''', (time.time() + lease_time, progress, job_id))
+		lconn.conn.commit()
+
+def leased_jobs(lconn: LockableSqliteConn, job_ids: list[int], owner: str) -> list[int]:
+	'''Which of `job_ids` are still leased to `owner`, i.e. haven't been advanced, failed or released since it claimed them'''
+	with lconn:
+		lconn.cur.execute(f'''SELECT id FROM jobs WHERE id IN ({", ".join("?" * len(job_ids))}) AND substr(lease_owner, 1, ?) = ?;''', (*job_ids, len(owner) + 1, owner + ':'))
+		return [row[0] for row in lconn.cur.fetchall()]
+
+def advance_job(lconn: LockableSqliteConn, job_id: int, state: str, keep_lease: bool = False, **fields) -> None:
+	'''Move a job to another state, updating any of `property`, `filename` and `output_path`. The lease is released unless `keep_lease`.'''
+	sets = ['state = ?', 'updated = ?', 'error = NULL'] + [f'{k} = ?' for k in fields]
+	if not keep_lease:
+		sets.append('lease_owner = NULL')
+	with lconn:
+		lconn.cur.execute(f'''UPDATE jobs SET {", ".join(sets)} WHERE id = ?;''', (state, time.time(), *fields.values(), job_id))
+		lconn.conn.commit()
+
+def release_job(lconn: LockableSqliteConn, job_id: int, state: Optional[str] = None) -> None:
+	'''Give a job back without counting an attempt (e.g. on shutdown)'''
+	with lconn:
+		lconn.cur.execute('''UPDATE jobs SET lease_owner = NULL, state = COALESCE(?, state) WHERE id = ?;''', (state, job_id))
+		lconn.conn.commit()
+
+def fail_job(lconn: LockableSqliteConn, job_id: int, error: str, max_attempts: int = 5, backoff: float = 30.0, retry: bool = True) -> bool:
+	'''
+	Record a failed attempt. The job is retried from the same state after an exponential backoff until `max_attempts` is reached, then marked `failed`.
+	Returns `True` if it will be retried.
+	'''
+	now = time.time()
+	with lconn:
+		lconn.cur.execute('''SELECT attempts FROM jobs WHERE id = ?;''', (job_id,))
+		attempts = lconn.cur.fetchone()[0] + 1
+		if retry and attempts < max_attempts:
+			lconn.cur.execute('''UPDATE jobs SET attempts = ?, not_before = ?, lease_owner = NULL, error = ?, updated = ? WHERE id = ?;''', (attempts, now + min(backoff * 2 ** (attempts - 1), 3600.0), error, now, job_id))
+		else:
+			lconn.cur.execute('''UPDATE jobs SET attempts = ?, state = 'failed', lease_owner = NULL, error = ?, updated = ? WHERE id = ?;''', (attempts, error, now, job_id))
+		lconn.conn.commit()
+	return retry and attempts < max_attempts
+
+def job_counts(lconn: LockableSqliteConn, states: list[str] = JOB_STATES, waiting: bool = False) -> dict[str, int]:
+	'''Number of jobs in each of `states`. States without jobs are left out. `waiting` only counts jobs no thread is working on.'''
+	with lconn:
+		lconn.cur.execute(f'''SELECT state, COUNT(*) FROM jobs WHERE state IN ({", ".join("?" * len(states))}){" AND lease_owner IS NULL" if waiting else ""} GROUP BY state;''', states)
+		return dict(lconn.cur.fetchall())
+
+def resume_jobs(lconn: LockableSqliteConn) -> int:
+	'''Release every lease left by a previous run so interrupted jobs pick up at the state they were in. Returns how many jobs are unfinished.'''
+	with lconn:
+		# Matching is cheap so those just start over
+		lconn.cur.execute('''UPDATE jobs SET state = 'queued' WHERE state = 'probing';''')
+		lconn.cur.execute('''UPDATE jobs SET lease_owner = NULL WHERE lease_owner IS NOT NULL;''')
+		lconn.conn.commit()
+		lconn.cur.execute('''SELECT COUNT(*) FROM jobs WHERE state NOT IN ('done', 'failed');''')
+		return lconn.cur.fetchone()[0]
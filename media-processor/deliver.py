@@ -0,0 +1,110 @@
+import errno
+import logging
+import os
+import shutil
+
+logger = logging.getLogger(__name__)
+
+# Copies across file systems go to `<destination>.part` and are renamed into place once complete and synced
+PART_SUFFIX = '.part'
+# Bytes per `copy_file_range`/`sendfile` call
+CHUNK_SIZE = 64 * 1024 * 1024
+# Errors meaning a kernel copy call can't be used for these files (as opposed to the copy failing)
+UNSUPPORTED = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP, errno.EBADF, errno.EPERM}
+
+
+def deliver(src: str, dst: str) -> str:
+	'''
+	Move a finished file into place, replacing any file already at `dst`.
+	A rename when both are on the same file system. Otherwise a copy done in the kernel to a temporary name beside `dst`, synced and renamed into place, after which `src` is removed.
+	The copy is synced because the source is deleted right after it, while a renamed file is still the one that was written.
+	Either way a partial file never appears at `dst`. Returns how the file was moved, for the log.
+	'''
+	try:
+		os.replace(src, dst)
+		return 'rename'
+	except OSError as e:
+		if e.errno != errno.EXDEV:
+			raise
+	method = copy_file(src, dst)
+	os.remove(src)
+	return method
+
+
+def link_or_copy(src: str, dst: str) -> str:
+	'''Put a copy of `src` at `dst`, hard linking when they're on the same file system. Returns how, for the log.'''
+	try:
+		os.link(src, dst)
+		return 'link'
+	except OSError as e:
+		if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+			raise
+	return copy_file(src, dst)
+
+
+def copy_file(src: str, dst: str) -> str:
+	'''Copy `src` to a temporary name beside `dst`, sync it and rename it into place. Returns the method that copied the data.'''
+	part_path = dst + PART_SUFFIX
+	try:
+		with open(src, 'rb') as fsrc, open(part_path, 'wb') as fdst:
+			size = os.fstat(fsrc.fileno()).st_size
+			method = kernel_copy(fsrc.fileno(), fdst.fileno(), size)
+			if not method:
+				shutil.copyfileobj(fsrc, fdst, 1024 * 1024)
+				method = 'read/write'
+			fdst.flush()
+			os.fsync(fdst.fileno())
+		try:
+			shutil.copymode(src, part_path)
+		except OSError:
+			# Some mounts (e.g. SMB, FAT) don't keep permissions
+			pass
+		os.replace(part_path, dst)
+	except BaseException:
+		if os.path.exists(part_path):
+			os.remove(part_path)
+		raise
+	sync_dir(dst)
+	return method
+
+
+def kernel_copy(fd_in: int, fd_out: int, size: int) -> str:
+	'''
+	Copy `size` bytes without passing them through userspace: `copy_file_range` (which also shares blocks on file systems that support reflinks), else `sendfile`.
+	Returns the method used, or an empty string if neither works for these files.
+	'''
+	for method in ('copy_file_range', 'sendfile'):
+		if not hasattr(os, method):
+			continue
+		copied = 0
+		try:
+			while copied < size:
+				count = min(CHUNK_SIZE, size - copied)
+				if method == 'copy_file_range':
+					n = os.copy_file_range(fd_in, fd_out, count, copied, copied)
+				else:
+					n = os.sendfile(fd_out, fd_in, copied, count)
+				if n == 0:
+					raise IOError(f'Source file shrank while copying it ({copied} of {size} bytes)')
+				copied += n
+			return method
+		except OSError as e:
+			# Only fall back before anything was written
+			if copied or e.errno not in UNSUPPORTED:
+				raise
+	return ''
+
+
+def sync_dir(path: str) -> None:
+	'''Make a rename into `path`'s folder durable'''
+	try:
+		fd = os.open(os.path.dirname(path) or '.', os.O_RDONLY)
+	except OSError:
+		return
+	try:
+		os.fsync(fd)
+	except OSError:
+		# Not supported by every file system
+		pass
+	finally:
+		os.close(fd)
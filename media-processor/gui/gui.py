@@ -1,11 +1,58 @@
+from bisect import bisect_left
+from queue import Empty, Queue
+import string
+import threading
 from tkinter import *
 from tkinter import ttk
-from tkinter.messagebox import askyesno
-from typing import Optional
+from tkinter.messagebox import askyesno, showerror
+from typing import Callable, Iterator, Optional
 
 from db import LockableSqliteConn
 from configure import command
 
+# Property names read from the DB at a time
+PAGE_SIZE = 500
+# Rows of the property list shown at once. Only these are put in the listbox.
+VISIBLE_ROWS = 10
+# Milliseconds between checks for results from the background thread
+POLL_INTERVAL = 50
+# Milliseconds after the last change to the search box before searching
+SEARCH_DELAY = 150
+# SQLite's NOCASE collation only folds ASCII letters
+NOCASE = str.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+
+def sort_key(property: str) -> tuple[str, str]:
+	'''The order of the `properties_search` index, which the property list is shown in'''
+	return (property.translate(NOCASE), property)
+
+def get_property_names(lconn: LockableSqliteConn, search: str = '', after: Optional[str] = None, limit: int = PAGE_SIZE) -> list[str]:
+	'''
+	Up to `limit` property names starting with `search` (ignoring case) in `sort_key` order, from just after the property `after`.
+	Read from the `properties_search` index, so a page is as quick to get from the end of a large catalog as from the start.
+	'''
+	conditions = []
+	params = []
+	if search:
+		conditions.append('''property LIKE ? ESCAPE '\\' ''')
+		params.append(search.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%')
+	if after is not None:
+		conditions.append('''property COLLATE NOCASE >= ? AND (property COLLATE NOCASE > ? OR property > ?)''')
+		params += [after, after, after]
+	where = f'''WHERE {' AND '.join(conditions)} ''' if conditions else ''
+	with lconn:
+		lconn.cur.execute(f'''SELECT property FROM properties {where}ORDER BY property COLLATE NOCASE, property LIMIT ?;''', params + [limit])
+		return [row[0] for row in lconn.cur.fetchall()]
+
+def property_pages(lconn: LockableSqliteConn, search: str, wanted: Callable[[], bool]) -> Iterator[list[str]]:
+	'''Every property name starting with `search`, a page at a time, for as long as `wanted()`. The last page is shorter than `PAGE_SIZE`, maybe empty.'''
+	after = None
+	while wanted():
+		page = get_property_names(lconn, search, after)
+		yield page
+		if len(page) < PAGE_SIZE:
+			return
+		after = page[-1]
+
 def get_properties(lconn: LockableSqliteConn, property: Optional[str] = None) -> tuple:
 	with lconn:
 		if property:
@@ -33,10 +80,59 @@ def get_destinations(lconn: LockableSqliteConn, user_at_ip: Optional[str] = None
 			lconn.cur.execute('''SELECT * FROM destination_servers;''')
 			return lconn.cur.fetchall()
 
+def get_property_form(lconn: LockableSqliteConn, property: Optional[str]) -> tuple[list[str], Optional[tuple], Optional[tuple]]:
+	'''What the property window shows: the destination servers to choose from, and the property and its settings if one is given'''
+	with lconn:
+		lconn.cur.execute('''SELECT user_at_ip FROM destination_servers;''')
+		user_at_ips = [row[0] for row in lconn.cur.fetchall()]
+		if not property:
+			return (user_at_ips, None, None)
+		return (user_at_ips, get_properties(lconn, property), get_property_settings(lconn, property))
+
+
+class LoaderThread(threading.Thread):
+	'''
+	Runs the configurator's slower queries in the background, one at a time, so the window keeps responding while they run.
+	Tk can only be used from the thread running it, so results wait in `results` until `RootWindow.poll` hands them to their callbacks.
+	'''
+	def __init__(self, lconn: LockableSqliteConn):
+		threading.Thread.__init__(self, name='GUI Loader', daemon=True)
+		self.lconn = lconn
+		self.requests: Queue = Queue()
+		self.results: Queue = Queue()
+
+	def submit(self, query: Callable, args: tuple, callback: Callable, stream: bool = False) -> None:
+		'''Run `query(lconn, *args)` and pass the result to `callback`. With `stream`, `query` is a generator and each item it yields is passed on as soon as it is ready.'''
+		self.requests.put((query, args, callback, stream))
+
+	def run(self):
+		while True:
+			query, args, callback, stream = self.requests.get()
+			try:
+				if stream:
+					for item in query(self.lconn, *args):
+						self.results.put((callback, item, None))
+				else:
+					self.results.put((callback, query(self.lconn, *args), None))
+			except Exception as e:
+				self.results.put((callback, None, e))
+
 
 class RootWindow:
 	def __init__(self, lconn: LockableSqliteConn):
 		self.lconn = lconn
+		self.loader = LoaderThread(lconn)
+		self.loader.start()
+		# Names of the properties matching the search, in `sort_key` order, and the index of the first one shown
+		self.property_names: list[str] = []
+		self.property_offset: int = 0
+		self.property_search: str = ''
+		# Bumped for each reload, so pages of an older one are ignored
+		self.property_generation: int = 0
+		self.shown_generation: int = 0
+		self.properties_loading: bool = False
+		self.selected_property: Optional[str] = None
+		self.search_after: Optional[str] = None
 
 		# Build window
 		self.root = Tk()
@@ -51,13 +147,25 @@ class RootWindow:
 		# Add property listings and action buttons
 		property_frame = Frame(main_frame)
 		property_frame.grid(row=0, column=0, pady=10)
-		self.property_listbox = Listbox(property_frame)
-		self.property_listbox.grid(row=0, column=0)
-		self.property_listbox.bind('<FocusOut>', lambda e: self.property_listbox.selection_clear(0, END))
-		property_listbox_scroll = Scrollbar(property_frame)
-		property_listbox_scroll.grid(row=0, column=1, sticky=N+S+W)
-		self.property_listbox.config(yscrollcommand=property_listbox_scroll.set)
-		property_listbox_scroll.config(command=self.property_listbox.yview)
+		search_frame = Frame(property_frame)
+		search_frame.grid(row=0, column=0, columnspan=2, sticky=W)
+		Label(search_frame, text='Search:').grid(row=0, column=0)
+		self.search_var = StringVar()
+		self.search_var.trace_add('write', lambda *_: self.search_changed())
+		Entry(search_frame, textvariable=self.search_var).grid(row=0, column=1)
+		self.property_listbox = Listbox(property_frame, height=VISIBLE_ROWS)
+		self.property_listbox.grid(row=1, column=0)
+		self.property_listbox.bind('<FocusOut>', lambda e: self.clear_property_selection())
+		self.property_listbox.bind('<<ListboxSelect>>', lambda e: self.property_selected())
+		self.property_listbox.bind('<MouseWheel>', lambda e: self.scroll_properties('scroll', -1 if e.delta > 0 else 1, 'units'))
+		self.property_listbox.bind('<Button-4>', lambda e: self.scroll_properties('scroll', -1, 'units'))
+		self.property_listbox.bind('<Button-5>', lambda e: self.scroll_properties('scroll', 1, 'units'))
+		# The listbox only holds the visible rows, so the scrollbar is driven from `property_names` instead
+		self.property_listbox_scroll = Scrollbar(property_frame)
+		self.property_listbox_scroll.grid(row=1, column=1, sticky=N+S+W)
+		self.property_listbox_scroll.config(command=self.scroll_properties)
+		self.property_count_label = Label(property_frame)
+		self.property_count_label.grid(row=2, column=0, columnspan=2, sticky=W)
 		property_actions_frame = Frame(main_frame)
 		property_actions_frame.grid(row=0, column=1)
 		Button(property_actions_frame, text='Add/Edit property', command=lambda: AddEditPropertyWindow(self)).grid(row=0, column=0)
@@ -87,12 +195,106 @@ class RootWindow:
 		action_frame.grid(row=2, column=0, sticky=SE)
 		Button(action_frame, text='Exit', command=lambda: self.root.quit()).grid(row=0, column=0, padx=5)
 	
+		self.poll()
 		self.root.mainloop()
 
+	def poll(self) -> None:
+		'''Hand the background thread's results to their callbacks, on the Tk thread'''
+		while True:
+			try:
+				callback, result, error = self.loader.results.get_nowait()
+			except Empty:
+				break
+			if error:
+				showerror('Media Processor Configurator | Error', str(error))
+			else:
+				callback(result)
+		self.root.after(POLL_INTERVAL, self.poll)
+
 	def update_properties_list(self) -> None:
+		'''Reload the properties matching the search box in the background, a page at a time. The current list stays up until the first page arrives.'''
+		self.search_after = None
+		self.property_generation += 1
+		generation = self.property_generation
+		self.property_search = self.search_var.get()
+		self.properties_loading = True
+		self.render_properties()
+		self.loader.submit(property_pages, (self.property_search, lambda: generation == self.property_generation), lambda page: self.properties_loaded(generation, page), stream=True)
+
+	def search_changed(self) -> None:
+		'''Search once typing pauses'''
+		if self.search_after:
+			self.root.after_cancel(self.search_after)
+		self.search_after = self.root.after(SEARCH_DELAY, self.update_properties_list)
+
+	def properties_loaded(self, generation: int, page: list[str]) -> None:
+		if generation != self.property_generation:
+			return
+		if generation != self.shown_generation:
+			self.shown_generation = generation
+			self.property_names = page
+			self.property_offset = 0
+		else:
+			self.property_names.extend(page)
+		self.properties_loading = len(page) == PAGE_SIZE
+		self.render_properties()
+
+	def render_properties(self) -> None:
+		'''Show the rows scrolled into view'''
+		total = len(self.property_names)
+		self.property_offset = max(0, min(self.property_offset, total - VISIBLE_ROWS))
+		visible = self.property_names[self.property_offset:self.property_offset + VISIBLE_ROWS]
 		self.property_listbox.delete(0, END)
-		for i, row in enumerate(get_properties(self.lconn)):
-			self.property_listbox.insert(i, row[0])
+		self.property_listbox.insert(END, *visible)
+		if self.selected_property in visible:
+			self.property_listbox.selection_set(visible.index(self.selected_property))
+		if total > VISIBLE_ROWS:
+			self.property_listbox_scroll.set(self.property_offset / total, (self.property_offset + len(visible)) / total)
+		else:
+			self.property_listbox_scroll.set(0.0, 1.0)
+		self.property_count_label.config(text=f'{total} properties' + (' (loading...)' if self.properties_loading else ''))
+
+	def scroll_properties(self, action: str, amount: str, unit: Optional[str] = None) -> None:
+		'''The scrollbar's command, `moveto <fraction>` or `scroll <n> units|pages`'''
+		if action == 'moveto':
+			self.property_offset = round(float(amount) * len(self.property_names))
+		else:
+			self.property_offset += int(amount) * (VISIBLE_ROWS if unit == 'pages' else 1)
+		self.render_properties()
+
+	def property_selected(self) -> None:
+		selection = self.property_listbox.curselection()
+		if selection:
+			self.selected_property = self.property_listbox.get(selection[0])
+
+	def clear_property_selection(self) -> None:
+		self.property_listbox.selection_clear(0, END)
+		self.selected_property = None
+
+	def property_index(self, property: str) -> int:
+		'''Where `property` is or would go in `property_names`'''
+		return bisect_left(self.property_names, sort_key(property), key=sort_key)
+
+	def property_saved(self, property: str) -> None:
+		'''Add a saved property to the list if it matches the search, rather than reloading the list'''
+		if not property.translate(NOCASE).startswith(self.property_search.translate(NOCASE)):
+			return
+		i = self.property_index(property)
+		if i < len(self.property_names) and self.property_names[i] == property:
+			return
+		if i == len(self.property_names) and self.properties_loading:
+			# Past the pages loaded so far. It will come in a later one.
+			return
+		self.property_names.insert(i, property)
+		self.render_properties()
+
+	def property_removed(self, property: str) -> None:
+		i = self.property_index(property)
+		if i < len(self.property_names) and self.property_names[i] == property:
+			del self.property_names[i]
+		if self.selected_property == property:
+			self.selected_property = None
+		self.render_properties()
 
 	def update_destinations_list(self) -> None:
 		self.destination_listbox.delete(0, END)
@@ -100,19 +302,19 @@ class RootWindow:
 			self.destination_listbox.insert(i, row[0])
 
 	def remove_selected_property(self) -> None:
-		selected_property: Optional[str] = self.property_listbox.get(self.property_listbox.curselection()[0]) if len(self.property_listbox.curselection()) > 0 else None
+		selected_property = self.selected_property
 		if selected_property:
 			yn = askyesno('Media Processor Configurator | Confirm', f'Are you sure you want to delete "{selected_property}"?')
 			if yn:
-				command(self.lconn, [f'remove property "{selected_property}"', f'remove setting "{selected_property}"', 'commit'])
-				self.update_properties_list()
+				command(self.lconn, [f'remove property "{selected_property}"', f'remove setting "{selected_property}"'])
+				self.property_removed(selected_property)
 
 	def remove_selected_destination(self) -> None:
 		selected_destination: Optional[str] = self.destination_listbox.get(self.destination_listbox.curselection()[0]) if len(self.destination_listbox.curselection()) > 0 else None
 		if selected_destination:
 			yn = askyesno('Media Processor Configurator | Confirm', f'Are you sure you want to delete "{selected_destination}"?')
 			if yn:
-				command(self.lconn, [f'remove destination "{selected_destination}"', 'commit'])
+				command(self.lconn, [f'remove destination "{selected_destination}"'])
 				self.update_destinations_list()
 
 class AddEditPropertyWindow:
@@ -155,10 +357,7 @@ class AddEditPropertyWindow:
 		self.output_container_entry = Entry(settings_frame)
 		self.output_container_entry.grid(row=3, column=1)
 		Label(settings_frame, text='Destination Server (leave blank for local):').grid(row=4, column=0)
-		with self.root_window.lconn:
-			self.root_window.lconn.cur.execute('''SELECT user_at_ip FROM destination_servers;''')
-			user_at_ips = list(map(lambda uai: uai[0], self.root_window.lconn.cur.fetchall()))
-		self.destination_server_box = ttk.Combobox(settings_frame, values=user_at_ips)
+		self.destination_server_box = ttk.Combobox(settings_frame)
 		self.destination_server_box.grid(row=4, column=1)
 		Label(settings_frame, text='Folder:').grid(row=5, column=0)
 		self.folder_entry = Entry(settings_frame)
@@ -169,27 +368,42 @@ class AddEditPropertyWindow:
 		Label(settings_frame, text='Season Override (leave blank for auto):').grid(row=7, column=0)
 		self.season_override_entry = Entry(settings_frame)
 		self.season_override_entry.grid(row=7, column=1)
+		Label(settings_frame, text='Copy Codecs (comma separated, leave blank to always encode):').grid(row=8, column=0)
+		self.copy_codecs_entry = Entry(settings_frame)
+		self.copy_codecs_entry.grid(row=8, column=1)
+		Label(settings_frame, text='Segments (split large files for parallel encoding, leave blank to disable):').grid(row=9, column=0)
+		self.segments_entry = Entry(settings_frame)
+		self.segments_entry.grid(row=9, column=1)
 
 		action_frame = Frame(self.add_edit_window)
 		action_frame.grid(row=4, column=0, sticky=SE)
-		Button(action_frame, text='Save and Exit', command=self.save_and_exit).grid(row=0, column=0, padx=5)
-
-		selected_property: Optional[str] = self.root_window.property_listbox.get(self.root_window.property_listbox.curselection()[0]) if len(self.root_window.property_listbox.curselection()) > 0 else None
-		if selected_property:
-			prop = get_properties(self.root_window.lconn, selected_property)
-			settings = get_property_settings(self.root_window.lconn, selected_property)
-			if prop:
-				self.property_entry.insert(0, prop[0])
-				self.pattern_entry.insert(0, prop[1])
-				self.partial_var.set(prop[2])
-			if settings:
-				self.ffmpeg_input_args_entry.insert(0, settings[1])
-				self.ffmpeg_output_args_entry.insert(0, settings[2])
-				self.output_container_entry.insert(0, settings[3])
-				self.destination_server_box.set(settings[3] if settings[4] else '')
-				self.folder_entry.insert(0, settings[5])
-				self.is_show_var.set(settings[6])
-				self.season_override_entry.insert(0, settings[7] if settings[7] else '')
+		# Enabled once the form is filled in, so saving early can't blank the property
+		self.save_button = Button(action_frame, text='Save and Exit', command=self.save_and_exit, state=DISABLED)
+		self.save_button.grid(row=0, column=0, padx=5)
+
+		self.root_window.loader.submit(get_property_form, (self.root_window.selected_property,), self.fill)
+
+	def fill(self, form: tuple[list[str], Optional[tuple], Optional[tuple]]) -> None:
+		'''Fill in the form with what `get_property_form` read'''
+		if not self.add_edit_window.winfo_exists():
+			return
+		user_at_ips, prop, settings = form
+		self.destination_server_box.config(values=user_at_ips)
+		if prop:
+			self.property_entry.insert(0, prop[0])
+			self.pattern_entry.insert(0, prop[1])
+			self.partial_var.set(prop[2])
+		if settings:
+			self.ffmpeg_input_args_entry.insert(0, settings[1])
+			self.ffmpeg_output_args_entry.insert(0, settings[2])
+			self.output_container_entry.insert(0, settings[3])
+			self.destination_server_box.set(settings[4] if settings[4] else '')
+			self.folder_entry.insert(0, settings[5])
+			self.is_show_var.set(settings[6])
+			self.season_override_entry.insert(0, settings[7] if settings[7] else '')
+			self.copy_codecs_entry.insert(0, settings[8] if settings[8] else '')
+			self.segments_entry.insert(0, str(settings[9]) if settings[9] else '')
+		self.save_button.config(state=NORMAL)
 
 	def get_values(self) -> dict:
 		'''Get the values as a dict of lists representing the DB entries'''
@@ -208,7 +422,9 @@ class AddEditPropertyWindow:
 				self.folder_entry.get(),
 				self.destination_server_box.get(),
 				str(self.is_show_var.get()),
-				self.season_override_entry.get()
+				self.season_override_entry.get(),
+				self.copy_codecs_entry.get(),
+				self.segments_entry.get()
 			]
 		}
 
@@ -217,10 +433,9 @@ class AddEditPropertyWindow:
 		values = self.get_values()
 		command(self.root_window.lconn, [
 			'add property "' + '" "'.join(values['properties']) + '"',
-			'add setting "' +  '"  "'.join(values['settings']) + '"',
-			'commit'
+			'add setting "' +  '"  "'.join(values['settings']) + '"'
 		])
-		self.root_window.update_properties_list()
+		self.root_window.property_saved(values['properties'][0])
 		self.add_edit_window.destroy()
 	
 
@@ -247,6 +462,12 @@ class AddEditDestinationWindow:
 		Label(destination_frame, text='Password (UNENCRYPTED!) (optional if using ssh keys):').grid(row=2, column=0)
 		self.password_entry = Entry(destination_frame, show='*')
 		self.password_entry.grid(row=2, column=1)
+		Label(destination_frame, text='Max Transfers (optional):').grid(row=3, column=0)
+		self.max_transfers_entry = Entry(destination_frame)
+		self.max_transfers_entry.grid(row=3, column=1)
+		Label(destination_frame, text='Max Rate (KiB/s) (optional):').grid(row=4, column=0)
+		self.max_rate_entry = Entry(destination_frame)
+		self.max_rate_entry.grid(row=4, column=1)
 
 		action_frame = Frame(self.add_edit_window)
 		action_frame.grid(row=1, column=0, sticky=SE)
@@ -258,20 +479,23 @@ class AddEditDestinationWindow:
 			if destination:
 				self.user_at_ip_entry.insert(0, destination[0])
 				self.password_entry.insert(0, destination[1])
+				self.max_transfers_entry.insert(0, destination[2] or '')
+				self.max_rate_entry.insert(0, destination[3] or '')
 
 	def get_values(self) -> dict:
 		'''Get the values as list representing the DB entry'''
 		return [
 			self.user_at_ip_entry.get(),
-			self.password_entry.get()
+			self.password_entry.get(),
+			self.max_transfers_entry.get(),
+			self.max_rate_entry.get()
 		]
 
 	def save_and_exit(self) -> None:
 		'''Save changes and close TopLevel'''
 		values = self.get_values()
 		command(self.root_window.lconn, [
-			'add destination "' + '" "'.join(values) + '"',
-			'commit'
+			'add destination "' + '" "'.join(values) + '"'
 		])
 		self.root_window.update_destinations_list()
 		self.add_edit_window.destroy()
@@ -0,0 +1,102 @@
+import math
+from sqlite3 import OperationalError
+import threading
+import time
+from typing import Optional
+
+from db import LockableSqliteConn
+
+# Pipeline stages recorded, in order
+STAGES = ['scan', 'match', 'transcode', 'transfer']
+# Percentiles reported by `stats`
+PERCENTILES = (50, 90, 99)
+
+
+class JobHistory(object):
+	'''
+	Collects `job_history` rows, one per job per stage attempt, and writes them in batches so recording doesn't take the DB's write lock for every job.
+	`flush` is called every few seconds by `processor.HistoryThread` and once more on shutdown. Rows not yet written when the process dies are lost, the jobs themselves are not.
+	'''
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.rows: list[tuple] = []
+
+	def record(self, job_id: int, stage: str, outcome: str, started: float, property: Optional[str] = None, server: Optional[str] = None, input_size: Optional[int] = None, output_size: Optional[int] = None, speed: Optional[float] = None, ffmpeg_args: Optional[str] = None, error: Optional[str] = None) -> None:
+		'''
+		Record a stage finishing now. `outcome` is `done`, `reused` (a cached result), `retry` (failed and will be retried) or `failed`.
+		`server` is the destination's `user_at_ip`, or `''` for a local folder, for stages that deliver the file.
+		'''
+		row = (job_id, stage, outcome, property, server, started, time.time(), input_size, output_size, speed, ffmpeg_args, error)
+		with self.lock:
+			self.rows.append(row)
+
+	def flush(self, lconn: LockableSqliteConn) -> int:
+		'''Write the recorded rows in one transaction. Returns how many. They are kept for the next flush if the DB is busy.'''
+		with self.lock:
+			rows, self.rows = self.rows, []
+		if not rows:
+			return 0
+		try:
+			with lconn:
+				lconn.cur.executemany('''INSERT INTO job_history (job_id, stage, outcome, property, server, started, finished, input_size, output_size, speed, ffmpeg_args, error) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);''', rows)
+				lconn.conn.commit()
+		except OperationalError:
+			with self.lock:
+				self.rows[:0] = rows
+			raise
+		return len(rows)
+
+
+def percentile(values: list[float], p: float) -> float:
+	'''Nearest rank percentile of sorted `values`'''
+	return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+def stats(lconn: LockableSqliteConn, by: str = 'property', since: float = 0.0) -> list[dict]:
+	'''
+	Per stage statistics of the history recorded since `since`, grouped `by` `property` or `destination` (only stages that deliver the file have one).
+	Each entry has the group, stage, attempts, failures, and for successful attempts the percentiles of the time spent in the stage and of the time waited for it since the previous stage finished, the throughput (bytes/s) and the mean transcode speed.
+	Property groups also get a `total` stage: the time from a file being found to it being delivered.
+	'''
+	with lconn:
+		lconn.cur.execute('''SELECT h.job_id, COALESCE(h.property, j.property, ''), h.server, h.stage, h.outcome, h.started, h.finished, h.input_size, h.output_size, h.speed FROM job_history h LEFT JOIN jobs j ON j.id = h.job_id WHERE h.finished >= ? ORDER BY h.job_id, h.started;''', (since,))
+		rows = lconn.cur.fetchall()
+	groups: dict[tuple[str, str], list[tuple]] = {}
+	waits: dict[tuple[str, str], list[float]] = {}
+	previous: Optional[tuple] = None
+	# job id -> when its first stage started
+	first: dict[int, float] = {}
+	for row in rows:
+		job_id, property, server, stage, outcome, started, finished = row[:7]
+		group = property if by == 'property' else (None if server is None else server or 'local')
+		first.setdefault(job_id, started)
+		if group is not None:
+			groups.setdefault((group, stage), []).append(row)
+			if previous and previous[0] == job_id and previous[4] in ('done', 'reused'):
+				waits.setdefault((group, stage), []).append(max(0.0, started - previous[6]))
+		# Delivered by the transfer stage, or by the transcode stage when streamed or already delivered before
+		delivered = stage == 'transfer' and outcome == 'done' or stage == 'transcode' and server is not None and outcome in ('done', 'reused')
+		if by == 'property' and delivered:
+			groups.setdefault((property, 'total'), []).append((job_id, property, server, 'total', outcome, first[job_id], finished, None, None, None))
+		previous = row
+	order = {stage: i for i, stage in enumerate(STAGES + ['total'])}
+	result = []
+	for (group, stage), entries in sorted(groups.items(), key=lambda g: (g[0][0], order.get(g[0][1], len(order)))):
+		done = [e for e in entries if e[4] in ('done', 'reused')]
+		durations = sorted(e[6] - e[5] for e in done)
+		# Transcodes read the input, transfers move the output. The other stages don't move data.
+		sizes = [(e[7] if stage == 'transcode' else e[8] if stage == 'transfer' else None) or 0 for e in done]
+		busy = sum(e[6] - e[5] for e in done)
+		speeds = [e[9] for e in done if e[9]]
+		wait = sorted(waits.get((group, stage), []))
+		result.append({
+			'group': group,
+			'stage': stage,
+			'count': len(entries),
+			'failed': sum(1 for e in entries if e[4] in ('retry', 'failed')),
+			'duration': {p: percentile(durations, p) for p in PERCENTILES} if durations else None,
+			'wait': {p: percentile(wait, p) for p in PERCENTILES} if wait else None,
+			'throughput': sum(sizes) / busy if busy > 0 and any(sizes) else None,
+			'speed': sum(speeds) / len(speeds) if speeds else None,
+		})
+	return result
@@ -0,0 +1,129 @@
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+from typing import Iterable, Optional
+
+# Event masks from <sys/inotify.h>
+IN_ACCESS = 0x00000001
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_CLOSE_NOWRITE = 0x00000010
+IN_OPEN = 0x00000020
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_CREATE | IN_CLOSE_WRITE | IN_MOVED_TO | IN_MOVED_FROM | IN_DELETE | IN_DELETE_SELF | IN_ONLYDIR
+
+_EVENT_HEADER = struct.Struct('iIII')
+
+try:
+	_libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+	_libc.inotify_init1.argtypes = [ctypes.c_int]
+	_libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+	_libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+	inotify_ok = True
+except (OSError, AttributeError):
+	inotify_ok = False
+
+
+class InotifyError(OSError):
+	'''inotify isn't available, or an inotify call failed (e.g. `max_user_watches` reached)'''
+
+
+class Inotify(object):
+	'''
+	Recursive directory watcher on top of the Linux inotify API.
+	Events are returned as `(path, mask)` tuples. A mask of `IN_Q_OVERFLOW` with an empty path means events were lost and a full rescan is needed.
+	'''
+	def __init__(self):
+		if not inotify_ok:
+			raise InotifyError('inotify is not available on this platform')
+		self.fd: int = _libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+		if self.fd < 0:
+			err = ctypes.get_errno()
+			raise InotifyError(err, os.strerror(err))
+		self.watches: dict[int, str] = {}
+
+	def __del__(self):
+		self.close()
+
+	def close(self) -> None:
+		if getattr(self, 'fd', -1) >= 0:
+			os.close(self.fd)
+			self.fd = -1
+			self.watches.clear()
+
+	def add_watch(self, path: str, mask: int = WATCH_MASK) -> int:
+		'''Watch a single directory. Raise an `InotifyError` if the watch can't be added (e.g. `max_user_watches` reached), or `FileNotFoundError`/`NotADirectoryError` if the directory is gone.'''
+		wd = _libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+		if wd < 0:
+			err = ctypes.get_errno()
+			if err in (errno.ENOENT, errno.ENOTDIR):
+				raise OSError(err, os.strerror(err), path)
+			raise InotifyError(err, os.strerror(err), path)
+		self.watches[wd] = path
+		return wd
+
+	def add_tree(self, base_dir: str, mask: int = WATCH_MASK) -> Iterable[str]:
+		'''Watch a directory and all of its subdirectories. Yields the files found while walking so callers can catch files that landed before the watch existed.'''
+		try:
+			self.add_watch(base_dir, mask)
+			entries = list(os.scandir(base_dir))
+		except (FileNotFoundError, NotADirectoryError):
+			# Removed or moved away before we got to it
+			return
+		for entry in entries:
+			if entry.is_dir(follow_symlinks=False):
+				yield from self.add_tree(entry.path, mask)
+			else:
+				yield entry.path
+
+	def remove_tree(self, base_dir: str) -> None:
+		'''Stop watching a directory and its subdirectories (e.g. after it was moved out of the watched tree).'''
+		prefix = os.path.join(base_dir, '')
+		for wd, path in list(self.watches.items()):
+			if path == base_dir or path.startswith(prefix):
+				_libc.inotify_rm_watch(self.fd, wd)
+				self.watches.pop(wd, None)
+
+	def read_events(self, timeout: Optional[float] = None) -> list[tuple[str, int]]:
+		'''Wait up to `timeout` seconds for events. Returns an empty list on timeout.'''
+		readable, _, _ = select.select([self.fd], [], [], timeout)
+		if not readable:
+			return []
+		try:
+			buf = os.read(self.fd, 64 * 1024)
+		except BlockingIOError:
+			return []
+		events: list[tuple[str, int]] = []
+		offset = 0
+		while offset + _EVENT_HEADER.size <= len(buf):
+			wd, mask, _cookie, length = _EVENT_HEADER.unpack_from(buf, offset)
+			offset += _EVENT_HEADER.size
+			name = buf[offset:offset + length].rstrip(b'\0')
+			offset += length
+			if mask & IN_Q_OVERFLOW:
+				events.append(('', mask))
+				continue
+			directory = self.watches.get(wd)
+			if mask & IN_IGNORED:
+				self.watches.pop(wd, None)
+				continue
+			if directory is None:
+				continue
+			events.append((os.path.join(directory, os.fsdecode(name)) if name else directory, mask))
+		return events
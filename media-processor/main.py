@@ -5,9 +5,15 @@ import re
 import signal
 from typing import Pattern
 
+from catalog import PropertyCatalog
 from configure import shell
-from db import LockableSqliteConn, create_tables
+from db import LockableSqliteConn, create_tables, resume_jobs
+from inotify import InotifyError
+from matcher import TIE_BREAKS
 import processor
+from scheduler import TranscodeScheduler
+from sftp_pool import SftpPool
+from transfer_scheduler import TransferScheduler
 
 threads = []
 
@@ -71,8 +77,26 @@ if __name__ == '__main__':
 	parser = argparse.ArgumentParser()
 	parser.add_argument('-w', '--watch', dest='watch_folder', help='the directory to watch for changes (required)', type=dir_path, required=True)
 	parser.add_argument('-p', '--process', dest='process_folder', help='the directory to process media in (required)', type=dir_path, required=True)
-	parser.add_argument('-pt', '--processer-threads', dest='processor_threads', help='the number of processor threads. should be equal to the number of max transcodes at a time', type=int, default=1)
+	parser.add_argument('-pt', '--processer-threads', dest='processor_threads', help='the most transcodes at a time. defaults to the number of available cores. jobs are only admitted while cores are free and the load average is under `-ml`', type=int)
+	parser.add_argument('-tt', '--transfer-threads', dest='transfer_threads', help='the most local moves and sftp uploads at a time. transfers run separately from transcodes', type=int, default=2)
+	parser.add_argument('-qs', '--queue-size', dest='queue_size', help='the most jobs waiting between stages. matching pauses while this many matched files wait for a transcode and transcoding pauses while this many transcoded files wait for a transfer', type=int, default=8)
+	parser.add_argument('-ml', '--max-load', dest='max_load', help='don\'t start new transcodes while the 1 minute load average is above this. defaults to the number of available cores', type=float)
+	parser.add_argument('-sto', '--stall-timeout', dest='stall_timeout', help='kill ffmpeg if it makes no progress for this many seconds. 0 disables', type=float, default=300.0)
+	parser.add_argument('-sf', '--status-file', dest='status_file', help='write the queue depths and progress of running transcodes (frames, fps, speed, size, eta) to this JSON file every few seconds')
+	parser.add_argument('-n', '--nice', dest='nice', help='niceness to run ffmpeg with', type=int, default=10)
 	parser.add_argument('-t', '--time-to-sleep', dest='sleep_time', help='how many minutes the watcher should wait before scanning again', type=float, default=0.5)
+	parser.add_argument('-wb', '--watcher-backend', dest='watcher_backend', help='how the watcher detects new files. `auto` uses inotify when available and falls back to polling. `inotify` exits if inotify can\'t be set up', choices=['auto', 'inotify', 'poll'], default='auto')
+	parser.add_argument('-ri', '--rescan-interval', dest='rescan_interval', help='how many minutes between full scans while inotify is in use, to catch anything it missed. `-t` is used when polling', type=float, default=60.0)
+	parser.add_argument('-st', '--settle-time', dest='settle_time', help='how many seconds a new file\'s size and modification time must stay unchanged before it is processed', type=float, default=10.0)
+	parser.add_argument('-sw', '--scan-workers', dest='scan_workers', help='how many directories the polling scan lists in parallel', type=int, default=8)
+	parser.add_argument('-mt', '--match-threshold', dest='match_threshold', help='the fuzzy match score (0-100) a property must beat to be matched', type=int, default=40)
+	parser.add_argument('-tb', '--tie-break', dest='tie_break', help='which property wins when several have the same score. `longest` and `shortest` compare pattern length. `first` uses DB order', choices=TIE_BREAKS, default='longest')
+	parser.add_argument('-bs', '--batch-size', dest='batch_size', help='the most queued files a processor thread matches in one pass. bursts like season packs are matched together', type=int, default=200)
+	parser.add_argument('-ms', '--memo-size', dest='memo_size', help='how many cleaned filenames (without season and episode numbers) to remember match results for', type=int, default=10000)
+	parser.add_argument('-pm', '--persist-memo', dest='persist_memo', help='keep match results in the DB so they survive restarts', action='store_true')
+	parser.add_argument('-ma', '--max-attempts', dest='max_attempts', help='how many times a job is tried before it is marked failed. retries back off exponentially', type=int, default=5)
+	parser.add_argument('-sc', '--sftp-connections', dest='sftp_connections', help='the most sftp sessions kept open to each destination server. sessions are reused between uploads. also the most transfers at once to each server unless its `max transfers` is lower', type=int, default=2)
+	parser.add_argument('-su', '--stream-uploads', dest='stream_uploads', help='pipe ffmpeg\'s output straight to sftp destinations instead of writing it to the process folder first. only for containers that can be written front to back (mkv, webm, ts, flv, nut, ogg, and mp4/mov with fragmenting `-movflags`). falls back to the process folder when no sftp session is free', action='store_true')
 	parser.add_argument('-kh', '--known-hosts', dest='known_hosts', help='location of an ssh known_hosts file. required if using sftp and you care about security', type=dir_file)
 	parser.add_argument('-pkl', '--private-key_loc', dest='private_key_loc', help='location of a ssh private key to use for sftp', type=dir_file)
 	parser.add_argument('-pkp', '--private-key-pass', dest='private_key_pass', help='the ssh private key password')
@@ -117,15 +141,32 @@ if __name__ == '__main__':
 		logger.error('Exiting with code 3')
 		exit(3)
 	print('Tables created if not exist.')
+	print(f'Resuming {resume_jobs(lconn)} unfinished jobs.')
+	sftp_pool = SftpPool(args.known_hosts, args.private_key_loc, args.private_key_pass, args.sftp_connections)
 	try:
 		# Spin up watcher and processor threads
-		watcherThread = processor.WatcherThread(args.watch_folder, args.sleep_time)
+		try:
+			watcherThread = processor.WatcherThread(args.watch_folder, args.sleep_time, args.watcher_backend, args.settle_time, args.scan_workers, args.rescan_interval)
+		except InotifyError as e:
+			print(f'{e} Use `--watcher-backend auto` to fall back to polling. Exiting. (Error 4)')
+			logger.error('Exiting with code 4')
+			exit(4)
 		watcherThread.start()
 		threads.append(watcherThread)
-		for i in range(args.processor_threads):
-			processorThread = processor.ProcessorThread(args.process_folder, args.clean_regex, args.season_episode_regex, args.episode_regex, args.known_hosts, args.private_key_loc, args.private_key_pass, i + 1)
-			processorThread.start()
-			threads.append(processorThread)
+		catalog = PropertyCatalog('db.sqlite3', args.match_threshold, args.tie_break, args.memo_size, args.persist_memo)
+		scheduler = TranscodeScheduler(args.processor_threads, args.max_load, args.nice)
+		transfers = TransferScheduler(catalog, args.sftp_connections)
+		stageThreads = [processor.MatchThread(args.clean_regex, args.season_episode_regex, args.episode_regex, catalog, args.batch_size, args.queue_size, args.max_attempts)]
+		for i in range(scheduler.max_jobs):
+			stageThreads.append(processor.TranscodeThread(args.process_folder, args.season_episode_regex, args.episode_regex, catalog, scheduler, sftp_pool, transfers, args.stream_uploads, args.queue_size, args.stall_timeout, args.max_attempts, i + 1))
+		for i in range(args.transfer_threads):
+			stageThreads.append(processor.TransferThread(catalog, sftp_pool, transfers, args.max_attempts, i + 1))
+		if args.status_file:
+			stageThreads.append(processor.StatusThread(args.status_file, transfers))
+		stageThreads.append(processor.HistoryThread())
+		for stageThread in stageThreads:
+			stageThread.start()
+			threads.append(stageThread)
 
 		# Keep alive and maybe collect user input
 		if args.disable_shell:
@@ -141,4 +182,7 @@ if __name__ == '__main__':
 		processor.kill()
 		for thread in threads:
 			thread.join()
+		# What the stage threads recorded while stopping
+		processor.history.flush(lconn)
+		sftp_pool.close()
 		print('Exiting')
\ No newline at end of file
@@ -0,0 +1,206 @@
+from collections import Counter, OrderedDict
+from heapq import nlargest
+from itertools import chain
+import threading
+from typing import Optional
+
+from rapidfuzz import fuzz as rapid_fuzz
+from thefuzz import fuzz
+
+from db import LockableSqliteConn
+
+try:
+	# Optional. rapidfuzz needs it to score a whole batch as one matrix.
+	import numpy
+	from rapidfuzz.process import cdist
+	cdist_ok = True
+except ImportError:
+	cdist_ok = False
+
+TIE_BREAKS = ['longest', 'shortest', 'first']
+# Score matrices with fewer cells than this are scored on one core. Starting threads costs more than a small matrix takes to score.
+PARALLEL_CELLS = 20000
+
+
+def ngrams(s: str, n: int = 3) -> set[str]:
+	'''Character n-grams of a lowercased, space padded string'''
+	s = f' {" ".join(s.lower().split())} '
+	return {s[i:i + n] for i in range(len(s) - n + 1)}
+
+
+class Matcher(object):
+	'''
+	Fuzzy matcher for a property catalog.
+	Candidates are pruned with a character trigram inverted index and only the best `max_candidates` of them are scored exactly with `fuzz.ratio`/`fuzz.partial_ratio`.
+	Trigrams shared by more than `stop_fraction` of the catalog (e.g. " th") say little about which pattern matches and are left out of the index.
+	Patterns without any indexed trigrams are always scored.
+	'''
+	def __init__(self, properties: list[tuple], threshold: int = 40, tie_break: str = 'longest', max_candidates: int = 64, stop_fraction: float = 0.01):
+		if tie_break not in TIE_BREAKS:
+			raise ValueError(f'tie_break must be one of {TIE_BREAKS}')
+		# (property, pattern, partial)
+		self.properties: list[tuple] = properties
+		self.threshold: int = threshold
+		self.tie_break: str = tie_break
+		self.max_candidates: int = max_candidates
+		self.partial: list[bool] = [bool(prow[2]) for prow in properties]
+		pattern_grams = [ngrams(prow[1]) if len(prow[1].strip()) >= 3 else set() for prow in properties]
+		# trigram -> indexes into `properties`
+		self.index: dict[str, list[int]] = {}
+		for i, grams in enumerate(pattern_grams):
+			for g in grams:
+				self.index.setdefault(g, []).append(i)
+		max_postings = max(64, int(len(properties) * stop_fraction))
+		self.stop_grams: set[str] = {g for g, postings in self.index.items() if len(postings) > max_postings}
+		for g in self.stop_grams:
+			del self.index[g]
+		self.gram_counts: list[int] = [len(grams - self.stop_grams) for grams in pattern_grams]
+		self.unindexed: list[int] = [i for i, c in enumerate(self.gram_counts) if c == 0]
+
+	def candidates(self, filename: str) -> list[int]:
+		'''Indexes of the properties most likely to score well, ranked by trigram overlap'''
+		query = ngrams(filename) - self.stop_grams
+		shared = Counter(chain.from_iterable(self.index.get(g, ()) for g in query))
+		# Partial patterns only need to be contained in the filename. Full patterns are compared both ways (Dice coefficient).
+		q = len(query)
+		overlap = {i: c / (self.gram_counts[i] if self.partial[i] else (self.gram_counts[i] + q) / 2) for i, c in shared.items()}
+		return nlargest(self.max_candidates, overlap, key=overlap.__getitem__) + self.unindexed
+
+	def score(self, filename: str, i: int) -> int:
+		prow = self.properties[i]
+		if prow[2]:
+			return fuzz.partial_ratio(filename, prow[1])
+		# Skip the exact score when the length difference alone keeps it under the threshold
+		if 200 * min(len(filename), len(prow[1])) <= self.threshold * (len(filename) + len(prow[1])):
+			return 0
+		return fuzz.ratio(filename, prow[1])
+
+	def rank_key(self, i: int, score: int) -> tuple:
+		if self.tie_break == 'longest':
+			return (-score, -len(self.properties[i][1]), i)
+		elif self.tie_break == 'shortest':
+			return (-score, len(self.properties[i][1]), i)
+		return (-score, i)
+
+	def top_k(self, filename: str, k: int = 1, exhaustive: bool = False) -> list[tuple[str, int]]:
+		'''Best `k` `(property, score)` pairs scoring above the threshold. `exhaustive` scores every property instead of just the candidates.'''
+		candidates = range(len(self.properties)) if exhaustive else self.candidates(filename)
+		scored = []
+		for i in candidates:
+			score = self.score(filename, i)
+			if score > self.threshold:
+				scored.append((self.rank_key(i, score), i, score))
+		scored.sort()
+		return [(self.properties[i][0], score) for _, i, score in scored[:k]]
+
+	def match(self, filename: str) -> Optional[tuple[str, int]]:
+		'''Best `(property, score)` for a cleaned filename. `None` if nothing scores above the threshold.'''
+		top = self.top_k(filename, 1)
+		return top[0] if top else None
+
+	def score_matrix(self, filenames: list[str], candidates: list[int]) -> list[list[int]]:
+		'''Score every filename against every candidate. Rows follow `filenames` and columns follow `candidates`.'''
+		if not cdist_ok:
+			return [[self.score(f, i) for i in candidates] for f in filenames]
+		matrix = [[0] * len(candidates) for _ in filenames]
+		for partial, scorer in ((False, rapid_fuzz.ratio), (True, rapid_fuzz.partial_ratio)):
+			columns = [c for c, i in enumerate(candidates) if self.partial[i] == partial]
+			if not columns:
+				continue
+			workers = -1 if len(filenames) * len(columns) >= PARALLEL_CELLS else 1
+			scores = cdist(filenames, [self.properties[candidates[c]][1] for c in columns], scorer=scorer, dtype=numpy.float64, workers=workers)
+			for r, row in enumerate(scores.tolist()):
+				for c, score in zip(columns, row):
+					# Same rounding as thefuzz
+					matrix[r][c] = int(round(score))
+		return matrix
+
+	def match_batch(self, filenames: list[str]) -> list[Optional[tuple[str, int]]]:
+		'''
+		Match many cleaned filenames at once (e.g. a season pack). Duplicates are only matched once.
+		Each filename is only scored against its own candidates. Filenames with the same candidates share a score matrix.
+		'''
+		groups: dict[tuple[int, ...], list[str]] = {}
+		for f in dict.fromkeys(filenames):
+			groups.setdefault(tuple(self.candidates(f)), []).append(f)
+		best: dict[str, Optional[tuple[str, int]]] = {}
+		for candidates, group in groups.items():
+			for f, row in zip(group, self.score_matrix(group, list(candidates))):
+				scored = [(self.rank_key(i, score), i, score) for i, score in zip(candidates, row) if score > self.threshold]
+				if scored:
+					_, i, score = min(scored)
+					best[f] = (self.properties[i][0], score)
+				else:
+					best[f] = None
+		return [best[f] for f in filenames]
+
+
+class MatchMemo(object):
+	'''
+	Bounded LRU memo of match results keyed on the name matched (the cleaned filename without season and episode numbers), for one catalog version at a time.
+	Optionally persisted to the `match_memo` table so it survives restarts. Entries for other catalog versions are dropped as soon as a new version is seen.
+	'''
+	def __init__(self, size: int = 10000, db: Optional[str] = None):
+		self.size: int = size
+		self.lock = threading.Lock()
+		# filename -> (property, score) or `None` if nothing matched
+		self.cache: OrderedDict[str, Optional[tuple[str, int]]] = OrderedDict()
+		self.version: Optional[str] = None
+		self.lconn = LockableSqliteConn(db) if db else None
+		self.hits: int = 0
+		self.misses: int = 0
+
+	def set_version(self, version: str) -> None:
+		'''Switch to a catalog version, invalidating everything memoized for other versions'''
+		if version == self.version:
+			return
+		self.cache.clear()
+		self.version = version
+		if self.lconn:
+			with self.lconn:
+				self.lconn.cur.execute('''DELETE FROM match_memo WHERE catalog_version != ?;''', (version,))
+				self.lconn.conn.commit()
+
+	def get_many(self, version: str, filenames: list[str]) -> dict[str, Optional[tuple[str, int]]]:
+		'''Look up memoized results. Filenames that aren't memoized are left out.'''
+		found: dict[str, Optional[tuple[str, int]]] = {}
+		with self.lock:
+			self.set_version(version)
+			missing = []
+			for f in filenames:
+				if f in self.cache:
+					self.cache.move_to_end(f)
+					found[f] = self.cache[f]
+				else:
+					missing.append(f)
+			if self.lconn and missing:
+				with self.lconn:
+					for f in missing:
+						self.lconn.cur.execute('''SELECT property, score FROM match_memo WHERE filename = ? AND catalog_version = ?;''', (f, version))
+						row = self.lconn.cur.fetchone()
+						if row:
+							found[f] = (row[0], row[1]) if row[0] is not None else None
+							self.remember(f, found[f])
+			# Per filename looked up, so a name repeated in a batch counts each time
+			hits = sum(1 for f in filenames if f in found)
+			self.hits += hits
+			self.misses += len(filenames) - hits
+		return found
+
+	def put_many(self, version: str, results: dict[str, Optional[tuple[str, int]]]) -> None:
+		with self.lock:
+			if version != self.version:
+				# The catalog changed while these were being matched
+				return
+			for f, match in results.items():
+				self.remember(f, match)
+			if self.lconn:
+				with self.lconn:
+					self.lconn.cur.executemany('''INSERT INTO match_memo (filename, catalog_version, property, score) VALUES (?, ?, ?, ?) ON CONFLICT(filename, catalog_version) DO UPDATE SET property = excluded.property, score = excluded.score;''', [(f, version, *(match or (None, None))) for f, match in results.items()])
+					self.lconn.conn.commit()
+
+	def remember(self, filename: str, match: Optional[tuple[str, int]]) -> None:
+		self.cache[filename] = match
+		self.cache.move_to_end(filename)
+		while len(self.cache) > self.size:
+			self.cache.popitem(last=False)
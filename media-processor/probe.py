@@ -0,0 +1,118 @@
+from collections import OrderedDict
+import json
+import logging
+import os
+import re
+from subprocess import run, PIPE, SubprocessError
+import threading
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+STREAM_TYPES = ['video', 'audio', 'subtitle']
+# Output args that need decoded frames, so a stream of that type can't be copied
+FILTER_ARGS = {
+	'video': {'-vf', '-filter:v', '-s', '-r', '-pix_fmt', '-aspect', '-vframes'},
+	'audio': {'-af', '-filter:a', '-ar', '-ac', '-aframes'},
+	'subtitle': set(),
+}
+ALL_FILTER_ARGS = {'-filter_complex', '-lavfi', '-filter'}
+
+# Muxers that write their output front to back, so it can go to a pipe. output_container -> muxer
+STREAM_MUXERS = {
+	'mkv': 'matroska',
+	'mka': 'matroska',
+	'webm': 'webm',
+	'ts': 'mpegts',
+	'flv': 'flv',
+	'nut': 'nut',
+	'ogg': 'ogg',
+}
+# Muxers that seek back to finish the file unless they are told to write fragments
+FRAGMENT_MUXERS = {
+	'mp4': 'mp4',
+	'm4v': 'mp4',
+	'mov': 'mov',
+}
+FRAGMENT_FLAGS = {'frag_keyframe', 'frag_every_frame', 'frag_custom', 'frag_duration', 'empty_moov'}
+
+probe_cache: OrderedDict[tuple, dict] = OrderedDict()
+probe_cache_size = 1024
+probe_lock = threading.Lock()
+
+
+def probe(path: str) -> Optional[dict]:
+	'''`ffprobe` JSON (streams and format) for a file. Cached by file identity. `None` if it can't be probed.'''
+	try:
+		stat = os.stat(path)
+	except FileNotFoundError:
+		return None
+	key = (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+	with probe_lock:
+		if key in probe_cache:
+			probe_cache.move_to_end(key)
+			return probe_cache[key]
+	try:
+		p = run(['ffprobe', '-v', 'quiet', '-print_format', 'json', '-show_streams', '-show_format', path], stdout=PIPE, check=True)
+		info = json.loads(p.stdout)
+	except (OSError, SubprocessError, ValueError) as e:
+		logger.warning(f'Could not probe {path} ({e}).')
+		return None
+	with probe_lock:
+		probe_cache[key] = info
+		while len(probe_cache) > probe_cache_size:
+			probe_cache.popitem(last=False)
+	return info
+
+
+def copy_args(path: str, copy_codecs: Optional[str], output_args: list[str]) -> tuple[list[str], str]:
+	'''
+	Work out which stream types can be copied instead of encoded.
+	A type is copied when every stream of that type in the source uses a codec from the property's comma separated `copy_codecs` and the output args don't filter it.
+	Returns the args to append after the output args (later codec options win in ffmpeg) and a description of the chosen path for the log.
+	'''
+	if not copy_codecs:
+		return ([], 'encode (no copy codecs set)')
+	if ALL_FILTER_ARGS.intersection(output_args):
+		return ([], 'encode (filter graph in output args)')
+	info = probe(path)
+	if not info:
+		return ([], 'encode (probe failed)')
+	allowed = {c.strip().lower() for c in copy_codecs.split(',') if c.strip()}
+	streams: dict[str, list[str]] = {t: [] for t in STREAM_TYPES}
+	for stream in info.get('streams', []):
+		codec_type = stream.get('codec_type')
+		if codec_type not in streams or stream.get('disposition', {}).get('attached_pic'):
+			continue
+		streams[codec_type].append(stream.get('codec_name', '').lower())
+	copied: list[str] = []
+	encoded: list[str] = []
+	for codec_type, codecs in streams.items():
+		if not codecs:
+			continue
+		if allowed.issuperset(codecs) and not FILTER_ARGS[codec_type].intersection(output_args):
+			copied.append(codec_type)
+		else:
+			encoded.append(codec_type)
+	args = [a for codec_type in copied for a in (f'-c:{codec_type[0]}', 'copy')]
+	if not copied:
+		return (args, 'encode')
+	elif not encoded:
+		return (args, 'remux (copy all streams)')
+	return (args, f'mixed (copy {", ".join(copied)}, encode {", ".join(encoded)})')
+
+
+def stream_format(container: str, output_args: list[str]) -> Optional[str]:
+	'''
+	The muxer to give ffmpeg (`-f`) when writing `container` to a pipe, or `None` if the output needs seeking and must be written to a file.
+	mp4 and mov only stream when `-movflags` asks for fragments.
+	'''
+	container = container.lower()
+	if container in STREAM_MUXERS:
+		return STREAM_MUXERS[container]
+	if container in FRAGMENT_MUXERS:
+		for i, arg in enumerate(output_args[:-1]):
+			# `+flag` and bare names set a flag, `-flag` clears it
+			if arg == '-movflags' and FRAGMENT_FLAGS.intersection(f for sign, f in re.findall(r'([+-]?)(\w+)', output_args[i + 1]) if sign != '-'):
+				return FRAGMENT_MUXERS[container]
+	return None
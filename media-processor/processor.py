@@ -1,97 +1,439 @@
+import json
 import logging
 import os
-from queue import Queue
 import re
 import shlex
-from subprocess import Popen, PIPE, SubprocessError
-from thefuzz import fuzz
+from sqlite3 import OperationalError
+from subprocess import Popen, PIPE
 import threading
-from typing import Iterable, Optional, Pattern
+import time
+from typing import Callable, IO, Optional, Pattern
 
 try:
-	from paramiko import SSHClient, AutoAddPolicy
 	from paramiko.ssh_exception import SSHException
 	sftp_ok = True
 except ImportError:
 	sftp_ok = False
 
-from db import LockableSqliteConn
+from cache import cache_key, destination_of, fingerprint, lookup_result, record_result, unchanged
+from catalog import PropertyCatalog
+from db import LockableSqliteConn, STAGE_STATES, advance_job, claim_job, claim_jobs, destination_heads, enqueue_job, fail_job, heartbeat_job, job_counts, leased_jobs, release_job
+from deliver import deliver, link_or_copy
+from history import JobHistory
+from inotify import Inotify, InotifyError, inotify_ok, IN_CLOSE_WRITE, IN_CREATE, IN_DELETE_SELF, IN_ISDIR, IN_MOVED_FROM, IN_MOVED_TO, IN_Q_OVERFLOW
+from probe import copy_args, probe, stream_format
+from progress import JobMetrics, Progress
+from scanner import Snapshot, TreeScanner
+from scheduler import TranscodeScheduler
+from segment import SegmentPlan, count_segments
+from sftp_pool import SftpConnection, SftpPool
+from sftp_upload import StreamUpload, upload
+from transfer_scheduler import TransferScheduler
 
 logger = logging.getLogger(__name__)
 
-processing_queue = Queue(0)
 event = threading.Event()
-processing_lock = threading.Lock()
+# Notified whenever jobs change state so idle stage threads don't wait for their next poll
+job_ready = threading.Condition()
+# How long (seconds) a claimed job stays leased to a stage thread without a heartbeat
+LEASE_TIME = 60.0
+# How often (seconds) running jobs renew their lease and publish progress
+PROGRESS_INTERVAL = 5.0
+# Progress of running transcodes. job id -> metrics
+metrics: dict[int, JobMetrics] = {}
+metrics_lock = threading.Lock()
+# How often (seconds) the job history recorded by the threads is written to the DB
+HISTORY_INTERVAL = 5.0
+history = JobHistory()
 
 def kill() -> None:
 	'''Set flag to kill all threads'''
 	event.set()
+	wake()
 
-def full_scan_dir(baseDir: str) -> Iterable[str]:
-	'''Recursively scan a dir to get all file absolute paths'''
-	for entry in os.scandir(baseDir):
-		if entry.is_file():
-			yield os.path.join(baseDir, entry.name)
-		else:
-			yield from full_scan_dir(entry.path)
+def wake() -> None:
+	'''Wake idle stage threads'''
+	with job_ready:
+		job_ready.notify_all()
+
+def index_row(path: str, stat: os.stat_result) -> tuple:
+	'''Build a `scan_index` row'''
+	return (path, stat.st_ino, stat.st_size, stat.st_mtime, stat.st_ctime)
+
+def open_for_write(paths: set[str]) -> set[str]:
+	'''Return the subset of `paths` that some local process has open for writing. Always empty where `/proc` isn't available.'''
+	busy: set[str] = set()
+	try:
+		pids = [pid for pid in os.listdir('/proc') if pid.isdigit()]
+	except FileNotFoundError:
+		return busy
+	for pid in pids:
+		fd_dir = f'/proc/{pid}/fd'
+		try:
+			fds = os.listdir(fd_dir)
+		except (FileNotFoundError, PermissionError, ProcessLookupError):
+			continue
+		for fd in fds:
+			try:
+				target = os.readlink(os.path.join(fd_dir, fd))
+				if target not in paths or target in busy:
+					continue
+				with open(f'/proc/{pid}/fdinfo/{fd}') as f:
+					for line in f:
+						if line.startswith('flags:'):
+							if int(line.split()[1], 8) & os.O_ACCMODE != os.O_RDONLY:
+								busy.add(target)
+							break
+			except (FileNotFoundError, PermissionError, ProcessLookupError):
+				continue
+	return busy
 
 
 class WatcherThread(threading.Thread):
-	def __init__(self, watch_folder: str, sleep_time: float):
+	def __init__(self, watch_folder: str, sleep_time: float, backend: str = 'auto', settle_time: float = 10.0, scan_workers: int = 8, rescan_interval: float = 60.0):
 		threading.Thread.__init__(self)
-		self.watch_folder: str = watch_folder
+		self.watch_folder: str = os.path.normpath(watch_folder)
 		self.sleep_time: float = sleep_time * 60
+		# Seconds between the full consistency scans while inotify is in use
+		self.rescan_interval: float = rescan_interval * 60
+		self.settle_time: float = settle_time
+		# Files waiting to finish being written. path -> [size, mtime_ns, stable since, found at (wall clock)]
+		self.pending: dict[str, list] = {}
 		self.name = 'Watcher Thread'
-		# Initialize last_files.
-		self.last_files: set[tuple] = set()
-		for entry in full_scan_dir(self.watch_folder):
-			stat = os.stat(entry)
-			ctime=stat.st_ctime
-			self.last_files.add((entry, ctime))
+		self.scanner = TreeScanner(self.watch_folder, scan_workers)
+		self.lconn = LockableSqliteConn('db.sqlite3')
+		# Scan index changes waiting to be written. path -> row, or `None` to delete
+		self.index_updates: dict[str, Optional[tuple]] = {}
+		# Initialize the scanner's snapshot. Restore it from the scan index if there is one so files that arrived while stopped show up as new.
+		if not self.load_index():
+			for row in self.scanner.scan()[0]:
+				self.index_updates[row[0]] = row
+			self.index_updates[self.watch_folder] = index_row(self.watch_folder, os.stat(self.watch_folder))
+			self.flush_index()
+		# Event driven backend. The polling scan is kept as a fallback and as a consistency check every `rescan_interval`.
+		self.notifier: Optional[Inotify] = None
+		# With `backend` set to `inotify` there is no fallback. An `InotifyError` is raised if inotify can't be used.
+		if backend != 'poll':
+			if inotify_ok:
+				try:
+					self.notifier = Inotify()
+					for _ in self.notifier.add_tree(self.watch_folder):
+						pass
+				except OSError as e:
+					self.close_notifier()
+					if backend == 'inotify':
+						raise InotifyError(f'Could not set up inotify on {self.watch_folder} ({e}).') from e
+					logger.warning(f'Could not set up inotify on {self.watch_folder} ({e}). Falling back to polling.')
+			elif backend == 'inotify':
+				raise InotifyError('inotify is not available on this system.')
+			else:
+				logger.warning('inotify is not available. Falling back to polling.')
+
+	def close_notifier(self) -> None:
+		if self.notifier:
+			self.notifier.close()
+			self.notifier = None
+
+	def load_index(self) -> bool:
+		'''Load the persisted scan index for the watch folder into the scanner's snapshot. Returns `False` if the watch folder has never been indexed.'''
+		prefix = os.path.join(self.watch_folder, '')
+		with self.lconn:
+			self.lconn.cur.execute('''SELECT 1 FROM scan_index WHERE path = ?;''', (self.watch_folder,))
+			if not self.lconn.cur.fetchone():
+				return False
+			# Range query on the primary key instead of LIKE so the index is used. '0' sorts right after '/'.
+			self.lconn.cur.execute('''SELECT path, ctime FROM scan_index WHERE path >= ? AND path < ?;''', (prefix, prefix[:-1] + '0'))
+			self.scanner.snapshot = Snapshot.from_rows(self.lconn.cur)
+		logger.info(f'Loaded {len(self.scanner.snapshot)} files from the scan index.')
+		return True
+
+	def flush_index(self) -> None:
+		'''Write pending scan index changes. They are kept for the next flush if the DB is busy.'''
+		if not self.index_updates:
+			return
+		upserts = [row for row in self.index_updates.values() if row]
+		deletes = [(path,) for path, row in self.index_updates.items() if not row]
+		with self.lconn:
+			try:
+				self.lconn.cur.executemany('''INSERT INTO scan_index (path, inode, size, mtime, ctime) VALUES (?, ?, ?, ?, ?) ON CONFLICT(path) DO UPDATE SET inode = excluded.inode, size = excluded.size, mtime = excluded.mtime, ctime = excluded.ctime;''', upserts)
+				self.lconn.cur.executemany('''DELETE FROM scan_index WHERE path = ?;''', deletes)
+				self.lconn.conn.commit()
+			except OperationalError as e:
+				self.lconn.conn.rollback()
+				logger.warning(f'Could not update the scan index ({e}). Retrying later.')
+				return
+		self.index_updates.clear()
 
 	def is_video(self, filename: str) -> bool:
 		'''Returns `True` if this is a video file. `False` otherwise.'''
-		return filename.rsplit('.', 1)[1].lower() in ['mp4', 'mkv', 'avi',
+		split = filename.rsplit('.', 1)
+		return len(split) > 1 and split[1].lower() in ['mp4', 'mkv', 'avi',
 			'webm', '264', 'mpeg', 'mpv', 'm2ts', '3gp2', 'flv', 'mp4v',
 			'm4v', 'mts', 'mov', 'h264', 'hevc', 'h265', 'wmv']
 
+	def discover(self, path: str) -> None:
+		'''Start settling a single file unless the current version of it has already been seen.'''
+		try:
+			stat = os.stat(path)
+		except FileNotFoundError:
+			return
+		if self.scanner.snapshot.get(path) == stat.st_ctime:
+			return
+		self.scanner.snapshot.add(path, stat.st_ctime)
+		if self.is_video(path):
+			self.pending.setdefault(path, [-1, -1, time.monotonic(), time.time()])
+		else:
+			self.index_updates[path] = index_row(path, stat)
+
+	def scan(self) -> None:
+		'''Full polling scan. Start settling anything that is new or changed since the last scan.'''
+		added, removed = self.scanner.scan()
+		for row in added:
+			if self.is_video(row[0]):
+				# Indexed once it settles. Until then a restart will pick it up again.
+				self.pending.setdefault(row[0], [-1, -1, time.monotonic(), time.time()])
+			else:
+				self.index_updates[row[0]] = row
+		for path in removed:
+			self.index_updates[path] = None
+		self.flush_index()
+
+	def settle(self) -> None:
+		'''
+		Queue pending files as jobs once they are done being written.
+		A file is done when its size and mtime haven't changed for `settle_time` seconds and no local process has it open for writing.
+		'''
+		if not self.pending:
+			return
+		now = time.monotonic()
+		# In the order the files were found (`pending` keeps it), so files copied in together are queued in that order
+		candidates: list[str] = []
+		for path, state in list(self.pending.items()):
+			try:
+				stat = os.stat(path)
+			except FileNotFoundError:
+				# Moved away or deleted before it settled
+				del self.pending[path]
+				continue
+			if stat.st_size != state[0] or stat.st_mtime_ns != state[1]:
+				self.pending[path] = [stat.st_size, stat.st_mtime_ns, now, state[3]]
+			elif now - state[2] >= self.settle_time:
+				candidates.append(path)
+		if not candidates:
+			return
+		busy = open_for_write(set(candidates))
+		for path in candidates:
+			if path in busy:
+				self.pending[path][2] = now
+				continue
+			try:
+				# Remember the settled version so later scans (and restarts) don't pick it up again
+				stat = os.stat(path)
+				job_id = enqueue_job(self.lconn, path)
+			except FileNotFoundError:
+				del self.pending[path]
+				continue
+			except OperationalError as e:
+				logger.warning(f'Could not queue {path} ({e}). Retrying later.')
+				continue
+			if job_id:
+				history.record(job_id, 'scan', 'done', self.pending[path][3], input_size=stat.st_size)
+			del self.pending[path]
+			self.scanner.snapshot.add(path, stat.st_ctime)
+			self.index_updates[path] = index_row(path, stat)
+			wake()
+
+	def handle_events(self, events: list[tuple[str, int]]) -> bool:
+		'''Handle inotify events. Returns `True` if events were lost and a full scan is needed.'''
+		rescan = False
+		for path, mask in events:
+			if mask & IN_Q_OVERFLOW:
+				logger.warning('inotify event queue overflowed. Running a full scan.')
+				rescan = True
+			elif mask & IN_ISDIR:
+				if mask & (IN_CREATE | IN_MOVED_TO):
+					# Files can land in a new directory before the watch on it exists
+					try:
+						for f in self.notifier.add_tree(path):
+							self.discover(f)
+					except OSError as e:
+						logger.warning(f'Could not watch {path} ({e}). Running a full scan.')
+						rescan = True
+				elif mask & IN_MOVED_FROM:
+					self.notifier.remove_tree(path)
+			elif mask & (IN_CREATE | IN_CLOSE_WRITE | IN_MOVED_TO):
+				self.discover(path)
+			elif mask & IN_DELETE_SELF and path == self.watch_folder:
+				rescan = True
+		return rescan
+
 	def run(self) -> None:
 		'''Watcher thread main function.'''
 		print('Watcher thread started.')
 		while not event.is_set():
 			if not os.path.exists(self.watch_folder):
 				os.makedirs(self.watch_folder)
-			new_scan: set[tuple] = set()
-			for entry in full_scan_dir(self.watch_folder):
-				stat = os.stat(entry)
-				ctime=stat.st_ctime
-				new_scan.add((entry, ctime))
-			new_files = new_scan - self.last_files
-			for f in new_files:
-				if self.is_video(f[0]):
-					processing_queue.put(f[0])
-			self.last_files = new_scan
-			event.wait(timeout=self.sleep_time)
-
-
-class ProcessorThread(threading.Thread):
-	def __init__(self, process_folder: str, clean_regex: Pattern[str], season_episode_regex: Pattern[str], episode_regex: Pattern[str], known_hosts: Optional[str], private_key_loc: Optional[str], private_key_pass: Optional[str], tid: int):
+			if self.notifier and not self.notifier.watches:
+				# The watch folder was removed (and possibly recreated) so its watches are gone
+				for f in self.notifier.add_tree(self.watch_folder):
+					self.discover(f)
+			self.scan()
+			# Wait until the next scan is due. With inotify it is only a consistency check, so it runs much less often. Short waits keep settling and shutdown responsive.
+			deadline = time.monotonic() + (self.rescan_interval if self.notifier else self.sleep_time)
+			while not event.is_set():
+				self.settle()
+				self.flush_index()
+				remaining = deadline - time.monotonic()
+				if remaining <= 0:
+					break
+				if self.notifier:
+					if self.handle_events(self.notifier.read_events(min(remaining, 1.0))):
+						break
+				else:
+					event.wait(timeout=min(remaining, 1.0) if self.pending else remaining)
+		self.close_notifier()
+
+
+class StatusThread(threading.Thread):
+	'''Writes the stage queue depths, the progress of running transcodes and per destination transfer throughput to a JSON status file every `PROGRESS_INTERVAL` seconds'''
+	def __init__(self, status_file: str, transfers: Optional[TransferScheduler] = None):
 		threading.Thread.__init__(self)
-		self.process_folder: str = process_folder
+		self.name = 'Status Thread'
+		self.status_file: str = status_file
+		self.transfers = transfers
+		self.lconn = LockableSqliteConn('db.sqlite3')
+
+	def write(self) -> None:
+		with metrics_lock:
+			running = [m.snapshot() for m in metrics.values()]
+		status = {'time': time.time(), 'queues': job_counts(self.lconn, STAGE_STATES), 'transcoding': running}
+		if self.transfers:
+			status['destinations'] = self.transfers.snapshot()
+		# Write then rename so readers never see a partial file
+		tmp_path = self.status_file + '.tmp'
+		with open(tmp_path, 'w') as f:
+			json.dump(status, f, indent='\t')
+		os.replace(tmp_path, self.status_file)
+
+	def run(self) -> None:
+		'''Status thread main function'''
+		while not event.is_set():
+			try:
+				self.write()
+			except (OSError, OperationalError) as e:
+				logger.warning(f'Could not write status file {self.status_file} ({e}).')
+			event.wait(timeout=PROGRESS_INTERVAL)
+
+
+class HistoryThread(threading.Thread):
+	'''Writes the job history recorded by the other threads to the DB in one transaction every `HISTORY_INTERVAL` seconds'''
+	def __init__(self):
+		threading.Thread.__init__(self)
+		self.name = 'History Thread'
+		self.lconn = LockableSqliteConn('db.sqlite3')
+
+	def run(self) -> None:
+		'''History thread main function'''
+		while not event.is_set():
+			event.wait(timeout=HISTORY_INTERVAL)
+			try:
+				history.flush(self.lconn)
+			except OperationalError as e:
+				logger.warning(f'Could not write job history ({e}). Retrying later.')
+
+
+class JobThread(threading.Thread):
+	'''
+	Base for the pipeline stages. Each stage claims jobs in its `state` from the `jobs` table and hands them to the next stage by advancing their state.
+	Claimed jobs are leased to the thread and the lease is renewed while the job runs, so jobs held by a thread that died are picked up again once the lease expires.
+	'''
+	state: str = ''
+	# Name of the stage in the job history
+	stage: str = ''
+
+	def __init__(self, name: str, max_attempts: int):
+		threading.Thread.__init__(self)
+		self.name = name
+		self.max_attempts: int = max_attempts
+		self.lconn = LockableSqliteConn('db.sqlite3')
+		self.last_heartbeat: float = 0.0
+		# When the current jobs were claimed (wall clock)
+		self.started: float = 0.0
+		# Destination server of the current job for stages that deliver it (`''` for local folders), for the job history
+		self.destination: Optional[str] = None
+		# Progress of the current job, if it reports any
+		self.metrics: Optional[JobMetrics] = None
+
+	def heartbeat(self, job_id: int, force: bool = False) -> None:
+		'''Renew a job's lease and save its progress. Only touches the DB every `PROGRESS_INTERVAL` unless `force`.'''
+		now = time.monotonic()
+		if not force and now - self.last_heartbeat < PROGRESS_INTERVAL:
+			return
+		try:
+			heartbeat_job(self.lconn, job_id, LEASE_TIME, json.dumps(self.metrics.snapshot()) if self.metrics else None)
+			self.last_heartbeat = now
+		except OperationalError as e:
+			logger.warning(f'Could not renew the lease on job {job_id} ({e}).')
+
+	def fail(self, job_id: int, item: str, error: str, retry: bool = True) -> None:
+		if fail_job(self.lconn, job_id, error, self.max_attempts, retry=retry):
+			logger.warning(f'{error} Job {job_id} ({item}) will be retried.')
+			history.record(job_id, self.stage, 'retry', self.started, server=self.destination, error=error)
+		else:
+			logger.error(f'{error} Job {job_id} ({item}) failed.')
+			history.record(job_id, self.stage, 'failed', self.started, server=self.destination, error=error)
+
+	def claim(self) -> list[tuple]:
+		return claim_jobs(self.lconn, self.state, self.name, 1, LEASE_TIME)
+
+	def work(self, jobs: list[tuple]) -> None:
+		raise NotImplementedError
+
+	def run(self) -> None:
+		'''Stage thread main function'''
+		print(f'{self.name} started.')
+		while not event.is_set():
+			try:
+				jobs = self.claim()
+				if jobs:
+					self.last_heartbeat = time.monotonic()
+					self.started = time.time()
+					try:
+						self.work(jobs)
+					except OperationalError:
+						raise
+					except Exception as e:
+						# A bug or bad data in one job mustn't take the thread down, or the next thread to claim the job would die the same way
+						logger.exception(f'{self.name} failed unexpectedly.')
+						items = {job[0]: job[1] for job in jobs}
+						for job_id in leased_jobs(self.lconn, list(items), self.name):
+							self.fail(job_id, items[job_id], f'Unexpected error ({type(e).__name__}: {e}).')
+					# The next stage has work and this one has room
+					wake()
+					continue
+			except OperationalError as e:
+				# The lease runs out and the job is picked up again
+				logger.warning(f'Job queue error ({e}).')
+			# Idle or the next stage is full. Jobs whose backoff ran out are only noticed by polling.
+			with job_ready:
+				if not event.is_set():
+					job_ready.wait(timeout=1.0)
+
+
+class MatchThread(JobThread):
+	'''Matches queued files to properties in batches. Stops matching while `queue_size` matched jobs are already waiting for a transcode.'''
+	state = 'queued'
+	stage = 'match'
+
+	def __init__(self, clean_regex: Pattern[str], season_episode_regex: Pattern[str], episode_regex: Pattern[str], catalog: PropertyCatalog, batch_size: int, queue_size: int, max_attempts: int):
+		JobThread.__init__(self, 'Match Thread', max_attempts)
 		self.clean_regex: Pattern[str] = clean_regex
 		self.season_episode_regex: Pattern[str] = season_episode_regex
 		self.episode_regex: Pattern[str] = episode_regex
-		self.known_hosts: Optional[str] = known_hosts
-		self.private_key_loc: Optional[str] = private_key_loc
-		self.private_key_pass: Optional[str] = private_key_pass
-		self.tid = tid
-		self.name = f'Processor Thread {tid}'
-		self.lconn = LockableSqliteConn('db.sqlite3')
-		self.ssh_client = SSHClient()
-		if self.known_hosts:
-			self.ssh_client.load_host_keys(self.known_hosts)
-		else:
-			self.ssh_client.set_missing_host_key_policy(AutoAddPolicy())
+		self.catalog = catalog
+		self.batch_size: int = batch_size
+		self.queue_size: int = queue_size
+		self.depths: dict[str, int] = {}
 
 	def clean_filename(self, filename: str) -> str:
 		'''
@@ -101,102 +443,439 @@ class ProcessorThread(threading.Thread):
 		'''
 		return re.sub(self.clean_regex, '', filename).replace('.', ' ').replace('_', ' ').strip()
 
-	def run(self) -> None:
-		'''Processor thread main function'''
-		print(f'Processor thread {self.tid} started.')
-		while not event.is_set():
-			if processing_queue.empty():
-				event.wait(timeout=5.0)
+	def match_key(self, filename: str) -> str:
+		'''
+		What a cleaned filename is matched and memoized on: the filename without its season and episode numbers, so every episode of a show shares one match.
+		Like when naming the output, the episode regex is only used if the season and episode regex finds nothing.
+		'''
+		key = re.sub(self.season_episode_regex, '', filename)
+		if key == filename:
+			key = re.sub(self.episode_regex, '', filename)
+		return ' '.join(key.split()) or filename
+
+	def claim(self) -> list[tuple]:
+		depths = job_counts(self.lconn, STAGE_STATES)
+		if depths != self.depths:
+			self.depths = depths
+			logger.info(f'Queue depths: {", ".join(f"{state} {depths.get(state, 0)}" for state in STAGE_STATES)}')
+		room = self.queue_size - job_counts(self.lconn, ['transcoding'], waiting=True).get('transcoding', 0)
+		if room <= 0:
+			return []
+		# Jobs left in `probing` by a match that errored or stopped heartbeating, once their lease (or retry backoff) runs out
+		jobs = claim_jobs(self.lconn, 'probing', self.name, min(self.batch_size, room), LEASE_TIME)
+		return jobs or claim_jobs(self.lconn, self.state, self.name, min(self.batch_size, room), LEASE_TIME, 'probing')
+
+	def work(self, jobs: list[tuple]) -> None:
+		'''Match a batch of queued jobs in one pass. Jobs with a matching property that has settings move on to `transcoding`.'''
+		filenames = [self.clean_filename(os.path.basename(job[1]).rsplit('.', 1)[0]) for job in jobs]
+		# The full filename is kept for naming the output
+		for job, filename, match in zip(jobs, filenames, self.catalog.match_batch([self.match_key(f) for f in filenames])):
+			job_id, item = job[0], job[1]
+			logger.info(f'Starting processing of {item}')
+			if not match:
+				self.fail(job_id, item, 'No properties that are close enough.', retry=False)
+				continue
+			logger.info(f'Matched {item} to {match[0]} (score {match[1]})')
+			if not self.catalog.get_settings(match[0]):
+				self.fail(job_id, item, f'Missing settings for {match[0]}.', retry=False)
+				continue
+			advance_job(self.lconn, job_id, 'transcoding', property=match[0], filename=filename)
+			history.record(job_id, self.stage, 'done', self.started, property=match[0])
+		logger.info(f'Match memo: {self.catalog.memo.hits} hits, {self.catalog.memo.misses} misses')
+
+
+class TranscodeThread(JobThread):
+	'''
+	Transcodes matched files into the process folder. Stops taking jobs while `queue_size` transcoded files are already waiting for a transfer.
+	With `stream_uploads`, files for SFTP destinations in a container that can be written front to back are uploaded as ffmpeg produces them instead, and skip the transfer stage.
+	A streamed upload takes one of its destination's transfer slots from `transfers`, and is written to the process folder if none is free.
+	'''
+	state = 'transcoding'
+	stage = 'transcode'
+
+	def __init__(self, process_folder: str, season_episode_regex: Pattern[str], episode_regex: Pattern[str], catalog: PropertyCatalog, scheduler: TranscodeScheduler, sftp_pool: SftpPool, transfers: TransferScheduler, stream_uploads: bool, queue_size: int, stall_timeout: float, max_attempts: int, tid: int):
+		JobThread.__init__(self, f'Transcode Thread {tid}', max_attempts)
+		self.process_folder: str = process_folder
+		self.season_episode_regex: Pattern[str] = season_episode_regex
+		self.episode_regex: Pattern[str] = episode_regex
+		self.catalog = catalog
+		self.scheduler = scheduler
+		self.sftp_pool = sftp_pool
+		self.transfers = transfers
+		self.stream_uploads: bool = stream_uploads
+		self.queue_size: int = queue_size
+		self.stall_timeout: float = stall_timeout
+
+	def claim(self) -> list[tuple]:
+		# Transcoded files take up space in the process folder until they are transferred
+		if job_counts(self.lconn, ['transferring'], waiting=True).get('transferring', 0) >= self.queue_size:
+			return []
+		return JobThread.claim(self)
+
+	def work(self, jobs: list[tuple]) -> None:
+		'''Transcode a matched file into the process folder and hand it to the transfer stage'''
+		job_id, item, _, _, _, topMatch, filename, _, _ = jobs[0]
+		row = self.catalog.get_settings(topMatch)
+		if not row:
+			self.fail(job_id, item, f'Missing settings for {topMatch}.', retry=False)
+			return
+		if not os.path.exists(item):
+			self.fail(job_id, item, 'Source file is gone.', retry=False)
+			return
+		if not os.path.exists(self.process_folder):
+			os.makedirs(self.process_folder)
+		try:
+			input_args = [a.strip() for a in shlex.split(row[0] or '')]
+			output_args = [a.strip() for a in shlex.split(row[1])]
+		except ValueError as e:
+			# Retrying won't help until the settings are fixed
+			self.fail(job_id, item, f'Could not parse the ffmpeg args of {topMatch} ({e}).', retry=False)
+			return
+		modifiers = ''
+		if row[6]:
+			# is show
+			season_episode = re.search(self.season_episode_regex, filename)
+			if season_episode:
+				modifiers = f' {season_episode.group().upper()}'
+			elif row[7]:
+				season_episode = re.search(self.episode_regex, filename)
+				if season_episode:
+					modifiers = f' S{int(row[7]):02}E{int(season_episode.group().replace(" ", "").replace("-", "").replace("e", "")):02}'
+		tmp_output_path = os.path.join(self.process_folder, topMatch + modifiers + '.' + row[2])
+		try:
+			key = cache_key(fingerprint(item), row)
+		except OSError as e:
+			logger.warning(f'Could not fingerprint {item} ({e}).')
+			key = None
+		if key and self.reuse(job_id, item, key, row, tmp_output_path):
+			return
+		stream_args, path = copy_args(item, row[8], output_args)
+		logger.info(f'Using {path} path for {item}')
+		info = probe(item)
+		cost, wanted = self.scheduler.estimate(info, path.startswith('remux'))
+		segments = count_segments(info, row[9], input_args, output_args, stream_args)
+		if segments > 1:
+			wanted = max(wanted, segments)
+		# Keep the lease alive while waiting to be admitted
+		cores = None
+		while cores is None and not event.is_set():
+			self.heartbeat(job_id, force=True)
+			cores = self.scheduler.acquire(wanted, event, LEASE_TIME / 3)
+		if cores is None:
+			# Shutting down. Leave it for the next run.
+			release_job(self.lconn, job_id)
+			return
+		destination = os.path.join(row[3], os.path.basename(tmp_output_path))
+		muxer = self.stream_muxer(row, output_args) if segments <= 1 else None
+		connection = self.stream_session(row) if muxer else None
+		if connection:
+			output = ['-f', muxer, 'pipe:1'] if '-f' not in output_args else ['pipe:1']
+		else:
+			output = [tmp_output_path]
+		s_args = ['ffmpeg', '-y', *input_args, '-i', item, *output_args, *stream_args, '-threads', str(len(cores)), '-v', 'quiet', *output]
+		duration = float((info or {}).get('format', {}).get('duration') or 0)
+		size = 0
+		try:
+			returncode: Optional[int] = 1
+			if connection:
+				logger.info(f'Transcoding {item} on cores {cores} and streaming it to {destination_of(row, os.path.basename(destination))} (estimated cost {cost:.3g} pixel seconds)')
+				self.track(JobMetrics(job_id, item, duration))
+				returncode, size = self.run_streamed(job_id, s_args, cores, row[4], connection, destination)
+			elif segments > 1:
+				plan = SegmentPlan(item, input_args, output_args, stream_args, tmp_output_path, info, segments)
+				logger.info(f'Transcoding {item} as {segments} segments on cores {cores} (estimated cost {cost:.3g} pixel seconds)')
+				self.track(JobMetrics(job_id, item, duration))
+				returncode = self.run_segments(job_id, plan, cores)
+				if returncode:
+					logger.warning(f'Segmented transcode of {item} failed. Falling back to a single pass.')
+			if returncode and not connection:
+				logger.info(f'Transcoding {item} on cores {cores} (estimated cost {cost:.3g} pixel seconds)')
+				self.track(JobMetrics(job_id, item, duration))
+				returncode = self.run_commands(job_id, [s_args], [cores])
+		except OSError as e:
+			self.fail(job_id, item, f'Error executing command {s_args}: {e}.')
+			return
+		finally:
+			self.scheduler.release(cores)
+			stats = self.track(None)
+		if returncode is None:
+			# Shutting down. Leave it for the next run.
+			release_job(self.lconn, job_id)
+			if os.path.exists(tmp_output_path):
+				os.remove(tmp_output_path)
+			return
+		if returncode != 0:
+			self.fail(job_id, item, f'Command {s_args} exited with {returncode}.')
+			return
+		logger.info(f'Transcoded {item} in {stats["elapsed"]}s at {stats["speed"]}x ({stats["frames"]} frames, {stats["size"]} bytes)')
+		input_size = int((info or {}).get('format', {}).get('size') or 0) or None
+		if connection:
+			advance_job(self.lconn, job_id, 'done', progress=json.dumps(stats), cache_key=key)
+			history.record(job_id, self.stage, 'done', self.started, topMatch, row[4], input_size, size, stats['speed'], shlex.join(s_args))
+			if key:
+				record_result(self.lconn, key, job_id, destination_of(row, os.path.basename(destination)), None, size)
+			logger.info(f'Finished processing {item}')
+			return
+		advance_job(self.lconn, job_id, 'transferring', output_path=tmp_output_path, progress=json.dumps(stats), cache_key=key)
+		history.record(job_id, self.stage, 'done', self.started, topMatch, None, input_size, os.path.getsize(tmp_output_path), stats['speed'], shlex.join(s_args))
+
+	def stream_muxer(self, row: tuple, output_args: list[str]) -> Optional[str]:
+		'''The muxer to stream a job's output to its SFTP destination with, or `None` if it has to be written to the process folder'''
+		if not self.stream_uploads or not row[4] or not sftp_ok:
+			return None
+		if not row[5] and not self.sftp_pool.private_key_loc:
+			# The transfer stage reports this
+			return None
+		return stream_format(row[2], output_args)
+
+	def stream_session(self, row: tuple) -> Optional[SftpConnection]:
+		'''A pooled session to stream to, along with a transfer slot, or `None` to write to the process folder instead of waiting for either'''
+		if not self.transfers.try_acquire(row[4]):
+			return None
+		try:
+			connection = self.sftp_pool.acquire(row[4], row[5], wait=False)
+		except (SSHException, EOFError, OSError) as e:
+			logger.warning(f'Could not open an SFTP session to {row[4]} ({e}). Transcoding to the process folder instead.')
+			connection = None
+		if not connection:
+			self.transfers.release(row[4], False)
+		return connection
+
+	def run_streamed(self, job_id: int, command: list[str], cores: list[int], user_at_ip: str, connection: SftpConnection, destination: str) -> tuple[Optional[int], int]:
+		'''
+		Run an ffmpeg command that writes to stdout, uploading its output to `destination` over `connection` as it is produced. Gives the session back to the pool and the transfer slot back to `transfers` when done.
+		Returns the exit code like `run_commands` and the size uploaded. Raises `IOError` if the upload failed.
+		'''
+		stream = StreamUpload(connection.sftp, destination, lambda sent, total: self.heartbeat(job_id), lambda n: self.transfers.throttle(user_at_ip, n, event))
+		try:
+			returncode = self.run_commands(job_id, [command], [cores], output=stream.start)
+			if returncode != 0:
+				stream.abort()
+				if stream.error:
+					# ffmpeg failed because the upload did
+					raise stream.error
+				size = 0
 			else:
-				if not os.path.exists(self.process_folder):
-					os.makedirs(self.process_folder)
-				with processing_lock:
-					item = processing_queue.get()
-
-				logger.info(f'Starting processing of {item}')
-
-				filename = os.path.basename(item).rsplit('.', 1)
-				ext = filename[1]
-				filename = self.clean_filename(filename[0])
-
-				row = None
-				with self.lconn:
-					self.lconn.cur.execute('''SELECT property, pattern, partial FROM properties;''')
-					rows = self.lconn.cur.fetchall()
-					topMatch = None
-					topScore = -1
-					for prow in rows:
-						if prow[2]:
-							score = fuzz.partial_ratio(filename, prow[1])
-						else:
-							score = fuzz.ratio(filename, prow[1])
-						if score > 40 and score > topScore:
-							topMatch = prow[0]
-					if topMatch:
-						logger.info(f'Matched {item} to {topMatch}')
-						self.lconn.cur.execute('''SELECT ps.ffmpeg_input_args, ps.ffmpeg_output_args, ps.output_container, ps.folder, ds.user_at_ip, ds.password, ps.is_show, ps.season_override FROM property_settings ps JOIN destination_servers ds ON ps.user_at_ip = ds.user_at_ip WHERE property = ?;''', (topMatch,))
-						row = self.lconn.cur.fetchone()
-						if not row:
-							self.lconn.cur.execute('''SELECT ps.ffmpeg_input_args, ps.ffmpeg_output_args, ps.output_container, ps.folder, ps.is_show, ps.season_override FROM property_settings ps WHERE property = ?;''', (topMatch,))
-							row = self.lconn.cur.fetchone()
-							if row:
-								# hacky way to get around not having a destination server
-								row = list(row)
-								row.insert(4, None)
-								row.insert(5, None)
-								row = tuple(row)
+				size = stream.finish()
+		except BaseException as e:
+			stream.abort()
+			self.sftp_pool.discard(user_at_ip, connection)
+			if e is stream.error or isinstance(e, (SSHException, EOFError)):
+				raise IOError(f'Streaming to {user_at_ip}:{destination} failed ({e})') from e
+			raise
+		finally:
+			self.transfers.release(user_at_ip)
+		self.sftp_pool.release(user_at_ip, connection)
+		return (returncode, size)
+
+	def reuse(self, job_id: int, item: str, key: str, row: tuple, tmp_output_path: str) -> bool:
+		'''
+		Short-circuit a job whose source and settings match an earlier result.
+		It is skipped if that result was delivered to the same place and is still there unchanged, or handed straight to the transfer stage if an unchanged local copy can be linked.
+		Returns `False` if it needs transcoding.
+		'''
+		previous = lookup_result(self.lconn, key)
+		if not previous:
+			return False
+		previous_job, previous_destination, local_path, size, mtime = previous
+		destination = destination_of(row, os.path.basename(tmp_output_path))
+		# Remote deliveries can't be checked without a session, so they are trusted
+		if previous_destination == destination and (not local_path or unchanged(local_path, size, mtime)):
+			logger.info(f'Skipping {item}. It is identical to job {previous_job}, which was already delivered to {destination}.')
+			advance_job(self.lconn, job_id, 'done', cache_key=key)
+			history.record(job_id, self.stage, 'reused', self.started, server=row[4] or '')
+			return True
+		if local_path and unchanged(local_path, size, mtime):
+			if os.path.exists(tmp_output_path):
+				os.remove(tmp_output_path)
+			method = link_or_copy(local_path, tmp_output_path)
+			logger.info(f'Reusing the output of job {previous_job} ({local_path}, {method}) for {item}.')
+			advance_job(self.lconn, job_id, 'transferring', output_path=tmp_output_path, cache_key=key)
+			history.record(job_id, self.stage, 'reused', self.started)
+			return True
+		logger.info(f'{item} is identical to job {previous_job} but its output at {previous_destination} can\'t be reused. Transcoding it again.')
+		return False
+
+	def track(self, job_metrics: Optional[JobMetrics]) -> Optional[dict]:
+		'''Start publishing a job's progress, or stop with `None`. Returns the final stats of the previous metrics.'''
+		stats = None
+		with metrics_lock:
+			if self.metrics:
+				stats = self.metrics.snapshot()
+				del metrics[self.metrics.job_id]
+			self.metrics = job_metrics
+			if job_metrics:
+				metrics[job_metrics.job_id] = job_metrics
+		return stats
+
+	def run_commands(self, job_id: int, commands: list[list[str]], groups: list[list[int]], tracked: Optional[list[bool]] = None, output: Optional[Callable[[IO[bytes]], None]] = None) -> Optional[int]:
+		'''
+		Run ffmpeg commands with one running per group of cores, pinned to that group. Stops starting new ones after a failure.
+		Progress of the `tracked` commands (all by default) counts toward the job's metrics. Commands that stop making progress for `stall_timeout` seconds are killed.
+		With `output`, commands write their output to stdout, which is passed to `output` as they start, and report progress on another pipe.
+		Returns the first non-zero exit code, 0 if all succeeded, or `None` if shutting down.
+		'''
+		pending = list(zip(commands, tracked or [True] * len(commands)))
+		free = list(groups)
+		running: list[tuple[Popen, list[int], Progress]] = []
+		returncode = 0
+		try:
+			while running or (pending and returncode == 0):
+				while pending and free and returncode == 0:
+					cores = free.pop(0)
+					command, track = pending.pop(0)
+					if output is None:
+						p = Popen([command[0], '-progress', 'pipe:1', '-nostats', *command[1:]], stdout=PIPE)
+						progress = Progress(p.stdout)
 					else:
-						logger.warning(f'Can\'t process {item}. No properties that are close enough.')
-				if row:
+						read_fd, write_fd = os.pipe()
+						try:
+							p = Popen([command[0], '-progress', f'pipe:{write_fd}', '-nostats', *command[1:]], stdout=PIPE, pass_fds=(write_fd,))
+						except OSError:
+							os.close(read_fd)
+							raise
+						finally:
+							os.close(write_fd)
+						progress = Progress(os.fdopen(read_fd, 'rb'))
+						output(p.stdout)
+					self.scheduler.apply(p.pid, cores)
+					if track and self.metrics:
+						self.metrics.add(progress)
+					running.append((p, cores, progress))
+				for p, cores, progress in list(running):
+					if p.poll() is not None:
+						running.remove((p, cores, progress))
+						free.append(cores)
+						returncode = returncode or p.returncode
+					elif self.stall_timeout and progress.stalled(self.stall_timeout):
+						logger.warning(f'ffmpeg ({p.pid}) made no progress for {self.stall_timeout:.0f}s. Killing it.')
+						p.kill()
+				if running:
+					if event.wait(timeout=0.25):
+						return None
+					self.heartbeat(job_id)
+			return returncode
+		finally:
+			for p, _, _ in running:
+				p.terminate()
+				p.wait()
+
+	def run_segments(self, job_id: int, plan: SegmentPlan, cores: list[int]) -> Optional[int]:
+		'''Split, encode the pieces in parallel on `cores`, then join them. Returns like `run_commands`.'''
+		plan.prepare()
+		try:
+			returncode = self.run_commands(job_id, [plan.split], [cores], [False])
+			if returncode != 0:
+				return returncode
+			encodes = plan.encodes(max(1, len(cores) // min(plan.segments, len(cores))))
+			groups = [cores[i::min(len(encodes), len(cores))] for i in range(min(len(encodes), len(cores)))]
+			# Audio only needs a fraction of a core so it shares the first group
+			commands = ([plan.audio] if plan.audio else []) + encodes
+			returncode = self.run_commands(job_id, commands, groups[:1] + groups, [False] * (len(commands) - len(encodes)) + [True] * len(encodes))
+			if returncode != 0:
+				return returncode
+			returncode = self.run_commands(job_id, [plan.join], [cores], [False])
+			if returncode != 0:
+				return returncode
+			return 0 if plan.verify(probe(plan.output_path)) else 1
+		finally:
+			plan.cleanup()
+
+
+class TransferThread(JobThread):
+	'''
+	Moves transcoded files to their destination folder, locally or over SFTP. Runs separately from transcoding so slow uploads don't hold a transcode slot.
+	Which transfer runs next, how many run at once for each destination and how fast they upload is left to `transfers`.
+	'''
+	state = 'transferring'
+	stage = 'transfer'
+
+	def __init__(self, catalog: PropertyCatalog, sftp_pool: SftpPool, transfers: TransferScheduler, max_attempts: int, tid: int):
+		JobThread.__init__(self, f'Transfer Thread {tid}', max_attempts)
+		self.catalog = catalog
+		self.sftp_pool = sftp_pool
+		self.transfers = transfers
+		# Also the destination whose transfer slot the claimed job holds
+		self.destination = ''
+
+	def claim(self) -> list[tuple]:
+		heads = destination_heads(self.lconn, self.state)
+		while heads:
+			picked = self.transfers.pick(heads)
+			if not picked:
+				# Every destination with work waiting is at its limit
+				return []
+			job_id, self.destination = picked
+			try:
+				jobs = claim_job(self.lconn, job_id, self.state, self.name, LEASE_TIME)
+			except BaseException:
+				self.transfers.release(self.destination, False)
+				raise
+			if jobs:
+				return jobs
+			# Another transfer thread got it first
+			self.transfers.release(self.destination, False)
+			heads = [head for head in heads if head[0] != job_id]
+		return []
+
+	def work(self, jobs: list[tuple]) -> None:
+		try:
+			self.transfer(jobs[0])
+		finally:
+			self.transfers.release(self.destination)
+
+	def transfer(self, job: tuple) -> None:
+		'''Move a transcoded file to its destination folder, locally or over SFTP'''
+		job_id, item, _, _, _, topMatch, _, tmp_output_path, key = job
+		row = self.catalog.get_settings(topMatch)
+		if not row:
+			self.fail(job_id, item, f'Missing settings for {topMatch}.', retry=False)
+			return
+		destination = os.path.join(row[3], os.path.basename(tmp_output_path))
+		if not os.path.exists(tmp_output_path):
+			if not row[4] and os.path.exists(destination):
+				# Already moved before a restart
+				advance_job(self.lconn, job_id, 'done')
+			else:
+				logger.warning(f'Transcoded file for {item} is missing. Transcoding again.')
+				advance_job(self.lconn, job_id, 'transcoding')
+			return
+		size = os.path.getsize(tmp_output_path)
+		if not row[4]:
+			try:
+				method = deliver(tmp_output_path, destination)
+			except OSError as e:
+				self.fail(job_id, item, f'Could not move {tmp_output_path} to {destination} ({e}).')
+				return
+			self.transfers.sent('', size)
+			logger.debug(f'Moved {tmp_output_path} to {destination} ({method}).')
+		elif sftp_ok:
+			if not row[5] and not self.sftp_pool.private_key_loc:
+				self.fail(job_id, item, f'Can\'t SFTP {item} to remote server. No ssh key or password given. File is processed, but will not be moved.', retry=False)
+				return
+			try:
+				start = time.monotonic()
+				# A pooled session can die between its health check and the upload, so try once more on a fresh one. The upload resumes where it stopped.
+				for attempt in range(2):
 					try:
-						input_args = [a.strip() for a in shlex.split(row[0])]
-						output_args = [a.strip() for a in shlex.split(row[1])]
-						modifiers = ''
-						if row[6]:
-							# is show
-							season_episode = re.search(self.season_episode_regex, filename)
-							if season_episode:
-								modifiers = f' {season_episode.group().upper()}'
-							elif row[7]:
-								season_episode = re.search(self.episode_regex, filename)
-								if season_episode:
-									modifiers = f' S{int(row[7]):02}E{int(season_episode.group().replace(" ", "").replace("-", "").replace("e", "")):02}'
-						tmp_output_path = os.path.join(self.process_folder, topMatch + modifiers + '.' + row[2])
-						s_args = ['ffmpeg', '-y', *input_args, '-i', item, *output_args, '-v', 'quiet', f'{tmp_output_path}']
-						p = Popen(s_args)
-						if p.wait() != 0:
-							raise SubprocessError
-						if not row[4]:
-							os.replace(tmp_output_path, os.path.join(row[3], topMatch + modifiers + '.' + row[2]))
-						elif sftp_ok:
-							sftp_user = row[4].split('@', 1)
-							sftp_host = sftp_user[1].split(':', 1)
-							if len(sftp_host) > 1:
-								sftp_port = int(sftp_host[1])
-							else:
-								sftp_port = 22
-							sftp_host = sftp_host[0]
-							sftp_user = sftp_user[0]
-							try:
-								cpass = True
-								if not row[5] and self.private_key_loc:
-									self.ssh_client.connect(hostname=sftp_host, username=sftp_user, port=sftp_port, key_filename=self.private_key_loc, passphrase=self.private_key_pass)
-								elif row[5]:
-									self.ssh_client.connect(hostname=sftp_host, username=sftp_user, password=row[4], port=sftp_port)
-								else:
-									cpass = False
-								if cpass:
-									sftp = self.ssh_client.open_sftp()
-									sftp.put(tmp_output_path, os.path.join(row[3], topMatch + modifiers + '.' + row[2]))
-									os.remove(tmp_output_path)
-								else:
-									logger.warn(f'Can\'t SFTP {item} to remote server. No ssh key or password given. File is processed, but will not be moved.')
-							except SSHException:
-								logger.warn(f'Can\'t SFTP {item} to remote server. Invalid host. Perhaps it isn\'t in the `known_hosts` file?. File is processed, but will not be moved.')
-							self.ssh_client.close()
-						else:
-							logger.warn(f'Can\'t SFTP {item} to remote server. `paramiko` not installed. File is processed, but will not be moved.')
-					except SubprocessError as e:
-						logger.error(f'\nError executing command {s_args} for {item}: {e}')
-				else:
-					logger.warn(f'\nTried procesing {item}, but failed due to missing settings.')
+						with self.sftp_pool.session(row[4], row[5]) as sftp:
+							upload(sftp, tmp_output_path, destination, callback=lambda sent, total: self.heartbeat(job_id), throttle=lambda n: self.transfers.throttle(row[4], n, event))
+						break
+					except (SSHException, EOFError, ConnectionError) as e:
+						if attempt:
+							raise
+						logger.info(f'SFTP session to {row[4]} failed ({e}). Retrying on a new one.')
+				elapsed = time.monotonic() - start
+				logger.info(f'Uploaded {size} bytes to {row[4]} in {elapsed:.1f}s ({size / max(elapsed, 0.001) / 1024 / 1024:.1f} MiB/s).')
+				os.remove(tmp_output_path)
+			except (SSHException, EOFError, OSError) as e:
+				self.fail(job_id, item, f'Can\'t SFTP {item} to remote server ({e}). Perhaps it isn\'t in the `known_hosts` file?')
+				return
+		else:
+			self.fail(job_id, item, f'Can\'t SFTP {item} to remote server. `paramiko` not installed. File is processed, but will not be moved.', retry=False)
+			return
+		advance_job(self.lconn, job_id, 'done')
+		history.record(job_id, self.stage, 'done', self.started, topMatch, row[4] or '', output_size=size)
+		if key:
+			record_result(self.lconn, key, job_id, destination_of(row, os.path.basename(destination)), None if row[4] else destination, size)
+		logger.info(f'Finished processing {item}')
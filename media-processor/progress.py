@@ -0,0 +1,91 @@
+import threading
+import time
+from typing import IO, Optional
+
+
+class Progress(object):
+	'''
+	Live stats of one ffmpeg process started with `-progress pipe:1`, read from its stdout on a background thread.
+	`updated` is when the encode last moved forward (frames, output time or size changed), so a process that keeps reporting the same numbers still counts as stalled.
+	'''
+	def __init__(self, stream: IO[bytes]):
+		self.frame: int = 0
+		self.fps: float = 0.0
+		self.size: int = 0
+		# Seconds of output written
+		self.out_time: float = 0.0
+		self.speed: float = 0.0
+		self.done: bool = False
+		self.updated: float = time.monotonic()
+		self.thread = threading.Thread(target=self.read, args=(stream,), daemon=True)
+		self.thread.start()
+
+	def read(self, stream: IO[bytes]) -> None:
+		block: dict[str, str] = {}
+		for line in stream:
+			key, _, value = line.decode(errors='replace').strip().partition('=')
+			if key != 'progress':
+				block[key] = value
+				continue
+			# A `progress` line ends each block
+			self.update(block)
+			block = {}
+			if value == 'end':
+				break
+		self.done = True
+		stream.close()
+
+	def update(self, block: dict[str, str]) -> None:
+		frame = to_number(block.get('frame'), int) or 0
+		# `out_time_ms` is really in microseconds as well
+		out_time = (to_number(block.get('out_time_us') or block.get('out_time_ms'), int) or 0) / 1e6
+		size = to_number(block.get('total_size'), int) or 0
+		if (frame, out_time, size) != (self.frame, self.out_time, self.size):
+			self.updated = time.monotonic()
+		self.frame, self.out_time, self.size = frame, out_time, size
+		self.fps = to_number(block.get('fps'), float) or 0.0
+		self.speed = to_number(block.get('speed', '').rstrip('x'), float) or 0.0
+
+	def stalled(self, timeout: float) -> bool:
+		return not self.done and time.monotonic() - self.updated > timeout
+
+
+def to_number(value: Optional[str], kind: type):
+	'''Parse a progress value. `None` for missing or `N/A` values.'''
+	try:
+		return kind(value)
+	except (TypeError, ValueError):
+		return None
+
+
+class JobMetrics(object):
+	'''
+	Throughput of one job summed over the ffmpeg processes that encode it (one, or one per segment).
+	Speed is seconds of output per second of wall time, so the ETA also covers segments that haven't started yet.
+	'''
+	def __init__(self, job_id: int, path: str, duration: float):
+		self.job_id: int = job_id
+		self.path: str = path
+		self.duration: float = duration
+		self.started: Optional[float] = None
+		self.processes: list[Progress] = []
+
+	def add(self, progress: Progress) -> None:
+		if self.started is None:
+			self.started = time.monotonic()
+		self.processes.append(progress)
+
+	def snapshot(self) -> dict:
+		elapsed = time.monotonic() - self.started if self.started is not None else 0.0
+		out_time = sum(p.out_time for p in self.processes)
+		speed = out_time / elapsed if elapsed > 0 else 0.0
+		return {
+			'job': self.job_id,
+			'path': self.path,
+			'frames': sum(p.frame for p in self.processes),
+			'fps': round(sum(p.fps for p in self.processes if not p.done), 2),
+			'speed': round(speed, 3),
+			'size': sum(p.size for p in self.processes),
+			'elapsed': round(elapsed, 1),
+			'eta': round(max(0.0, self.duration - out_time) / speed, 1) if speed > 0 and self.duration else None,
+		}
@@ -0,0 +1,152 @@
+from array import array
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
+import os
+import time
+from typing import Iterable, Optional
+
+# Directory mtimes newer than this (ns) aren't trusted. More entries could land within the same timestamp tick.
+RACY_NS = 2 * 10**9
+
+
+class DirListing(object):
+	'''The files in a single directory. `names` is sorted and `ctimes` is aligned with it.'''
+	__slots__ = ('mtime_ns', 'names', 'ctimes', 'subdirs')
+
+	def __init__(self, mtime_ns: int, names: list[str], ctimes: array, subdirs: list[str]):
+		self.mtime_ns: int = mtime_ns
+		self.names: list[str] = names
+		self.ctimes: array = ctimes
+		self.subdirs: list[str] = subdirs
+
+	def get(self, name: str) -> Optional[float]:
+		i = bisect_left(self.names, name)
+		if i < len(self.names) and self.names[i] == name:
+			return self.ctimes[i]
+		return None
+
+	def set(self, name: str, ctime: float) -> None:
+		i = bisect_left(self.names, name)
+		if i < len(self.names) and self.names[i] == name:
+			self.ctimes[i] = ctime
+		else:
+			self.names.insert(i, name)
+			self.ctimes.insert(i, ctime)
+
+
+class Snapshot(object):
+	'''
+	Compact record of the files seen under a tree and their ctimes.
+	Paths are split into a directory key and a basename so each directory path is only stored once, and ctimes are kept in flat arrays.
+	'''
+	def __init__(self):
+		# directory path -> listing
+		self.dirs: dict[str, DirListing] = {}
+
+	def __len__(self) -> int:
+		return sum(len(listing.names) for listing in self.dirs.values())
+
+	def get(self, path: str) -> Optional[float]:
+		'''Get the recorded ctime of a file. `None` if it hasn't been seen.'''
+		directory, name = os.path.split(path)
+		listing = self.dirs.get(directory)
+		return listing.get(name) if listing else None
+
+	def add(self, path: str, ctime: float) -> None:
+		'''Record a single file (e.g. from an inotify event) without waiting for the next scan.'''
+		directory, name = os.path.split(path)
+		listing = self.dirs.get(directory)
+		if listing is None:
+			# mtime -1 makes the next scan list the directory for real
+			listing = self.dirs[directory] = DirListing(-1, [], array('d'), [])
+		listing.set(name, ctime)
+
+	@classmethod
+	def from_rows(cls, rows: Iterable[tuple[str, float]]) -> 'Snapshot':
+		'''Build a snapshot from `(path, ctime)` rows'''
+		grouped: dict[str, list[tuple[str, float]]] = {}
+		for path, ctime in rows:
+			directory, name = os.path.split(path)
+			grouped.setdefault(directory, []).append((name, ctime))
+		snapshot = cls()
+		for directory, files in grouped.items():
+			files.sort()
+			snapshot.dirs[directory] = DirListing(-1, [f[0] for f in files], array('d', [f[1] for f in files]), [])
+		return snapshot
+
+
+class TreeScanner(object):
+	'''
+	Walk a directory tree and keep a `Snapshot` of it.
+	Each directory's listing is kept along with its mtime and only re-read (with the `DirEntry` stat data) when the mtime changes, so an unchanged directory costs one `stat` and no diffing.
+	Directories are listed level by level on a bounded thread pool.
+	A directory's mtime only changes when entries are added, removed or renamed, so in-place rewrites of a file in an otherwise unchanged directory aren't picked up.
+	'''
+	def __init__(self, base_dir: str, workers: int = 8):
+		self.base_dir: str = base_dir
+		self.workers: int = max(1, workers)
+		self.snapshot = Snapshot()
+
+	def list_dir(self, path: str) -> Optional[tuple[DirListing, Optional[list[tuple]]]]:
+		'''
+		List a single directory. Returns the listing and the `(inode, size, mtime)` of each file, or the previous listing and `None` if it hasn't changed.
+		Returns `None` if the directory is gone or unreadable.
+		'''
+		try:
+			mtime_ns = os.stat(path).st_mtime_ns
+		except (FileNotFoundError, NotADirectoryError, PermissionError):
+			return None
+		cached = self.snapshot.dirs.get(path)
+		if cached and cached.mtime_ns == mtime_ns and time.time_ns() - mtime_ns > RACY_NS:
+			return (cached, None)
+		files: list[tuple] = []
+		dirs: list[str] = []
+		try:
+			with os.scandir(path) as it:
+				for entry in it:
+					try:
+						if entry.is_file():
+							stat = entry.stat()
+							files.append((entry.name, stat.st_ctime, stat.st_ino, stat.st_size, stat.st_mtime))
+						elif entry.is_dir():
+							dirs.append(entry.path)
+					except FileNotFoundError:
+						# Removed while listing
+						continue
+		except (FileNotFoundError, NotADirectoryError, PermissionError):
+			return None
+		files.sort()
+		listing = DirListing(mtime_ns, [f[0] for f in files], array('d', [f[1] for f in files]), dirs)
+		return (listing, [f[2:] for f in files])
+
+	def scan(self) -> tuple[list[tuple], list[str]]:
+		'''Walk the tree and update the snapshot. Returns the `(path, inode, size, mtime, ctime)` rows of new or changed files and the paths of removed files.'''
+		old = self.snapshot.dirs
+		dirs: dict[str, DirListing] = {}
+		added: list[tuple] = []
+		removed: list[str] = []
+		frontier = [self.base_dir]
+		with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='Scanner') as pool:
+			while frontier:
+				next_frontier: list[str] = []
+				for path, result in zip(frontier, pool.map(self.list_dir, frontier)):
+					if result is None:
+						continue
+					listing, stats = result
+					dirs[path] = listing
+					next_frontier.extend(listing.subdirs)
+					if stats is None:
+						continue
+					# Only directories that were re-listed need diffing
+					old_ctimes = dict(zip(old[path].names, old[path].ctimes)) if path in old else {}
+					for name, ctime, stat in zip(listing.names, listing.ctimes, stats):
+						if old_ctimes.pop(name, None) != ctime:
+							added.append((os.path.join(path, name), *stat, ctime))
+					removed.extend(os.path.join(path, name) for name in old_ctimes)
+				frontier = next_frontier
+		for path, listing in old.items():
+			if path not in dirs:
+				removed.extend(os.path.join(path, name) for name in listing.names)
+		self.snapshot.dirs = dirs
+		return (added, removed)
+
@@ -0,0 +1,81 @@
+import logging
+import math
+import os
+import threading
+import time
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+# Pixels one core is expected to keep up with
+PIXELS_PER_CORE = 1280 * 720
+# Clips shorter than this (seconds) don't benefit from more than one core
+SHORT_CLIP = 120.0
+
+
+def available_cores() -> list[int]:
+	if hasattr(os, 'sched_getaffinity'):
+		return sorted(os.sched_getaffinity(0))
+	return list(range(os.cpu_count() or 1))
+
+
+class TranscodeScheduler(object):
+	'''
+	Admits transcode jobs based on free cores and the load average, and hands each job a set of cores to pin ffmpeg to.
+	Jobs ask for cores based on their estimated cost and get as many as are free, so concurrency adapts to the mix of jobs.
+	New jobs wait while the 1 minute load average is above `max_load` unless nothing of ours is running.
+	'''
+	def __init__(self, max_jobs: Optional[int] = None, max_load: Optional[float] = None, nice: int = 0):
+		self.cores: list[int] = available_cores()
+		self.max_jobs: int = max_jobs or len(self.cores)
+		self.max_load: float = max_load or float(len(self.cores))
+		self.nice: int = nice
+		self.free: list[int] = list(self.cores)
+		self.running: int = 0
+		self.cond = threading.Condition()
+
+	def estimate(self, info: Optional[dict], copy_only: bool = False) -> tuple[float, int]:
+		'''Estimate a job's cost (pixels * seconds) and how many cores it should ask for from its `ffprobe` info'''
+		if copy_only or not info:
+			return (0.0, 1)
+		duration = float(info.get('format', {}).get('duration') or 0)
+		pixels = max([s.get('width', 0) * s.get('height', 0) for s in info.get('streams', []) if s.get('codec_type') == 'video'] or [0])
+		if duration and duration < SHORT_CLIP:
+			return (pixels * duration, 1)
+		return (pixels * duration, max(1, min(len(self.cores), math.ceil(pixels / PIXELS_PER_CORE))))
+
+	def load_ok(self) -> bool:
+		try:
+			return os.getloadavg()[0] < self.max_load
+		except OSError:
+			return True
+
+	def acquire(self, wanted: int, stop: threading.Event, timeout: Optional[float] = None) -> Optional[list[int]]:
+		'''Block until the job is admitted. Returns the cores to use, or `None` if `stop` was set or `timeout` seconds passed while waiting.'''
+		deadline = time.monotonic() + timeout if timeout is not None else None
+		with self.cond:
+			while not stop.is_set() and (deadline is None or time.monotonic() < deadline):
+				if self.free and self.running < self.max_jobs and (self.running == 0 or self.load_ok()):
+					granted = self.free[:max(1, wanted)]
+					del self.free[:len(granted)]
+					self.running += 1
+					return granted
+				# Load average changes without anyone notifying, so re-check periodically
+				self.cond.wait(timeout=5.0 if deadline is None else max(0.0, min(5.0, deadline - time.monotonic())))
+		return None
+
+	def release(self, cores: list[int]) -> None:
+		with self.cond:
+			self.free = sorted(self.free + cores)
+			self.running -= 1
+			self.cond.notify_all()
+
+	def apply(self, pid: int, cores: list[int]) -> None:
+		'''Pin a started process to its cores and lower its priority'''
+		try:
+			if hasattr(os, 'sched_setaffinity'):
+				os.sched_setaffinity(pid, cores)
+			if self.nice:
+				os.setpriority(os.PRIO_PROCESS, pid, self.nice)
+		except (OSError, ProcessLookupError) as e:
+			logger.warning(f'Could not set affinity or priority of {pid} ({e}).')
@@ -0,0 +1,83 @@
+import logging
+import os
+import shutil
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+# Shortest piece (seconds) worth encoding separately. Shorter files get fewer segments.
+MIN_SEGMENT = 60.0
+# How far (seconds) the joined output's duration may be from the source's
+DURATION_TOLERANCE = 0.5
+# Args that change which streams are used or what part of the source is read. Segmenting is skipped when they are set.
+UNSAFE_ARGS = {'-map', '-filter_complex', '-lavfi', '-ss', '-sseof', '-t', '-to', '-itsoffset', '-vframes', '-frames:v', '-stream_loop'}
+
+
+def count_segments(info: Optional[dict], segments: Optional[int], input_args: list[str], output_args: list[str], stream_args: list[str]) -> int:
+	'''How many segments to split a source into given its `ffprobe` info. 1 means transcode it in a single pass.'''
+	if not segments or segments < 2 or not info:
+		return 1
+	if UNSAFE_ARGS.intersection(input_args) or UNSAFE_ARGS.intersection(output_args):
+		return 1
+	if '-c:v' in stream_args:
+		# Video is copied so there is nothing to parallelize
+		return 1
+	if not any(s.get('codec_type') == 'video' and not s.get('disposition', {}).get('attached_pic') for s in info.get('streams', [])):
+		return 1
+	duration = float(info.get('format', {}).get('duration') or 0)
+	return max(1, min(segments, int(duration // MIN_SEGMENT)))
+
+
+class SegmentPlan(object):
+	'''
+	The ffmpeg commands to transcode one source as `segments` pieces.
+	1. `split` copies the video stream into pieces. The segment muxer only cuts at keyframes so each piece decodes on its own.
+	2. `encodes` encode the pieces in parallel. `audio` encodes the audio and subtitles once, alongside them.
+	3. `join` concatenates the encoded pieces without re-encoding and muxes the audio back in.
+	The pieces are kept in `work_dir` next to the output, so the split costs one extra copy of the source's video stream in the process folder.
+	'''
+	def __init__(self, item: str, input_args: list[str], output_args: list[str], stream_args: list[str], output_path: str, info: dict, segments: int):
+		self.output_path: str = output_path
+		self.work_dir: str = output_path + '.parts'
+		self.segments: int = segments
+		self.duration: float = float(info['format']['duration'])
+		duration = self.duration
+		streams = info.get('streams', [])
+		has_audio = any(s.get('codec_type') in ('audio', 'subtitle') for s in streams)
+		# The pieces' timestamps start at 0, so the video is shifted back to where it started relative to the other streams to keep it in sync with the audio
+		video_start = float(next((s.get('start_time') for s in streams if s.get('codec_type') == 'video' and not s.get('disposition', {}).get('attached_pic')), 0) or 0)
+		video_start -= float(info['format'].get('start_time') or 0)
+		# Evenly spaced cut points. The muxer moves each one to the next keyframe.
+		times = ','.join(f'{duration * i / segments:.3f}' for i in range(1, segments))
+		self.split: list[str] = ['ffmpeg', '-y', '-v', 'quiet', '-i', item, '-an', '-sn', '-dn', '-c', 'copy', '-f', 'segment', '-segment_times', times, '-reset_timestamps', '1', os.path.join(self.work_dir, 'src%03d.mkv')]
+		self.encode_args: tuple[list[str], list[str]] = (input_args, output_args + stream_args)
+		self.audio: Optional[list[str]] = ['ffmpeg', '-y', *input_args, '-i', item, *output_args, *stream_args, '-vn', '-dn', '-v', 'quiet', os.path.join(self.work_dir, 'audio.mka')] if has_audio else None
+		self.list_path: str = os.path.join(self.work_dir, 'list.txt')
+		self.join: list[str] = ['ffmpeg', '-y', '-v', 'quiet', '-itsoffset', f'{video_start:.6f}', '-f', 'concat', '-safe', '0', '-i', self.list_path]
+		if has_audio:
+			self.join += ['-i', os.path.join(self.work_dir, 'audio.mka'), '-map', '0:v', '-map', '1']
+		self.join += ['-c', 'copy', output_path]
+
+	def prepare(self) -> None:
+		self.cleanup()
+		os.makedirs(self.work_dir)
+
+	def encodes(self, threads: int) -> list[list[str]]:
+		'''Encode commands for the pieces `split` produced. The muxer may produce fewer pieces than asked for if keyframes are sparse.'''
+		pieces = sorted(f for f in os.listdir(self.work_dir) if f.startswith('src'))
+		input_args, output_args = self.encode_args
+		with open(self.list_path, 'w') as f:
+			for piece in pieces:
+				f.write(f"file 'enc{piece[3:]}'\n")
+		return [['ffmpeg', '-y', *input_args, '-i', os.path.join(self.work_dir, piece), *output_args, '-an', '-sn', '-dn', '-threads', str(threads), '-v', 'quiet', os.path.join(self.work_dir, 'enc' + piece[3:])] for piece in pieces]
+
+	def verify(self, info: Optional[dict]) -> bool:
+		'''Check the joined output is as long as the source. Pieces that didn't start on a clean keyframe lose frames.'''
+		duration = float((info or {}).get('format', {}).get('duration') or 0)
+		if abs(duration - self.duration) > DURATION_TOLERANCE:
+			logger.warning(f'Joined output {self.output_path} is {duration:.3f}s long but the source is {self.duration:.3f}s.')
+			return False
+		return True
+
+	def cleanup(self) -> None:
+		shutil.rmtree(self.work_dir, ignore_errors=True)
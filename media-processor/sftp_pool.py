@@ -0,0 +1,161 @@
+from contextlib import contextmanager
+import logging
+import threading
+import time
+from typing import Iterator, Optional
+
+try:
+	from paramiko import AutoAddPolicy, SFTPClient, SSHClient
+	from paramiko.ssh_exception import SSHException
+	sftp_ok = True
+except ImportError:
+	sftp_ok = False
+
+logger = logging.getLogger(__name__)
+
+
+def parse_destination(user_at_ip: str) -> tuple[str, str, int]:
+	'''Split `user@ip:port` (port optional) into user, host and port'''
+	user, host = user_at_ip.split('@', 1)
+	host, _, port = host.partition(':')
+	return (user, host, int(port) if port else 22)
+
+
+class SftpConnection(object):
+	def __init__(self, client: 'SSHClient', sftp: 'SFTPClient', password: Optional[str]):
+		self.client = client
+		self.sftp = sftp
+		self.password: Optional[str] = password
+		self.last_used: float = time.monotonic()
+
+	def close(self) -> None:
+		try:
+			self.sftp.close()
+		except (SSHException, OSError, EOFError):
+			# The session is already dead
+			pass
+		finally:
+			self.client.close()
+
+
+class SftpPool(object):
+	'''
+	Process-wide pool of SFTP sessions, keyed by `destination_servers.user_at_ip`, so uploads don't pay for an SSH handshake and login every time.
+	At most `max_per_destination` sessions are open to each destination. Sessions send keepalives, are checked before being handed out, and are replaced when they have died.
+	Sessions idle for longer than `idle_timeout` seconds are closed.
+	'''
+	def __init__(self, known_hosts: Optional[str], private_key_loc: Optional[str], private_key_pass: Optional[str], max_per_destination: int = 2, keepalive: int = 30, idle_timeout: float = 300.0):
+		self.known_hosts: Optional[str] = known_hosts
+		self.private_key_loc: Optional[str] = private_key_loc
+		self.private_key_pass: Optional[str] = private_key_pass
+		self.max_per_destination: int = max(1, max_per_destination)
+		self.keepalive: int = keepalive
+		self.idle_timeout: float = idle_timeout
+		self.cond = threading.Condition()
+		# user_at_ip -> sessions not in use
+		self.idle: dict[str, list[SftpConnection]] = {}
+		# user_at_ip -> sessions open (idle or in use)
+		self.open: dict[str, int] = {}
+
+	def connect(self, user_at_ip: str, password: Optional[str]) -> SftpConnection:
+		user, host, port = parse_destination(user_at_ip)
+		client = SSHClient()
+		if self.known_hosts:
+			client.load_host_keys(self.known_hosts)
+		else:
+			client.set_missing_host_key_policy(AutoAddPolicy())
+		try:
+			if password:
+				client.connect(hostname=host, username=user, password=password, port=port)
+			else:
+				client.connect(hostname=host, username=user, port=port, key_filename=self.private_key_loc, passphrase=self.private_key_pass)
+			client.get_transport().set_keepalive(self.keepalive)
+			return SftpConnection(client, client.open_sftp(), password)
+		except BaseException:
+			client.close()
+			raise
+
+	def healthy(self, connection: SftpConnection, password: Optional[str]) -> bool:
+		'''Check a pooled session still works. Sessions idle for a while get a round trip to the server, since keepalives may not have noticed a dead peer yet.'''
+		if connection.password != password:
+			# The destination's password changed
+			return False
+		transport = connection.client.get_transport()
+		if transport is None or not transport.is_active() or not transport.is_authenticated():
+			return False
+		if time.monotonic() - connection.last_used > self.keepalive:
+			try:
+				connection.sftp.normalize('.')
+			except (SSHException, OSError, EOFError):
+				return False
+		return True
+
+	def acquire(self, user_at_ip: str, password: Optional[str], wait: bool = True) -> Optional[SftpConnection]:
+		'''Take a healthy session to a destination, waiting if it already has `max_per_destination` in use. Without `wait`, returns `None` instead.'''
+		with self.cond:
+			self.reap()
+			while True:
+				idle = self.idle.setdefault(user_at_ip, [])
+				if idle:
+					connection = idle.pop()
+					break
+				if self.open.get(user_at_ip, 0) < self.max_per_destination:
+					connection = None
+					self.open[user_at_ip] = self.open.get(user_at_ip, 0) + 1
+					break
+				if not wait:
+					return None
+				self.cond.wait()
+		if connection is not None:
+			if self.healthy(connection, password):
+				return connection
+			logger.info(f'Pooled SFTP session to {user_at_ip} is no longer usable. Reconnecting.')
+			connection.close()
+		try:
+			return self.connect(user_at_ip, password)
+		except BaseException:
+			self.discard(user_at_ip, None)
+			raise
+
+	def release(self, user_at_ip: str, connection: SftpConnection) -> None:
+		'''Return a session to the pool'''
+		connection.last_used = time.monotonic()
+		with self.cond:
+			self.idle.setdefault(user_at_ip, []).append(connection)
+			self.cond.notify_all()
+
+	def discard(self, user_at_ip: str, connection: Optional[SftpConnection]) -> None:
+		'''Close a session that failed instead of returning it to the pool'''
+		if connection is not None:
+			connection.close()
+		with self.cond:
+			self.open[user_at_ip] -= 1
+			self.cond.notify_all()
+
+	@contextmanager
+	def session(self, user_at_ip: str, password: Optional[str]) -> Iterator['SFTPClient']:
+		'''Borrow an SFTP session to a destination for the duration of a `with` block. Sessions that raise are closed rather than reused.'''
+		connection = self.acquire(user_at_ip, password)
+		try:
+			yield connection.sftp
+		except BaseException:
+			self.discard(user_at_ip, connection)
+			raise
+		self.release(user_at_ip, connection)
+
+	def reap(self) -> None:
+		'''Close sessions idle for longer than `idle_timeout`. Call with `cond` held.'''
+		now = time.monotonic()
+		for user_at_ip, idle in self.idle.items():
+			for connection in [c for c in idle if now - c.last_used > self.idle_timeout]:
+				idle.remove(connection)
+				self.open[user_at_ip] -= 1
+				connection.close()
+
+	def close(self) -> None:
+		with self.cond:
+			for user_at_ip, idle in self.idle.items():
+				for connection in idle:
+					connection.close()
+				self.open[user_at_ip] -= len(idle)
+				idle.clear()
@@ -0,0 +1,264 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import logging
+import os
+import threading
+from typing import Callable, IO, Iterable, Iterator, Optional
+
+try:
+	from paramiko import SFTPClient, SFTPFile
+	from paramiko.sftp import CMD_WRITE, int64
+	from paramiko.ssh_exception import SSHException
+	sftp_ok = True
+	# paramiko has no public way to send a request and collect its reply later. These private methods do (checked with paramiko 5.0.0).
+	pipelined = hasattr(SFTPClient, '_async_request') and hasattr(SFTPClient, '_read_response')
+except ImportError:
+	sftp_ok = False
+	pipelined = False
+
+logger = logging.getLogger(__name__)
+
+# Uploads go to `<destination>.part` and are renamed into place once complete, so a partial file is never mistaken for a finished one
+PART_SUFFIX = '.part'
+# Bytes per SFTP write request. 32 KiB is the largest every server is required to accept.
+REQUEST_SIZE = 32 * 1024
+# Write requests in flight at once. 64 of them fill the default 2 MiB SSH channel window.
+MAX_OUTSTANDING = 64
+# Bytes at the end of a partial upload compared with the local file before resuming from it
+RESUME_CHECK_SIZE = 64 * 1024
+# SFTP channels a large upload is spread over. The server grants each channel its own window, so more channels keep more data in flight over high latency links.
+# They share the session's SSH connection, and count towards the server's per-connection session limit (10 for OpenSSH).
+STREAMS = 4
+# Files with less than this left to send only use the session's own channel
+STRIPE_MIN = 16 * 1024 * 1024
+# Read buffer for local files
+READ_SIZE = 1024 * 1024
+
+
+def upload(sftp: 'SFTPClient', local_path: str, remote_path: str, callback: Optional[Callable[[int, int], None]] = None, throttle: Optional[Callable[[int], None]] = None, streams: int = STREAMS, request_size: int = REQUEST_SIZE, max_outstanding: int = MAX_OUTSTANDING) -> int:
+	'''
+	Upload a file over SFTP, keeping up to `max_outstanding` write requests in flight on each of up to `streams` channels, so throughput isn't bound by the link's round trip time.
+	The file is written to `remote_path + PART_SUFFIX`, resuming a partial upload left there by an earlier attempt, then verified and renamed to `remote_path`.
+	`callback(sent, total)` is called as writes are acknowledged, and `throttle(n)` before sending each `n` bytes (it may block to limit the rate). Returns the size of the file.
+	Raises `IOError` if the uploaded file doesn't match, and paramiko's exceptions if the session fails.
+	'''
+	size = os.path.getsize(local_path)
+	part_path = remote_path + PART_SUFFIX
+	with open(local_path, 'rb', buffering=0) as local:
+		# Writes are acknowledged in order, so everything more than one window of writes below the end of a partial upload is known to have landed.
+		# A file smaller than `STRIPE_MIN` was sent on one channel, so only one channel's window can be missing.
+		offset = resume_offset(sftp, local, part_path, size, (1 if size < STRIPE_MIN else streams) * max_outstanding * request_size)
+		if offset:
+			logger.info(f'Resuming upload of {local_path} to {remote_path} at {offset} of {size} bytes.')
+		if size - offset < STRIPE_MIN or not pipelined:
+			streams = 1
+		remote = sftp.open(part_path, 'r+' if offset else 'w')
+		extra: list[tuple['SFTPClient', 'SFTPFile']] = []
+		try:
+			if streams > 1:
+				# Each channel takes a few round trips to set up, so open them together
+				with ThreadPoolExecutor(max_workers=streams - 1, thread_name_prefix='SFTP Stream') as pool:
+					futures = [pool.submit(open_stream, sftp, part_path) for _ in range(streams - 1)]
+				extra = [f.result() for f in futures if not f.exception()]
+				for f in futures:
+					if f.exception():
+						raise f.exception()
+			write_all([(sftp, remote)] + extra, file_chunks(local, offset, size, request_size), offset, size, callback, throttle, max_outstanding)
+		finally:
+			remote.close()
+			# Closing a channel closes its handles on the server, without waiting for a reply
+			for client, _ in extra:
+				client.close()
+		verify(sftp, part_path, size, lambda: file_sha1(local), local_path)
+	rename(sftp, part_path, remote_path)
+	return size
+
+
+def open_stream(sftp: 'SFTPClient', part_path: str) -> tuple['SFTPClient', 'SFTPFile']:
+	'''Open another SFTP channel on a session's connection, with the partial upload open for writing'''
+	client = SFTPClient.from_transport(sftp.get_channel().get_transport())
+	try:
+		return (client, client.open(part_path, 'r+'))
+	except BaseException:
+		client.close()
+		raise
+
+
+def resume_offset(sftp: 'SFTPClient', local, part_path: str, size: int, in_flight: int) -> int:
+	'''Where to resume an upload from: `in_flight` bytes before the end of the partial upload if the bytes just before that match the local file, otherwise 0'''
+	try:
+		uploaded = sftp.stat(part_path).st_size or 0
+	except IOError:
+		return 0
+	if uploaded > size:
+		return 0
+	offset = max(0, uploaded - in_flight)
+	if not offset:
+		return 0
+	check = min(RESUME_CHECK_SIZE, offset)
+	with sftp.open(part_path, 'r') as remote:
+		remote.seek(offset - check)
+		tail = remote.read(check)
+	if tail != os.pread(local.fileno(), check, offset - check):
+		logger.info(f'Partial upload {part_path} doesn\'t match the local file. Starting over.')
+		return 0
+	return offset
+
+
+def write_all(streams: list[tuple['SFTPClient', 'SFTPFile']], chunks: Iterable[bytes], offset: int, size: int, callback: Optional[Callable[[int, int], None]], throttle: Optional[Callable[[int], None]], max_outstanding: int) -> int:
+	'''
+	Write `chunks` from `offset` as asynchronous write requests dealt round robin over the channels, waiting only for the oldest once `max_outstanding` per channel are in flight.
+	paramiko's own pipelining instead stops to collect every outstanding reply every 100 requests, leaving the link idle for a round trip each time.
+	Without the private paramiko methods this relies on, the chunks are written on the first channel with paramiko's own pipelining instead.
+	`size` is only passed on to `callback`. Returns the offset after the last chunk.
+	'''
+	if not pipelined:
+		_, remote = streams[0]
+		remote.set_pipelined(True)
+		remote.seek(offset)
+		position = offset
+		for chunk in chunks:
+			if throttle:
+				throttle(len(chunk))
+			remote.write(chunk)
+			position += len(chunk)
+			if callback:
+				callback(position, size)
+		remote.flush()
+		return position
+	pending: deque[tuple['SFTPClient', int, int]] = deque()
+	limit = max_outstanding * len(streams)
+	acked = offset
+	position = offset
+	for n, chunk in enumerate(chunks):
+		if len(pending) >= limit:
+			acked += wait(pending)
+			if callback:
+				callback(acked, size)
+		if throttle:
+			throttle(len(chunk))
+		client, remote = streams[n % len(streams)]
+		pending.append((client, client._async_request(type(None), CMD_WRITE, remote.handle, int64(position), chunk), len(chunk)))
+		position += len(chunk)
+	while pending:
+		acked += wait(pending)
+	if callback:
+		callback(acked, size)
+	return position
+
+
+def file_chunks(local, offset: int, size: int, request_size: int) -> Iterator[bytes]:
+	'''Read a local file from `offset` to `size` in pieces of `request_size`'''
+	position = offset
+	while position < size:
+		buffer = os.pread(local.fileno(), READ_SIZE, position)
+		if not buffer:
+			raise IOError(f'{local.name} shrank while uploading it')
+		for start in range(0, len(buffer), request_size):
+			yield buffer[start:start + request_size]
+		position += len(buffer)
+
+
+def wait(pending: deque) -> int:
+	'''Wait for the oldest write request to be acknowledged. Returns its length.'''
+	client, request, length = pending.popleft()
+	client._read_response(request)
+	return length
+
+
+def file_sha1(local) -> bytes:
+	h = hashlib.sha1()
+	position = 0
+	while buffer := os.pread(local.fileno(), READ_SIZE, position):
+		h.update(buffer)
+		position += len(buffer)
+	return h.digest()
+
+
+def verify(sftp: 'SFTPClient', part_path: str, size: int, sha1: Callable[[], bytes], source: str) -> None:
+	'''Check an upload's size, and its SHA-1 if the server supports the `check-file` extension. A bad upload is removed so the next attempt starts over.'''
+	uploaded = sftp.stat(part_path).st_size
+	if uploaded != size:
+		sftp.remove(part_path)
+		raise IOError(f'{part_path} is {uploaded} bytes after uploading, expected {size}')
+	try:
+		with sftp.open(part_path, 'r') as remote:
+			remote_hash = remote.check('sha1')
+	except IOError:
+		# Most servers (including OpenSSH) don't implement `check-file`. The size check will have to do.
+		return
+	if remote_hash != sha1():
+		sftp.remove(part_path)
+		raise IOError(f'{part_path} doesn\'t match {source} after uploading')
+
+
+def rename(sftp: 'SFTPClient', part_path: str, remote_path: str) -> None:
+	'''Atomically move a finished upload into place, replacing any existing file'''
+	try:
+		sftp.posix_rename(part_path, remote_path)
+	except IOError:
+		# Server without the `posix-rename@openssh.com` extension. Plain SFTP rename won't overwrite.
+		try:
+			sftp.remove(remote_path)
+		except IOError:
+			pass
+		sftp.rename(part_path, remote_path)
+
+
+class StreamUpload(object):
+	'''
+	Uploads a stream, such as ffmpeg's stdout, to `remote_path + PART_SUFFIX` on a background thread as it is produced.
+	At most `max_outstanding` requests of `request_size` are buffered, so a slow link holds the writer back rather than filling memory.
+	Call `finish` once the writer has succeeded to verify the upload and rename it into place, or `abort` to remove it.
+	'''
+	def __init__(self, sftp: 'SFTPClient', remote_path: str, callback: Optional[Callable[[int, int], None]] = None, throttle: Optional[Callable[[int], None]] = None, request_size: int = REQUEST_SIZE, max_outstanding: int = MAX_OUTSTANDING):
+		self.sftp = sftp
+		self.remote_path: str = remote_path
+		self.part_path: str = remote_path + PART_SUFFIX
+		self.callback = callback
+		self.throttle = throttle
+		self.request_size: int = request_size
+		self.max_outstanding: int = max_outstanding
+		self.size: int = 0
+		self.hash = hashlib.sha1()
+		self.error: Optional[BaseException] = None
+		self.thread: Optional[threading.Thread] = None
+
+	def start(self, stream: IO[bytes]) -> None:
+		self.thread = threading.Thread(target=self.run, args=(stream,), name='SFTP Stream', daemon=True)
+		self.thread.start()
+
+	def run(self, stream: IO[bytes]) -> None:
+		try:
+			with self.sftp.open(self.part_path, 'w') as remote:
+				self.size = write_all([(self.sftp, remote)], self.chunks(stream), 0, 0, self.callback, self.throttle, self.max_outstanding)
+		except BaseException as e:
+			self.error = e
+		finally:
+			# If the upload failed the writer gets a broken pipe instead of blocking forever
+			stream.close()
+
+	def chunks(self, stream: IO[bytes]) -> Iterator[bytes]:
+		while chunk := stream.read(self.request_size):
+			self.hash.update(chunk)
+			yield chunk
+
+	def finish(self) -> int:
+		'''Wait for the stream to end, then verify the upload and move it into place. Returns its size. Raises the upload's error if it failed.'''
+		if self.thread:
+			self.thread.join()
+		if self.error:
+			raise self.error
+		verify(self.sftp, self.part_path, self.size, self.hash.digest, 'the stream')
+		rename(self.sftp, self.part_path, self.remote_path)
+		return self.size
+
+	def abort(self) -> None:
+		'''Wait for the stream to end and remove the partial upload'''
+		if self.thread:
+			self.thread.join()
+		try:
+			self.sftp.remove(self.part_path)
+		except (IOError, EOFError, SSHException):
+			pass
@@ -0,0 +1,159 @@
+from collections import deque
+import threading
+import time
+from typing import Optional
+
+from catalog import PropertyCatalog
+
+# Throughput is reported over this many seconds
+RATE_WINDOW = 10.0
+# Bytes a rate limited destination may send at once after being idle, at least
+MIN_BURST = 256 * 1024
+
+
+class TokenBucket(object):
+	'''
+	Limits a byte rate, allowing bursts of up to `burst` bytes.
+	Senders take tokens before sending and sleep off any debt, so concurrent transfers to the same destination share the rate.
+	'''
+	def __init__(self, rate: float, burst: Optional[float] = None):
+		self.rate: float = rate
+		self.burst: float = burst or max(rate, MIN_BURST)
+		self.tokens: float = self.burst
+		self.updated: float = time.monotonic()
+		self.lock = threading.Lock()
+
+	def set_rate(self, rate: float) -> None:
+		with self.lock:
+			self.rate = rate
+			self.burst = max(rate, MIN_BURST)
+
+	def consume(self, n: int, stop: threading.Event) -> None:
+		'''Take `n` bytes worth of tokens, waiting until the rate allows them. Returns early if `stop` is set.'''
+		with self.lock:
+			now = time.monotonic()
+			self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+			self.updated = now
+			self.tokens -= n
+			delay = -self.tokens / self.rate if self.tokens < 0 else 0.0
+		if delay > 0:
+			stop.wait(delay)
+
+
+class DestinationState(object):
+	def __init__(self):
+		self.active: int = 0
+		self.last_started: float = 0.0
+		self.transfers: int = 0
+		self.bytes: int = 0
+		# (time, bytes) sent in the last `RATE_WINDOW` seconds
+		self.samples: deque[tuple[float, int]] = deque()
+		self.bucket: Optional[TokenBucket] = None
+
+	def sent(self, n: int) -> None:
+		now = time.monotonic()
+		self.bytes += n
+		self.samples.append((now, n))
+		while self.samples and now - self.samples[0][0] > RATE_WINDOW:
+			self.samples.popleft()
+
+	def rate(self) -> float:
+		now = time.monotonic()
+		return sum(n for t, n in self.samples if now - t <= RATE_WINDOW) / RATE_WINDOW
+
+
+class TransferScheduler(object):
+	'''
+	Decides which waiting transfer runs next and paces uploads, per destination (`user_at_ip`, or `''` for local folders).
+	Each SFTP destination runs at most `max_transfers` transfers at once (from `destination_servers`, never more than `max_sessions`), and is limited to `max_rate` KiB/s if set.
+	Destinations take turns: the next transfer goes to the destination whose next job has the highest priority, then the one with the fewest transfers running, then the one that started a transfer longest ago.
+	A backlog for one server therefore never holds up delivery to another.
+	'''
+	def __init__(self, catalog: PropertyCatalog, max_sessions: int):
+		self.catalog = catalog
+		self.max_sessions: int = max_sessions
+		self.lock = threading.Lock()
+		self.destinations: dict[str, DestinationState] = {}
+
+	def state(self, destination: str) -> DestinationState:
+		'''Call with `lock` held'''
+		if destination not in self.destinations:
+			self.destinations[destination] = DestinationState()
+		return self.destinations[destination]
+
+	def max_transfers(self, destination: str) -> Optional[int]:
+		'''`None` for no limit. Local folders have no limit besides the number of transfer threads.'''
+		if not destination:
+			return None
+		limits = self.catalog.get_destination(destination)
+		if limits and limits[0]:
+			return max(1, min(limits[0], self.max_sessions))
+		# Uploads beyond this would only wait for a pooled session
+		return self.max_sessions
+
+	def pick(self, heads: list[tuple]) -> Optional[tuple[int, str]]:
+		'''Choose one of the `(job id, user_at_ip, priority)` heads from `destination_heads` and take a transfer slot for it. Returns `(job id, user_at_ip)`, or `None` if every destination with work is busy.'''
+		limits = {destination: self.max_transfers(destination) for _, destination, _ in heads}
+		with self.lock:
+			ready = [h for h in heads if limits[h[1]] is None or self.state(h[1]).active < limits[h[1]]]
+			if not ready:
+				return None
+			job_id, destination, _ = min(ready, key=lambda h: (-h[2], self.state(h[1]).active, self.state(h[1]).last_started))
+			self.start(destination)
+			return (job_id, destination)
+
+	def try_acquire(self, destination: str) -> bool:
+		'''Take a transfer slot for a destination if one is free'''
+		limit = self.max_transfers(destination)
+		with self.lock:
+			if limit is not None and self.state(destination).active >= limit:
+				return False
+			self.start(destination)
+			return True
+
+	def start(self, destination: str) -> None:
+		'''Call with `lock` held'''
+		state = self.state(destination)
+		state.active += 1
+		state.last_started = time.monotonic()
+
+	def release(self, destination: str, finished: bool = True) -> None:
+		'''Give back a transfer slot. `finished` is `False` if the slot went unused, e.g. another thread claimed the job first.'''
+		with self.lock:
+			state = self.state(destination)
+			state.active -= 1
+			if finished:
+				state.transfers += 1
+
+	def sent(self, destination: str, n: int) -> None:
+		'''Account for bytes delivered without `throttle`, such as local moves'''
+		with self.lock:
+			self.state(destination).sent(n)
+
+	def throttle(self, destination: str, n: int, stop: threading.Event) -> None:
+		'''Account for `n` bytes about to be sent to a destination, waiting if that would exceed its bandwidth limit'''
+		limits = self.catalog.get_destination(destination) if destination else None
+		rate = limits[1] * 1024 if limits and limits[1] else None
+		with self.lock:
+			state = self.state(destination)
+			state.sent(n)
+			if rate is None:
+				state.bucket = None
+			elif state.bucket is None:
+				state.bucket = TokenBucket(rate)
+			elif state.bucket.rate != rate:
+				state.bucket.set_rate(rate)
+			bucket = state.bucket
+		if bucket:
+			bucket.consume(n, stop)
+
+	def snapshot(self) -> dict[str, dict]:
+		'''Per destination transfers running, finished and bytes sent so far, and the throughput (bytes/s) over the last `RATE_WINDOW` seconds'''
+		with self.lock:
+			return {destination or 'local': {
+				'active': state.active,
+				'transfers': state.transfers,
+				'bytes': state.bytes,
+				'rate': round(state.rate()),
+				'max_rate': round(state.bucket.rate) if state.bucket else None,
+			} for destination, state in self.destinations.items()}